@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 from datetime import date
 from typing import Optional
 
@@ -14,3 +14,37 @@ class Task(BaseModel):
         return self.__str__()
 
 
+class TaskExtraction(BaseModel):
+    """The structured response for one message: one task per action item, none if it has no task"""
+    # Required and closed, so a response in the wrong shape is retried rather than read as no task
+    model_config = ConfigDict(extra="forbid")
+
+    tasks: list[Task]
+
+
+class MessageTaskExtraction(TaskExtraction):
+    model_config = ConfigDict(extra="forbid")
+
+    id: str
+
+
+class BatchTaskExtraction(BaseModel):
+    """The structured response for a batch: one result per message id"""
+    model_config = ConfigDict(extra="forbid")
+
+    results: list[MessageTaskExtraction]
+
+
+class TaskTriage(BaseModel):
+    """The cheap first pass over a message: whether it has a task, and how sure the model is"""
+    model_config = ConfigDict(extra="forbid")
+
+    id: str
+    has_task: bool
+    confidence: float = Field(ge=0, le=1)
+
+
+class BatchTaskTriage(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    results: list[TaskTriage]
@@ -0,0 +1,183 @@
+"""
+local pre-classification that skips obvious non-task mail before it reaches the LLM
+"""
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import zlib
+from collections import Counter
+
+from app.config import settings
+from app.message_service.models import Message
+
+NOREPLY_SENDER = re.compile(r"(no-?reply|do-?not-?reply|notifications?@|mailer-daemon|bounces?@)", re.IGNORECASE)
+BULK_PRECEDENCE = {"bulk", "list", "junk"}
+TOKEN = re.compile(r"[a-z0-9]{2,}")
+
+
+def header_rules(message: Message) -> str | None:
+    """
+    Return the reason a message looks automated from its headers, or None
+    """
+    headers = {name.lower(): value for name, value in message.headers.items()}
+    if "list-unsubscribe" in headers:
+        return "list-unsubscribe"
+    if headers.get("precedence", "").strip().lower() in BULK_PRECEDENCE:
+        return "bulk-precedence"
+    if headers.get("auto-submitted", "no").strip().lower() != "no":
+        return "auto-submitted"
+    if NOREPLY_SENDER.search(message.sender):
+        return "noreply-sender"
+    return None
+
+
+class PreFilter:
+    def __init__(
+        self,
+        mode: str = "shadow",
+        threshold: float = 0.97,
+        rule_threshold: float = 0.5,
+        min_samples: int = 200,
+        model_path: str | None = None,
+        n_features: int = 2 ** 20
+    ):
+        """
+        Header rules combined with a hashed bag-of-words naive Bayes model that
+        learns online from the LLM's decisions.
+
+        Args:
+            mode: "off", "shadow" to only measure the LLM calls that would be
+                saved, or "enforce" to skip messages without calling the LLM
+            threshold: the probability of no task needed to skip a message
+            rule_threshold: the lower probability needed when a header rule matches
+            min_samples: the LLM decisions seen before the model is trusted;
+                until then only header rules can skip a message
+            model_path: the JSON file the model is loaded from and saved to
+            n_features: the size of the hashed feature space
+        """
+        self.mode = mode
+        self.threshold = threshold
+        self.rule_threshold = rule_threshold
+        self.min_samples = min_samples
+        self.model_path = model_path
+        self.n_features = n_features
+        self._lock = threading.Lock()
+        # Per class (0 no task, 1 task): message counts and feature counts
+        self.class_counts = [0, 0]
+        self.feature_counts = [Counter(), Counter()]
+        self.feature_totals = [0, 0]
+        self.stats = Counter(checked=0, would_skip=0, skipped=0, missed_tasks=0)
+        if model_path and os.path.exists(model_path):
+            try:
+                self.load()
+            except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+                # A corrupt model must not stop the app from importing, it is relearned from the LLM's decisions
+                print(f"Could not load the prefilter model from {model_path}, starting from an empty model: {e}")
+
+    def features(self, message: Message) -> Counter:
+        tokens = TOKEN.findall(f"{message.subject} {message.body}".lower())
+        domain = message.sender.rsplit("@", 1)[-1].strip("> ").lower()
+        tokens.append(f"domain:{domain}")
+        tokens.extend(f"header:{name.lower()}" for name in message.headers)
+        return Counter(zlib.crc32(token.encode()) % self.n_features for token in tokens)
+
+    def predict(self, message: Message) -> float:
+        """
+        Return the probability that the message has no task
+        """
+        features = self.features(message)
+        with self._lock:
+            total = sum(self.class_counts)
+            log_probs = []
+            for label in (0, 1):
+                counts = self.feature_counts[label]
+                denominator = self.feature_totals[label] + self.n_features
+                log_prob = math.log((self.class_counts[label] + 1) / (total + 2))
+                for feature, count in features.items():
+                    log_prob += count * math.log((counts[feature] + 1) / denominator)
+                log_probs.append(log_prob)
+        # Softmax over the two classes
+        return 1 / (1 + math.exp(max(min(log_probs[1] - log_probs[0], 700), -700)))
+
+    def decide(self, message: Message) -> bool:
+        """
+        Whether the message can be skipped, regardless of mode
+        """
+        rule = header_rules(message)
+        if sum(self.class_counts) < self.min_samples:
+            return rule is not None
+        return self.predict(message) >= (self.rule_threshold if rule else self.threshold)
+
+    def should_skip(self, message: Message) -> bool:
+        """
+        Decide whether to skip the LLM for a message. Only returns True in
+        enforce mode, in shadow mode the decision is just counted.
+        """
+        if self.mode == "off":
+            return False
+        skip = self.decide(message)
+        with self._lock:
+            self.stats["checked"] += 1
+            if skip:
+                self.stats["would_skip"] += 1
+                if self.mode == "enforce":
+                    self.stats["skipped"] += 1
+        return skip and self.mode == "enforce"
+
+    def observe(self, message: Message, has_task: bool):
+        """
+        Learn from the LLM's decision for a message. In shadow mode, also count
+        the tasks that would have been lost by skipping it.
+        """
+        if self.mode == "off":
+            return
+        if self.mode == "shadow" and has_task and self.decide(message):
+            with self._lock:
+                self.stats["missed_tasks"] += 1
+        features = self.features(message)
+        label = int(has_task)
+        with self._lock:
+            self.class_counts[label] += 1
+            self.feature_counts[label].update(features)
+            self.feature_totals[label] += sum(features.values())
+
+    def load(self):
+        with open(self.model_path) as f:
+            model = json.load(f)
+        class_counts = [int(count) for count in model["class_counts"]]
+        feature_counts = [Counter({int(k): v for k, v in counts.items()}) for counts in model["feature_counts"]]
+        if len(class_counts) != 2 or len(feature_counts) != 2:
+            raise ValueError("expected counts for two classes")
+        with self._lock:
+            self.class_counts = class_counts
+            self.feature_counts = feature_counts
+            self.feature_totals = [sum(counts.values()) for counts in feature_counts]
+
+    def save(self):
+        if not self.model_path:
+            return
+        with self._lock:
+            model = {"class_counts": self.class_counts, "feature_counts": [dict(counts) for counts in self.feature_counts]}
+        # Write a temporary file and rename it over the model, so a crash mid-write never leaves a truncated model
+        directory = os.path.dirname(os.path.abspath(self.model_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".prefilter-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(model, f)
+            os.replace(tmp_path, self.model_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+# Shared by every polling worker so the model learns from the whole userbase
+prefilter = PreFilter(
+    mode=settings.PREFILTER_MODE,
+    threshold=settings.PREFILTER_THRESHOLD,
+    rule_threshold=settings.PREFILTER_RULE_THRESHOLD,
+    min_samples=settings.PREFILTER_MIN_SAMPLES,
+    model_path=settings.PREFILTER_MODEL_PATH
+)
@@ -0,0 +1,236 @@
+"""
+builds the LLM prompts for task identification within a token budget, keeping attachment data out of them
+"""
+import functools
+import inspect
+import math
+import threading
+from collections import Counter
+from datetime import date
+from string import Template
+
+from app.config import settings
+from app.message_service.models import Message
+
+# Mistral tokenizers average about four characters of English per token
+CHARS_PER_TOKEN = 4
+TRUNCATED = " [truncated]"
+
+SYSTEM_PROMPT_TEMPLATE = """
+    You will be given a message from the users work email or slack and you need to identify if the message contains a task and if so return the task in a json format.
+    Remember this is for work so the task should be something that is work related.
+
+    The json should have the following fields:
+    - title: a short title for the task
+    - due_date: the due date of the task - this should be in the format YYYY-MM-DD - if no due date is found return null
+    - description: the description of the task
+
+    if the message does not contain a task return None
+
+    Three examples of messages that contain tasks:
+
+    Message 1:
+    Subject: Website Update Request
+    From: manager@company.com
+    Body: Hi team, we need to update the pricing page on our website by next Friday. Please make sure to include the new enterprise tier pricing and update all the feature comparisons.
+
+    Expected Response:
+    {
+        "title": "Update Website Pricing Page",
+        "due_date": "2024-01-19",
+        "description": "Update pricing page to include new enterprise tier pricing and feature comparison updates"
+    }
+
+    Message 2:
+    Subject: Q4 Report Draft Review
+    From: finance@company.com
+    Body: Please review the attached Q4 financial report draft and provide feedback by January 25th. Focus particularly on the revenue projections section.
+
+    Expected Response:
+    {
+        "title": "Review Q4 Financial Report",
+        "due_date": "2024-01-25",
+        "description": "Review Q4 financial report draft with focus on revenue projections section"
+    }
+
+    Message 3:
+    Subject: Team Meeting Notes
+    From: teammate@company.com
+    Body: Can you help document the action items from today's meeting? We need to prepare the client presentation slides and send them for internal review.
+
+    Expected Response:
+    {
+        "title": "Prepare Client Presentation",
+        "due_date": null,
+        "description": "Create presentation slides for client and submit for internal review"
+    }
+
+    Two examples of a message that does not contain a task:
+
+    Message 4:
+    Subject: Project Status Update
+    From: projectmanager@company.com
+    Body: Here's the latest status update on the project. We're on track for the deadline.
+
+    Expected Response:
+    None
+
+    Message 5:
+    Subject: Holiday Sale Announcement
+    From: marketing@company.com
+    Body: Just wanted to let everyone know that our holiday sale is live! 25% off all products until December 31st. Check it out at company.com/sale
+
+    Expected Response:
+    None
+
+    Todays date is $today - this is important to know for the due date
+    """
+
+BATCH_INSTRUCTIONS = """
+    You will now be given several messages at once, each starting with a line "Message id: <id>".
+    Identify the task in each message independently, following the instructions above.
+    Respond with a single json object that has one key per message id, where the value is the task json for that message or null if it does not contain a task.
+    Return only the json object.
+    """
+
+STRUCTURED_INSTRUCTIONS = """
+    A message can contain several tasks, such as meeting notes with an action item for each attendee. Return one task json per distinct action item.
+    Respond with a json object with a single key "tasks", holding the list of task json, or an empty list where the examples above respond None.
+    """
+
+STRUCTURED_BATCH_INSTRUCTIONS = """
+    You will now be given several messages at once, each starting with a line "Message id: <id>".
+    Identify the task in each message independently, following the instructions above.
+    A message can contain several tasks, such as meeting notes with an action item for each attendee. Return one task json per distinct action item.
+    Respond with a json object with a single key "results", holding a list with one entry per message.
+    Each entry has the message "id" and its "tasks", the list of task json or an empty list where the examples above respond None.
+    """
+
+TRIAGE_PROMPT = inspect.cleandoc("""
+    You will be given messages from the users work email or slack, each starting with a line "Message id: <id>".
+    For each message decide whether it asks the user to do a work related task.
+    Respond with a json object with a single key "results", holding a list with one entry per message.
+    Each entry has the message "id", "has_task" true or false, and your "confidence" in that answer from 0 to 1.
+    """)
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+@functools.lru_cache(maxsize=8)
+def compile_system_prompt(today: date, batch: bool = False, structured: bool = False) -> str:
+    """
+    The system prompt for a day, with the indentation of the templates removed.
+    Compiled once per day rather than on every request.
+
+    Args:
+        today: the date the model resolves relative due dates against
+        batch: add the instructions for several messages per request
+        structured: ask for the json schema of the structured output mode
+    """
+    prompt = inspect.cleandoc(Template(SYSTEM_PROMPT_TEMPLATE).substitute(today=today.isoformat()))
+    if structured:
+        instructions = STRUCTURED_BATCH_INSTRUCTIONS if batch else STRUCTURED_INSTRUCTIONS
+    else:
+        instructions = BATCH_INSTRUCTIONS if batch else None
+    if instructions:
+        prompt += "\n\n" + inspect.cleandoc(instructions)
+    return prompt
+
+
+class PromptBuilder:
+    def __init__(self, body_token_budget: int | None = None):
+        """
+        Args:
+            body_token_budget: the most tokens of a message body sent to the LLM,
+                LLM_BODY_TOKEN_BUDGET by default
+        """
+        self.body_token_budget = body_token_budget or settings.LLM_BODY_TOKEN_BUDGET
+        self._lock = threading.Lock()
+        self.stats = Counter(requests=0, estimated_tokens=0, truncated=0, chunked=0)
+
+    def system_prompt(self, batch: bool = False, structured: bool = False) -> str:
+        return compile_system_prompt(date.today(), batch, structured)
+
+    def truncate(self, text: str) -> str:
+        """
+        Cut text down to the body token budget, at a word boundary where there is one
+        """
+        limit = self.body_token_budget * CHARS_PER_TOKEN
+        if len(text) <= limit:
+            return text
+        with self._lock:
+            self.stats["truncated"] += 1
+        cut = text[:limit - len(TRUNCATED)]
+        if " " in cut:
+            cut = cut.rsplit(" ", 1)[0]
+        return cut + TRUNCATED
+
+    def chunk(self, message: Message) -> list[Message]:
+        """
+        Split a message whose body is over the token budget into at most
+        LLM_MAX_CHUNKS messages, each with a part of the body, breaking at word
+        boundaries. Anything past the last chunk is left out.
+        """
+        limit = self.body_token_budget * CHARS_PER_TOKEN
+        if len(message.body) <= limit:
+            return [message]
+        parts = []
+        body = message.body
+        while body and len(parts) < settings.LLM_MAX_CHUNKS:
+            cut = len(body) if len(body) <= limit else body.rfind(" ", 0, limit)
+            if cut <= 0:
+                cut = limit
+            parts.append(body[:cut])
+            body = body[cut:].lstrip()
+        with self._lock:
+            self.stats["chunked"] += 1
+            self.stats["truncated"] += bool(body)
+        return [
+            message.model_copy(update={"subject": f"{message.subject} (part {i + 1} of {len(parts)})", "body": part})
+            for i, part in enumerate(parts)
+        ]
+
+    def render(self, message: Message) -> str:
+        """
+        Render only what the LLM needs from a message: attachments are listed by name and type, never their data
+        """
+        lines = [
+            f"Sender: {message.sender}",
+            f"Subject: {message.subject}",
+            f"Body: {self.truncate(message.body)}",
+        ]
+        if message.attachments:
+            lines.append("Attachments: " + ", ".join(f"{attachment.filename} ({attachment.mimeType})" for attachment in message.attachments))
+        return "\n".join(lines)
+
+    def task_request(self, message: Message, structured: bool = False) -> list[dict]:
+        return self._request(self.system_prompt(structured=structured), self.render(message))
+
+    def batch_request(self, messages: list[Message], structured: bool = False) -> list[dict]:
+        return self._request(self.system_prompt(batch=True, structured=structured), self._render_batch(messages))
+
+    def triage_request(self, messages: list[Message]) -> list[dict]:
+        """
+        The short prompt of the small model that decides which messages are worth a full extraction
+        """
+        return self._request(TRIAGE_PROMPT, self._render_batch(messages))
+
+    def _render_batch(self, messages: list[Message]) -> str:
+        # Messages are labelled with their position in the batch as a stable id
+        return "\n\n".join(f"Message id: {i}\n{self.render(message)}" for i, message in enumerate(messages))
+
+    def _request(self, system: str, user: str) -> list[dict]:
+        tokens = estimate_tokens(system) + estimate_tokens(user)
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["estimated_tokens"] += tokens
+        print(f"Estimated prompt tokens: {tokens}")
+        return [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user}
+        ]
+
+
+prompt_builder = PromptBuilder()
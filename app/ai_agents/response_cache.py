@@ -0,0 +1,106 @@
+"""
+cache of raw LLM responses keyed by a hash of the model and the prompt, so identical mail is only classified once
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from app.config import settings
+
+
+class ResponseCache:
+    def __init__(self, max_size: int = 1024, path: str | None = None, ttl_seconds: float = 86400):
+        """
+        Two tier response cache: a size-bounded in-process LRU in front of an optional SQLite file.
+
+        Args:
+            max_size: the maximum number of responses held in memory
+            path: the SQLite file of the on-disk tier, or None to only cache in memory
+            ttl_seconds: how long a response stays valid in either tier
+        """
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS llm_responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS ix_llm_responses_created_at ON llm_responses (created_at)")
+            self._db.commit()
+
+    @staticmethod
+    def make_key(model: str, *prompt: str) -> str:
+        """
+        Hash the model name and the prompt, with whitespace normalized so
+        re-wrapped or re-indented copies of the same mail share a key
+        """
+        normalized = "\n".join(" ".join(part.split()) for part in prompt)
+        return hashlib.sha256(f"{model}\n{normalized}".encode()).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[1] < self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self._entries.pop(key, None)
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT response, created_at FROM llm_responses WHERE key = ? AND created_at > ?",
+                    (key, now - self.ttl_seconds)
+                ).fetchone()
+                if row:
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def set(self, key: str, response: str):
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO llm_responses (key, response, created_at) VALUES (?, ?, ?)",
+                    (key, response, now)
+                )
+                self._db.execute("DELETE FROM llm_responses WHERE created_at <= ?", (now - self.ttl_seconds,))
+                self._db.commit()
+
+    def _remember(self, key: str, response: str, created_at: float):
+        self._entries[key] = (response, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+            }
+
+
+# Shared by every TaskIdentifier so identical mail across users costs one LLM call
+response_cache = ResponseCache(
+    max_size=settings.LLM_CACHE_SIZE,
+    path=settings.LLM_CACHE_PATH,
+    ttl_seconds=settings.LLM_CACHE_TTL_SECONDS
+)
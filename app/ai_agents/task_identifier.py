@@ -5,93 +5,286 @@ from app.message_service.models import Message
 from mistralai import Mistral
 import os
 import json
-from app.ai_agents.models import Task       
-from datetime import datetime
+import asyncio
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from app.ai_agents.models import Task, TaskExtraction, BatchTaskExtraction, BatchTaskTriage
+from app.ai_agents.response_cache import ResponseCache, response_cache
+from app.ai_agents.prompt import PromptBuilder, prompt_builder, estimate_tokens
+from app.config import settings
+from app.rate_limiter import mistral_limiter, call_with_backoff, call_with_backoff_async
+from pydantic import ValidationError
+
+
+class LLMStats:
+    def __init__(self, window: int = 1000):
+        """
+        Completions paid for and thrown away across all TaskIdentifiers, with
+        the calls, tokens, cost and latency of each tier of the model cascade
+
+        Args:
+            window: the most recent latencies per tier the percentiles are taken over
+        """
+        self._lock = threading.Lock()
+        self._counts = Counter(calls=0, wasted_calls=0)
+        self._latencies = defaultdict(lambda: deque(maxlen=window))
+
+    def __getitem__(self, name: str):
+        with self._lock:
+            return self._counts[name]
+
+    def count(self, **counts: int):
+        with self._lock:
+            self._counts.update(counts)
+
+    def record(self, tier: str, seconds: float, tokens: int, cost: float):
+        with self._lock:
+            self._counts["calls"] += 1
+            self._counts[f"{tier}_calls"] += 1
+            self._counts[f"{tier}_tokens"] += tokens
+            self._counts[f"{tier}_cost"] += cost
+            self._latencies[tier].append(seconds)
+
+    def snapshot(self) -> dict:
+        """The counts, and the median and 95th percentile latency of each tier"""
+        with self._lock:
+            stats = dict(self._counts)
+            for tier, latencies in self._latencies.items():
+                ordered = sorted(latencies)
+                stats[f"{tier}_p50_seconds"] = ordered[len(ordered) // 2]
+                stats[f"{tier}_p95_seconds"] = ordered[int(0.95 * (len(ordered) - 1))]
+        return stats
+
+
+llm_stats = LLMStats()
+
+
+def response_format(model) -> dict:
+    """The Mistral response format that constrains the output to a pydantic model's json schema"""
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": model.__name__, "schema": model.model_json_schema(), "strict": True}
+    }
+
+
+def merge_tasks(tasks: list[Task]) -> list[Task]:
+    """
+    Drop tasks with the same title as an earlier one, as the chunks of a long
+    message can repeat an action item. A duplicate's due date fills in a missing one.
+    """
+    merged = {}
+    for task in tasks:
+        key = " ".join(task.title.lower().split())
+        if key not in merged:
+            merged[key] = task
+        elif merged[key].due_date is None and task.due_date is not None:
+            merged[key] = merged[key].model_copy(update={"due_date": task.due_date})
+    return list(merged.values())
+
 
 class TaskIdentifier:
-    def __init__(self):
+    def __init__(
+        self,
+        cache: ResponseCache | None = None,
+        batch_size: int | None = None,
+        concurrency: int | None = None,
+        timeout: float | None = None,
+        prompts: PromptBuilder | None = None,
+        output_mode: str | None = None,
+        schema_retries: int | None = None,
+        cascade: bool | None = None
+    ):
+        """
+        Args:
+            cache: the response cache, the shared one by default
+            batch_size: the messages classified per request, LLM_BATCH_SIZE by default
+            concurrency: the requests in flight at once on the async path, LLM_CONCURRENCY by default
+            timeout: the seconds an async request may take before it is cancelled, LLM_TIMEOUT_SECONDS by default
+            prompts: renders the requests, the shared prompt builder by default
+            output_mode: "structured" to constrain responses to the Task json schema,
+                or "text" to parse free text responses, LLM_OUTPUT_MODE by default
+            schema_retries: the requests repeated when a structured response breaks
+                the schema, LLM_SCHEMA_RETRIES by default
+            cascade: triage batches with LLM_TRIAGE_MODEL before extracting tasks
+                with LLM_EXTRACT_MODEL, LLM_CASCADE by default
+        """
         self.mistral = Mistral(api_key=os.getenv("MISTRAL_TOKEN"))
+        self.cache = cache if cache is not None else response_cache
+        self.batch_size = batch_size or settings.LLM_BATCH_SIZE
+        self.concurrency = concurrency or settings.LLM_CONCURRENCY
+        self.timeout = timeout or settings.LLM_TIMEOUT_SECONDS
+        self.prompts = prompts or prompt_builder
+        self.structured = (output_mode or settings.LLM_OUTPUT_MODE) == "structured"
+        self.schema_retries = settings.LLM_SCHEMA_RETRIES if schema_retries is None else schema_retries
+        self.cascade = settings.LLM_CASCADE if cascade is None else cascade
+        self.model = settings.LLM_EXTRACT_MODEL
+        # The model and price per million tokens of each tier
+        self.tiers = {
+            "triage": (settings.LLM_TRIAGE_MODEL, settings.LLM_TRIAGE_COST_PER_MILLION_TOKENS),
+            "extract": (settings.LLM_EXTRACT_MODEL, settings.LLM_EXTRACT_COST_PER_MILLION_TOKENS),
+        }
+
+    def _task_request(self, message: Message) -> list[dict]:
+        return self.prompts.task_request(message, self.structured)
+
+    def _batch_request(self, messages: list[Message]) -> list[dict]:
+        return self.prompts.batch_request(messages, self.structured)
+
+    def _complete(self, messages: list[dict], response_format: dict | None = None, tier: str = "extract") -> str:
+        """
+        Run a chat completion on the model of a tier within the Mistral rate limit, backing off on 429s
+        """
+        model, kwargs = self.tiers[tier][0], {"response_format": response_format} if response_format else {}
+        start = time.monotonic()
+        completion = call_with_backoff(
+            lambda: self.mistral.chat.complete(model=model, messages=messages, **kwargs),
+            mistral_limiter
+        )
+        return self._record(tier, messages, completion, start)
+
+    async def _complete_async(self, messages: list[dict], response_format: dict | None = None, tier: str = "extract") -> str:
+        model, kwargs = self.tiers[tier][0], {"response_format": response_format} if response_format else {}
+        start = time.monotonic()
+        completion = await call_with_backoff_async(
+            lambda: asyncio.wait_for(
+                self.mistral.chat.complete_async(model=model, messages=messages, **kwargs),
+                timeout=self.timeout
+            ),
+            mistral_limiter
+        )
+        return self._record(tier, messages, completion, start)
+
+    def _record(self, tier: str, messages: list[dict], completion, start: float) -> str:
+        """
+        Record the latency, tokens and cost of a completion and return its content.
+        Tokens are estimated when the response does not report its usage.
+        """
+        content = completion.choices[0].message.content
+        tokens = getattr(getattr(completion, "usage", None), "total_tokens", None)
+        if not isinstance(tokens, int):
+            tokens = sum(estimate_tokens(message["content"]) for message in messages) + estimate_tokens(content or "")
+        llm_stats.record(tier, time.monotonic() - start, tokens, tokens * self.tiers[tier][1] / 1e6)
+        return content
+
+    def _schema(self, count: int | None = None) -> tuple:
+        """
+        The validator and response format of a structured request for one message,
+        or for a batch of `count` messages. Both are None in text mode.
+        """
+        if not self.structured:
+            return None, None
+        if count is None:
+            return self.parse_structured_response, response_format(TaskExtraction)
+        return lambda response: self.parse_structured_batch_response(response, count), response_format(BatchTaskExtraction)
+
+    def _validated(self, messages: list[dict], count: int | None = None) -> tuple[str, bool]:
+        """
+        Complete a request, repeating it up to `schema_retries` times while a
+        structured response breaks the schema. Text responses are returned as is.
+
+        Returns:
+            tuple: the last response and whether it is valid
+        """
+        validate, schema = self._schema(count)
+        for attempt in range(self.schema_retries + 1 if validate else 1):
+            response = self._complete(messages, schema)
+            if self._is_valid(response, validate, attempt):
+                return response, True
+        return response, False
+
+    async def _validated_async(self, messages: list[dict], count: int | None = None) -> tuple[str, bool]:
+        validate, schema = self._schema(count)
+        for attempt in range(self.schema_retries + 1 if validate else 1):
+            response = await self._complete_async(messages, schema)
+            if self._is_valid(response, validate, attempt):
+                return response, True
+        return response, False
+
+    def _is_valid(self, response: str, validate, attempt: int) -> bool:
+        if validate is None:
+            return True
+        try:
+            validate(response)
+            return True
+        except ValueError as e:
+            llm_stats.count(wasted_calls=1)
+            print(f"Response breaks the schema (attempt {attempt + 1} of {self.schema_retries + 1}): {e}")
+            return False
+
+    def _cache_key(self, message: Message) -> str:
+        # The triage model is part of the key, as with the cascade a cached result may be its decision
+        models = f"{self.tiers['triage'][0]}>{self.model}" if self.cascade else self.model
+        return self.cache.make_key(models, self.prompts.system_prompt(structured=self.structured), self.prompts.render(message))
 
     def identify_task(self, message: Message) -> str:
         print(f"Identifying task for message: {message}")
-        return self.mistral.chat.complete(
-            model="mistral-large-latest",
-            messages=[
-                {"role": "system", "content": """
-                 
-                 You will be given a message from the users work email or slack and you need to identify if the message contains a task and if so return the task in a json format.
-                 Remember this is for work so the task should be something that is work related.
-
-                 The json should have the following fields:
-                 - task: a short title for the task
-                 - due_date: the due date of the task - this should be in the format YYYY-MM-DD - if no due date is found return None
-                 - description: the description of the task
-
-                 if the message does not contain a task return None
-
-                 Four examples of messages that contain tasks:
-                 
-                 Message 1:
-                 Subject: Website Update Request
-                 From: manager@company.com
-                 Body: Hi team, we need to update the pricing page on our website by next Friday. Please make sure to include the new enterprise tier pricing and update all the feature comparisons.
-                 
-                 Expected Response:
-                 {
-                     "title": "Update Website Pricing Page",
-                     "due_date": "2024-01-19",
-                     "description": "Update pricing page to include new enterprise tier pricing and feature comparison updates"
-                 }
-
-                 Message 2:
-                 Subject: Q4 Report Draft Review
-                 From: finance@company.com
-                 Body: Please review the attached Q4 financial report draft and provide feedback by January 25th. Focus particularly on the revenue projections section.
-                 
-                 Expected Response:
-                 {
-                     "title": "Review Q4 Financial Report",
-                     "due_date": "2024-01-25", 
-                     "description": "Review Q4 financial report draft with focus on revenue projections section"
-                 }
-
-                 Message 3:
-                 Subject: Team Meeting Notes
-                 From: teammate@company.com
-                 Body: Can you help document the action items from today's meeting? We need to prepare the client presentation slides and send them for internal review.
-                 
-                 Expected Response:
-                 {
-                    "title": "Prepare Client Presentation",
-                     "due_date": None,
-                     "description": "Create presentation slides for client and submit for internal review"
-                 }
-
-                 Two examples of a message that does not contain a task:
-
-                 Message 4:
-                 Subject: Project Status Update
-                 From: projectmanager@company.com
-                 Body: Here's the latest status update on the project. We're on track for the deadline.
-                 
-                 Expected Response:
-                 None   
-
-                 Message 5:
-                 Subject: Holiday Sale Announcement
-                 From: marketing@company.com
-                 Body: Just wanted to let everyone know that our holiday sale is live! 25% off all products until December 31st. Check it out at company.com/sale
-                 
-                 Expected Response:
-                 None
-
-                 Todays date is {datetime.now().strftime("%Y-%m-%d")} - this is important to know for the due date 
-
-                 """
-                 },
-                {"role": "user", "content": str(message)}
-            ]
-        ).choices[0].message.content
+        key = self._cache_key(message)
+        response = self.cache.get(key)
+        if response is not None:
+            return response
+
+        response, valid = self._validated(self._task_request(message))
+        if valid:
+            self.cache.set(key, response)
+        return response
+
+    async def identify_task_async(self, message: Message) -> str:
+        print(f"Identifying task for message: {message}")
+        key = self._cache_key(message)
+        response = self.cache.get(key)
+        if response is not None:
+            return response
+
+        response, valid = await self._validated_async(self._task_request(message))
+        if valid:
+            self.cache.set(key, response)
+        return response
+
+    def parse_structured_response(self, response: str) -> list[Task]:
+        """
+        Validate a structured response against the TaskExtraction schema in one pass
+
+        Raises:
+            ValueError: if the response breaks the schema
+        """
+        return TaskExtraction.model_validate_json(response).tasks
+
+    def parse_structured_batch_response(self, response: str, count: int) -> list[list[Task]]:
+        """
+        Validate a structured batch response and map it back to its messages
+
+        Raises:
+            ValueError: if the response breaks the schema or has no result for some message
+        """
+        results = {result.id: result.tasks for result in BatchTaskExtraction.model_validate_json(response).results}
+        missing = [i for i in range(count) if str(i) not in results]
+        if missing:
+            raise ValueError(f"No result for messages {missing}")
+        return [results[str(i)] for i in range(count)]
+
+    def _parse(self, response: str) -> list[Task]:
+        # Text responses hold at most one task
+        if not self.structured:
+            task = self.parse_response(response)
+            return [task] if task else []
+        try:
+            return self.parse_structured_response(response)
+        except ValueError:
+            print(f"Error parsing response: {response}")
+            return []
+
+    def _parse_batch(self, response: str, count: int) -> list[list[Task]] | None:
+        if not self.structured:
+            results = self.parse_batch_response(response, count)
+            if results is None:
+                llm_stats.count(wasted_calls=1)
+                return None
+            return [[task] if task else [] for task in results]
+        try:
+            return self.parse_structured_batch_response(response, count)
+        except ValueError:
+            return None
 
     def parse_response(self, response: str) -> Task:
         print(f"Parsing response: {response}")
@@ -120,7 +313,227 @@ class TaskIdentifier:
             return None
 
     def get_task(self, message: Message) -> Task|None:
+        """
+        The first task in a message, from a request of its own. get_tasks finds every task.
+        """
+        tasks = self._request_tasks(message)
+        return tasks[0] if tasks else None
+
+    def _request_tasks(self, message: Message) -> list[Task]:
         response = self.identify_task(message)
-        return self.parse_response(response)
-    
+        return self._parse(response)
+
+    def identify_tasks(self, messages: list[Message]) -> str:
+        """
+        Classify several messages in one completion, sending the system prompt once
+        """
+        print(f"Identifying tasks for {len(messages)} messages")
+        return self._validated(self._batch_request(messages), len(messages))[0]
+
+    async def identify_tasks_async(self, messages: list[Message]) -> str:
+        print(f"Identifying tasks for {len(messages)} messages")
+        return (await self._validated_async(self._batch_request(messages), len(messages)))[0]
+
+    def parse_batch_response(self, response: str, count: int) -> list[Task | None] | None:
+        """
+        Map a batch response back to its messages.
+
+        Returns:
+            list: the task for each message, in order, or None if the response is
+            malformed or does not have a valid result for every message
+        """
+        print(f"Parsing batch response: {response}")
+        cleaned_response = response
+        if "```json" in cleaned_response:
+            cleaned_response = cleaned_response.split("```json")[-1]
+            cleaned_response = cleaned_response.split("```")[0]
+        try:
+            results = json.loads(cleaned_response.strip())
+            if not isinstance(results, dict) or any(str(i) not in results for i in range(count)):
+                return None
+            return [Task(**results[str(i)]) if results[str(i)] else None for i in range(count)]
+        except (json.JSONDecodeError, TypeError, ValidationError):
+            print(f"Error parsing batch response: {response}")
+            return None
+
+    async def get_task_async(self, message: Message) -> Task | None:
+        tasks = await self._request_tasks_async(message)
+        return tasks[0] if tasks else None
+
+    async def _request_tasks_async(self, message: Message) -> list[Task]:
+        response = await self.identify_task_async(message)
+        return self._parse(response)
+
+    def parse_triage_response(self, response: str, count: int) -> list[bool]:
+        """
+        Decide from a triage response which messages need a full extraction: those
+        the small model thinks have a task, or is not confident have none
+
+        Raises:
+            ValueError: if the response breaks the schema or has no result for some message
+        """
+        results = {result.id: result for result in BatchTaskTriage.model_validate_json(response).results}
+        missing = [i for i in range(count) if str(i) not in results]
+        if missing:
+            raise ValueError(f"No triage result for messages {missing}")
+        return [
+            results[str(i)].has_task or results[str(i)].confidence < settings.LLM_TRIAGE_NO_TASK_CONFIDENCE
+            for i in range(count)
+        ]
+
+    def _escalated(self, keys: list[str], batch: list[int], response: str) -> list[int]:
+        """
+        Cache the messages the triage settled as having no task, and return the rest.
+        Every message is escalated if the triage response is unusable.
+        """
+        try:
+            escalate = self.parse_triage_response(response, len(batch))
+        except ValueError as e:
+            llm_stats.count(wasted_calls=1)
+            print(f"Triage response breaks the schema, escalating the batch: {e}")
+            return batch
+        no_task = TaskExtraction(tasks=[]).model_dump_json() if self.structured else "None"
+        for i, needed in zip(batch, escalate):
+            if not needed:
+                self.cache.set(keys[i], no_task)
+        llm_stats.count(triaged=len(batch), escalated=sum(escalate))
+        return [i for i, needed in zip(batch, escalate) if needed]
+
+    def _triage(self, messages: list[Message], keys: list[str], batch: list[int]) -> list[int]:
+        """
+        Run the first tier of the cascade over a batch
 
+        Returns:
+            list: the indexes of the messages escalated to the extraction model
+        """
+        if not self.cascade:
+            return batch
+        request = self.prompts.triage_request([messages[i] for i in batch])
+        return self._escalated(keys, batch, self._complete(request, response_format(BatchTaskTriage), tier="triage"))
+
+    async def _triage_async(self, messages: list[Message], keys: list[str], batch: list[int]) -> list[int]:
+        if not self.cascade:
+            return batch
+        request = self.prompts.triage_request([messages[i] for i in batch])
+        return self._escalated(keys, batch, await self._complete_async(request, response_format(BatchTaskTriage), tier="triage"))
+
+    def _lookup_cached(self, messages: list[Message]) -> tuple[list[list[Task]], list[str], list[list[int]]]:
+        """
+        Resolve the messages that are already cached.
+
+        Returns:
+            tuple: the tasks found so far, the cache key of every message, and
+            the indexes of the uncached messages split into batches
+        """
+        tasks = [[] for _ in messages]
+        keys = [self._cache_key(message) for message in messages]
+        pending = []
+        for i, key in enumerate(keys):
+            response = self.cache.get(key)
+            if response is None:
+                pending.append(i)
+            else:
+                tasks[i] = self._parse(response)
+        batches = [pending[start:start + self.batch_size] for start in range(0, len(pending), self.batch_size)]
+        return tasks, keys, batches
+
+    def _store_batch(self, tasks: list[list[Task]], keys: list[str], batch: list[int], results: list[list[Task]]):
+        for i, found in zip(batch, results):
+            # Cached in the same form as a single message response so either path can reuse it
+            if self.structured:
+                self.cache.set(keys[i], TaskExtraction(tasks=found).model_dump_json())
+            else:
+                self.cache.set(keys[i], found[0].model_dump_json() if found else "None")
+            tasks[i] = found
+
+    def _chunk(self, messages: list[Message]) -> tuple[list[Message], list[int]]:
+        """
+        Split long messages into chunks that fit the token budget
+
+        Returns:
+            tuple: the chunks, and the index of the message each one came from
+        """
+        chunks, owners = [], []
+        for i, message in enumerate(messages):
+            for chunk in self.prompts.chunk(message):
+                chunks.append(chunk)
+                owners.append(i)
+        return chunks, owners
+
+    def _merge(self, count: int, owners: list[int], results: list[list[Task]]) -> list[list[Task]]:
+        merged = [[] for _ in range(count)]
+        for owner, found in zip(owners, results):
+            merged[owner].extend(found)
+        return [merge_tasks(found) for found in merged]
+
+    def get_tasks(self, messages: list[Message]) -> list[list[Task]]:
+        """
+        Get every task in each message, packing up to `batch_size` uncached
+        messages into each request. A batch whose response is malformed falls
+        back to one request per message.
+
+        Messages over the body token budget are split into chunks that are
+        extracted separately, and their tasks merged. With the cascade on, the
+        small model triages each batch first and only the messages it does not
+        confidently rule out reach the extraction model.
+
+        Returns:
+            list: the tasks of each message, empty for messages without a task
+        """
+        chunks, owners = self._chunk(messages)
+        return self._merge(len(messages), owners, self._extract(chunks))
+
+    def _extract(self, messages: list[Message]) -> list[list[Task]]:
+        tasks, keys, batches = self._lookup_cached(messages)
+        for batch in batches:
+            batch = self._triage(messages, keys, batch)
+            results = None
+            if len(batch) > 1:
+                results = self._parse_batch(self.identify_tasks([messages[i] for i in batch]), len(batch))
+            if results is None:
+                for i in batch:
+                    tasks[i] = self._request_tasks(messages[i])
+                continue
+            self._store_batch(tasks, keys, batch, results)
+        return tasks
+
+    async def get_tasks_async(self, messages: list[Message]) -> list[list[Task]]:
+        """
+        Async get_tasks that runs up to `concurrency` requests at once.
+
+        Each request is cancelled after `timeout` seconds. If any request
+        fails, the ones still in flight are cancelled and the error is raised,
+        so no message is reported as having no task when it was never classified.
+        """
+        chunks, owners = self._chunk(messages)
+        return self._merge(len(messages), owners, await self._extract_async(chunks))
+
+    async def _extract_async(self, messages: list[Message]) -> list[list[Task]]:
+        tasks, keys, batches = self._lookup_cached(messages)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def classify(message_index: int):
+            async with semaphore:
+                tasks[message_index] = await self._request_tasks_async(messages[message_index])
+
+        async def classify_batch(batch: list[int]):
+            async with semaphore:
+                batch = await self._triage_async(messages, keys, batch)
+            results = None
+            if len(batch) > 1:
+                async with semaphore:
+                    response = await self.identify_tasks_async([messages[i] for i in batch])
+                results = self._parse_batch(response, len(batch))
+            if results is None:
+                await asyncio.gather(*(classify(i) for i in batch))
+                return
+            self._store_batch(tasks, keys, batch, results)
+
+        requests = [asyncio.ensure_future(classify_batch(batch)) for batch in batches]
+        try:
+            await asyncio.gather(*requests)
+        except BaseException:
+            for request in requests:
+                request.cancel()
+            raise
+        return tasks
@@ -1,22 +1,22 @@
 from fastapi import APIRouter, HTTPException, Depends, Request
 from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 import logging
-from app.models import User, get_db
+from app.models import User, get_async_db
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
 
 @router.post('/login')
-async def login(request: Request, db: Session = Depends(get_db)):
+async def login(request: Request, db: AsyncSession = Depends(get_async_db)):
     data = await request.json()
     email = data.get('email')
     password = data.get('password') 
     print(f"email: {email}, password: {password}")
     print(f"db type: {type(db)}")
-    print(f"db query type: {type(db.query)}")
-    user = db.query(User).filter(User.email == email).first()
+    user = (await db.execute(select(User).filter(User.email == email))).scalars().first()
     print(f"user: {user}")
     if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
@@ -36,7 +36,7 @@ async def login(request: Request, db: Session = Depends(get_db)):
 
 
 @router.post('/register')
-async def register(request: Request, db: Session = Depends(get_db)):
+async def register(request: Request, db: AsyncSession = Depends(get_async_db)):
     print("register")
     print(f"request: {request}")
     print(f"request type: {type(request)}")
@@ -51,14 +51,14 @@ async def register(request: Request, db: Session = Depends(get_db)):
     print(f"email: {email}, password: {password}")
     user = User(email=email, password=password)
     db.add(user)
-    db.commit()
+    await db.commit()
     return JSONResponse(status_code=200, content={"message": "Successfully registered", "user": {"id": user.id, "email": user.email}})
 
 @router.get('/user')
-async def get_user(request: Request, db: Session = Depends(get_db)):
+async def get_user(request: Request, db: AsyncSession = Depends(get_async_db)):
     data = await request.json()
     user_id = data.get('user_id')
-    user = db.query(User).filter(User.id == user_id).first()
+    user = (await db.execute(select(User).filter(User.id == user_id))).scalars().first()
     return JSONResponse(status_code=200, content={
         "user": {
             "id": user.id, 
@@ -1,13 +1,19 @@
 from google_auth_oauthlib.flow import Flow
-from fastapi import Request, APIRouter, HTTPException, Depends
+from fastapi import Request, Response, APIRouter, HTTPException, Depends, Body, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import RedirectResponse, JSONResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 import jwt
 import logging
+import secrets
 from datetime import datetime
 
 from app.config import settings
-from app.models import User, GmailCredentials, get_db
+from app.models import User, GmailCredentials, get_async_db
+from app.services.gmail_polling import request_poll
+from app.services.gmail_push import decode_push_notification, verify_push_identity
+from app.services.job_queue import mark_due_statement
 
 
 router = APIRouter()
@@ -53,7 +59,7 @@ async def login():
 
 
 @router.get("/integrations/google/callback")
-async def callback(request: Request, db: Session = Depends(get_db)):
+async def callback(request: Request, db: AsyncSession = Depends(get_async_db)):
     try:
         flow, credentials = get_flow_and_credentials(request)
         
@@ -71,13 +77,13 @@ async def callback(request: Request, db: Session = Depends(get_db)):
             raise HTTPException(status_code=400, detail="User email not found in token")
 
         # Create or update user
-        user = db.query(User).filter(User.email == user_email).first()
+        user = (await db.execute(select(User).filter(User.email == user_email))).scalars().first()
         if not user:
             raise HTTPException(status_code=400, detail="User not found")
         
         if not user.is_google_authenticated:
             user.is_google_authenticated = True
-            db.commit()
+            await db.commit()
 
         # Store credentials
         db.add(
@@ -87,7 +93,7 @@ async def callback(request: Request, db: Session = Depends(get_db)):
                 refresh_token=credentials.refresh_token, 
                 token_expiry=datetime.fromtimestamp(credentials.expiry.timestamp())
             ))
-        db.commit()
+        await db.commit()
         
         return JSONResponse(status_code=200, content={"message": "Successfully authenticated with Gmail"})
 
@@ -96,3 +102,57 @@ async def callback(request: Request, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"Authentication failed: {str(e)}")
 
 
+@router.post("/integrations/google/push", status_code=204)
+async def push(
+    envelope: dict = Body(...),
+    token: str | None = None,
+    authorization: str | None = Header(None),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Receive a Gmail watch notification from a Pub/Sub push subscription and poll
+    only the mailbox that changed. Any 2xx acknowledges the message, anything
+    else is redelivered by Pub/Sub.
+    """
+    # Without a shared secret anyone could trigger polls, so pushes stay off until one is configured
+    if not settings.GMAIL_PUSH_TOKEN:
+        logger.warning("Rejecting push notification, GMAIL_PUSH_TOKEN is not configured")
+        raise HTTPException(status_code=403, detail="Push notifications are not configured")
+    if not secrets.compare_digest(token or "", settings.GMAIL_PUSH_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid push token")
+    if settings.GMAIL_PUSH_AUDIENCE:
+        try:
+            # Fetches Google's signing certificates, so it runs off the event loop
+            await run_in_threadpool(verify_push_identity, authorization)
+        except ValueError as e:
+            logger.warning(f"Rejecting push notification: {e}")
+            raise HTTPException(status_code=403, detail="Invalid push identity")
+    try:
+        email, history_id = decode_push_notification(envelope)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    user = (await db.execute(
+        select(User.id, GmailCredentials.history_id).join(
+            GmailCredentials, GmailCredentials.user_id == User.id
+        ).filter(
+            User.email == email,
+            User.is_active == True,
+            User.is_google_authenticated == True
+        ).order_by(GmailCredentials.id.desc()).limit(1)
+    )).first()
+    if user is None:
+        logger.info(f"Ignoring push notification for unknown mailbox {email}")
+        return Response(status_code=204)
+
+    # Notifications can arrive late or more than once, skip any we have already synced past
+    if user.history_id and user.history_id.isdigit() and int(history_id) <= int(user.history_id):
+        return Response(status_code=204)
+
+    if settings.POLLING_MODE == "worker":
+        # Whichever worker claims the job next polls the user
+        await db.execute(mark_due_statement(user.id))
+        await db.commit()
+    else:
+        request_poll(user.id)
+    return Response(status_code=204)
@@ -1,34 +1,110 @@
+import base64
+import json
 import logging
-from fastapi import APIRouter, HTTPException, Depends, Header
-from sqlalchemy.orm import Session
-from app.models import Task, User, get_db
+from datetime import date, datetime, time
+from typing import Literal
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, Response
+from sqlalchemy import literal, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.models import Task, User, get_async_db
 from app.ai_agents.models import Task as TaskModel
 
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+SORT_ORDERS = ("created_at", "-created_at", "due_date", "-due_date")
+
+def encode_cursor(sort: str, value: datetime | None, task_id: int) -> str:
+    cursor = {"sort": sort, "value": value.isoformat() if value else None, "id": task_id}
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+def decode_cursor(cursor: str, sort: str) -> tuple[datetime | None, int]:
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        value = datetime.fromisoformat(decoded["value"]) if decoded["value"] else None
+        task_id = int(decoded["id"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if decoded.get("sort") != sort:
+        raise HTTPException(status_code=400, detail="Cursor does not match sort order")
+    return value, task_id
+
+def keyset_filter(column, descending: bool, value: datetime, task_id: int):
+    """
+    Filter for the rows after (value, task_id) in the order (column, id). A row
+    value comparison, so the page is a range scan of the (user_id, column, id) index
+    """
+    row, after = tuple_(column, Task.id), tuple_(literal(value, column.type), literal(task_id))
+    return row < after if descending else row > after
+
 @router.get("/tasks", response_model=list[TaskModel])
-async def get_tasks(user_id: int = Header(description="The ID of the user"), db: Session = Depends(get_db)):
-    """Get all tasks for the current user"""
-    user = db.query(User).filter(User.id == user_id).first()
+async def get_tasks(
+    response: Response,
+    user_id: int = Header(description="The ID of the user"),
+    limit: int = Query(50, ge=1, le=500, description="The maximum number of tasks to return"),
+    cursor: str | None = Query(None, description="The X-Next-Cursor of the previous page"),
+    sort: Literal[SORT_ORDERS] = Query("-created_at", description="The sort order, prefix with - for descending"),
+    completed: bool | None = Query(None),
+    due_after: date | None = Query(None, description="Only tasks due on or after this date"),
+    due_before: date | None = Query(None, description="Only tasks due on or before this date"),
+    created_after: datetime | None = Query(None, description="Only tasks created after this time"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Get a page of tasks for the current user.
+
+    Pages are keyset paginated: pass the X-Next-Cursor header of a page as
+    `cursor` to get the next one. The header is missing on the last page.
+    """
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    tasks = db.query(Task).filter(Task.user_id == user_id).all()
+    descending = sort.startswith("-")
+    column = Task.created_at if sort.endswith("created_at") else Task.due_date
+    query = select(Task).filter(Task.user_id == user_id)
+    if completed is not None:
+        query = query.filter(Task.completed == completed)
+    if due_after:
+        query = query.filter(Task.due_date >= datetime.combine(due_after, time.min))
+    if due_before:
+        query = query.filter(Task.due_date <= datetime.combine(due_before, time.max))
+    if created_after:
+        query = query.filter(Task.created_at > created_after)
+    value, task_id = decode_cursor(cursor, sort) if cursor else (None, None)
+
+    # Fetch one extra row to know whether there is a next page
+    tasks = []
+    if value is not None or task_id is None:
+        page = query.filter(column.is_not(None)) if column.nullable else query
+        if cursor:
+            page = page.filter(keyset_filter(column, descending, value, task_id))
+        order = (column.desc(), Task.id.desc()) if descending else (column.asc(), Task.id.asc())
+        tasks = list((await db.execute(page.order_by(*order).limit(limit + 1))).scalars().all())
+    # Tasks without a due date come last, as a second phase paged by id alone
+    if column.nullable and len(tasks) <= limit:
+        tail = query.filter(column.is_(None))
+        if task_id is not None and value is None:
+            tail = tail.filter(Task.id < task_id if descending else Task.id > task_id)
+        tail = tail.order_by(Task.id.desc() if descending else Task.id.asc()).limit(limit + 1 - len(tasks))
+        tasks += (await db.execute(tail)).scalars().all()
+    if len(tasks) > limit:
+        tasks = tasks[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(sort, getattr(tasks[-1], column.key), tasks[-1].id)
     return tasks
 
 @router.put("/tasks/{task_id}", response_model=TaskModel)
-async def update_task(task_id: int, task: TaskModel, db: Session = Depends(get_db)):
+async def update_task(task_id: int, task: TaskModel, db: AsyncSession = Depends(get_async_db)):
     """Update a task"""
-    db_task = db.query(Task).filter(Task.id == task_id).first()
+    db_task = await db.get(Task, task_id)
     if not db_task:
         raise HTTPException(status_code=404, detail="Task not found")
     db_task.title = task.title
     db_task.description = task.description
     db_task.due_date = task.due_date
-    db.commit()
-    db.refresh(db_task)
+    await db.commit()
+    await db.refresh(db_task)
     return db_task
 
 
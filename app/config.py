@@ -10,6 +10,103 @@ class Settings(BaseSettings):
     GOOGLE_TOKEN_URL: str = "https://oauth2.googleapis.com/token"
     GOOGLE_SCOPES: list = ["https://www.googleapis.com/auth/userinfo.email", "https://www.googleapis.com/auth/gmail.readonly", "openid"]
 
+    # Database, a sqlite:// or postgresql:// URL
+    DATABASE_URL: str = "sqlite:///mail_tasks.db"
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_MMAP_SIZE: int = 268435456
+
+    # Polling
+    POLLING_INTERVAL_SECONDS: float = 10  # how often an inbox that just produced tasks is polled
+    POLLING_MAX_INTERVAL_SECONDS: float = 900  # how often an idle inbox is polled
+    POLLING_BACKOFF_FACTOR: float = 2.0
+    POLLING_USER_RELOAD_SECONDS: float = 60
+    # "thread" polls inside the API process, "worker" leaves polling to app.worker processes
+    POLLING_MODE: str = "thread"
+    POLL_JOB_LEASE_SECONDS: float = 120
+    POLL_JOB_HEARTBEAT_SECONDS: float = 30
+    POLL_JOB_CLAIM_INTERVAL_SECONDS: float = 1
+    POLLING_WORKERS: int = 8
+    POLLING_CYCLE_TIMEOUT_SECONDS: float = 300
+    POLLING_USER_BATCH_SIZE: int = 500
+    LEDGER_RETENTION_DAYS: int = 30
+    LEDGER_COMPACTION_INTERVAL_SECONDS: float = 3600
+
+    # Ingestion pipeline, the classify stage runs LLM_CONCURRENCY workers
+    PIPELINE_FETCH_WORKERS: int = 4
+    PIPELINE_PARSE_WORKERS: int = 2
+    PIPELINE_PREFILTER_WORKERS: int = 1
+    PIPELINE_PERSIST_WORKERS: int = 2
+    PIPELINE_PERSIST_BATCH_SIZE: int = 100
+    PIPELINE_QUEUE_SIZE: int = 100
+    PIPELINE_RUN_TIMEOUT_SECONDS: float = 600  # the longest a poll waits for its messages to be persisted
+    PIPELINE_MAX_MESSAGE_FAILURES: int = 3  # polls a message can fail in before it is dead lettered and the cursor moves on
+
+    # Gmail push notifications, polling becomes a safety net when a topic is set
+    GMAIL_PUSH_TOPIC: str | None = None  # projects/<project>/topics/<topic>
+    GMAIL_PUSH_TOKEN: str | None = None  # shared secret in the push subscription's endpoint URL, pushes are rejected without it
+    GMAIL_PUSH_AUDIENCE: str | None = None  # audience of the push subscription's OIDC token, verified when set
+    GMAIL_PUSH_SERVICE_ACCOUNT: str | None = None  # service account the OIDC token must be signed for
+    GMAIL_WATCH_RENEWAL_SECONDS: float = 86400
+    GMAIL_WATCH_CHECK_INTERVAL_SECONDS: float = 3600
+    POLLING_SAFETY_NET_SECONDS: float = 900
+
+    # Gmail
+    GMAIL_RESYNC_LIMIT: int = 50
+    GMAIL_BATCH_SIZE: int = 50
+    GMAIL_CLIENT_CACHE_SIZE: int = 1000
+    GMAIL_CLIENT_IDLE_SECONDS: float = 900
+    # Mail in these inbox categories is never fetched
+    GMAIL_EXCLUDED_CATEGORIES: list[str] = ["social", "promotions"]
+    # The only headers fetched with each message, the pre-filter reads the bulk mail ones
+    GMAIL_METADATA_HEADERS: list[str] = ["Subject", "From", "To", "Date", "List-Unsubscribe", "Precedence", "Auto-Submitted"]
+
+    # Background token refresh
+    TOKEN_REFRESH_LEAD_SECONDS: float = 300
+    TOKEN_REFRESH_BATCH_SIZE: int = 50
+    TOKEN_REFRESH_INTERVAL_SECONDS: float = 30
+    TOKEN_REFRESH_RELOAD_SECONDS: float = 300
+    TOKEN_CACHE_SIZE: int = 4096
+
+    # Upstream rate limits, in requests per second
+    GMAIL_RATE_LIMIT: float = 3000
+    GMAIL_USER_RATE_LIMIT: float = 40
+    MISTRAL_RATE_LIMIT: float = 5
+    BACKOFF_RETRIES: int = 5
+    BACKOFF_BASE_SECONDS: float = 1
+    BACKOFF_MAX_SECONDS: float = 60
+
+    # LLM
+    LLM_BATCH_SIZE: int = 8
+    LLM_CONCURRENCY: int = 4
+    LLM_TIMEOUT_SECONDS: float = 60
+    LLM_CACHE_SIZE: int = 10000
+    LLM_CACHE_PATH: str | None = None
+    LLM_CACHE_TTL_SECONDS: float = 86400
+    LLM_BODY_TOKEN_BUDGET: int = 1000  # message body tokens sent per request, longer bodies are chunked
+    LLM_MAX_CHUNKS: int = 4  # the most chunks of one message extracted, the rest is truncated
+    LLM_OUTPUT_MODE: str = "structured"  # "structured" json schema responses or free "text"
+    LLM_SCHEMA_RETRIES: int = 1  # repeats of a request whose structured response breaks the schema
+
+    # Model cascade: a small model triages every batch, and only messages it is
+    # not confident have no task are escalated to the extraction model.
+    # Costs are blended prices in dollars per million tokens, for the stats.
+    LLM_CASCADE: bool = True
+    LLM_TRIAGE_MODEL: str = "mistral-small-latest"
+    LLM_TRIAGE_NO_TASK_CONFIDENCE: float = 0.9
+    LLM_TRIAGE_COST_PER_MILLION_TOKENS: float = 0.1
+    LLM_EXTRACT_MODEL: str = "mistral-large-latest"
+    LLM_EXTRACT_COST_PER_MILLION_TOKENS: float = 2.0
+
+    # Local pre-filter ahead of the LLM: "off", "shadow" or "enforce"
+    PREFILTER_MODE: str = "shadow"
+    PREFILTER_THRESHOLD: float = 0.97
+    PREFILTER_RULE_THRESHOLD: float = 0.5
+    PREFILTER_MIN_SAMPLES: int = 200
+    PREFILTER_MODEL_PATH: str | None = None
+
     class Config:
         env_file = ".env"
 
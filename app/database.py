@@ -0,0 +1,70 @@
+"""
+engine factory for the configured DATABASE_URL, used by the models, scripts and polling service
+"""
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from app.config import settings
+
+# Async drivers for each backend, the async engine uses the same database as the sync one
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+def to_async_url(url: str) -> str:
+    """
+    Swap a database URL's driver for its async equivalent
+    """
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for database backend: {backend}")
+    return parsed.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Let the polling workers write while the API reads: WAL for concurrent
+    readers, a busy timeout instead of "database is locked", and mmap reads
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}")
+    cursor.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+    cursor.close()
+
+
+def _engine_options(url: str) -> dict:
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    return {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_pre_ping": True,
+    }
+
+
+def create_db_engine(url: str | None = None) -> Engine:
+    """
+    Create the engine for `url`, DATABASE_URL by default, tuned for its backend
+    """
+    url = url or settings.DATABASE_URL
+    engine = create_engine(url, **_engine_options(url))
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", set_sqlite_pragmas)
+    return engine
+
+
+def create_async_db_engine(url: str | None = None) -> AsyncEngine:
+    """
+    Create the async engine for `url`, DATABASE_URL by default, tuned for its backend
+    """
+    url = to_async_url(url or settings.DATABASE_URL)
+    engine = create_async_engine(url, **_engine_options(url))
+    if engine.dialect.name == "sqlite":
+        event.listen(engine.sync_engine, "connect", set_sqlite_pragmas)
+    return engine
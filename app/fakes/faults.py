@@ -0,0 +1,76 @@
+"""
+latency, error and quota injection shared by the offline stand-ins for the upstream APIs
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import Counter
+
+
+class FaultInjector:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        quota: float | None = None,
+        seed: int | None = None
+    ):
+        """
+        Args:
+            latency: the seconds each request takes
+            jitter: up to this many seconds are added to the latency at random
+            error_rate: the share of requests that fail with a server error
+            quota: the requests allowed per second, those over it are rate limited
+            seed: seeds the random faults so a run can be repeated
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota = quota
+        self.stats = Counter(requests=0, errors=0, rate_limited=0)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window = (0, 0)
+
+    def delay(self) -> float:
+        with self._lock:
+            return self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    def fault(self) -> tuple[str, float] | None:
+        """
+        Decide the fault of one request, without its latency
+
+        Returns:
+            tuple: ("rate_limited", retry after seconds) or ("error", 0), None if the request succeeds
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.stats["requests"] += 1
+            if self.quota is not None:
+                # Fixed one second windows, as upstream quotas are counted
+                second, used = self._window
+                if int(now) != second:
+                    second, used = int(now), 0
+                if used >= self.quota:
+                    self.stats["rate_limited"] += 1
+                    return "rate_limited", second + 1 - now
+                self._window = (second, used + 1)
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return "error", 0.0
+        return None
+
+    def inject(self) -> tuple[str, float] | None:
+        """Wait out the latency of a request and return its fault"""
+        delay = self.delay()
+        if delay:
+            time.sleep(delay)
+        return self.fault()
+
+    async def inject_async(self) -> tuple[str, float] | None:
+        delay = self.delay()
+        if delay:
+            await asyncio.sleep(delay)
+        return self.fault()
@@ -0,0 +1,552 @@
+"""
+in-process stand-in for the Gmail API, so GmailService and the polling pipeline run with no network
+
+FakeGmail replaces googleapiclient's `build` in app.message_service.gmail_service
+and serves users().getProfile/watch, messages().list/get, attachments().get,
+history().list and batch requests from per-token mailboxes. Mailboxes are
+filled from recorded fixtures (see record_mailbox) or the synthetic generator,
+and every request can be slowed down, failed or rate limited.
+"""
+import base64
+import itertools
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from app.fakes.faults import FaultInjector
+from app.message_service import gmail_service
+
+# Gmail rejects batches of more than 100 requests
+MAX_BATCH_SIZE = 100
+HISTORY_PAGE_SIZE = 100
+
+SYNTHETIC_RATES = {"task": 0.3, "meeting": 0.05, "fyi": 0.25, "newsletter": 0.2, "promotion": 0.1, "attachment": 0.1}
+
+SENDERS = ["manager@company.com", "finance@company.com", "teammate@company.com", "client@partner.com", "ops@company.com"]
+TASK_SUBJECTS = [
+    ("Website Update Request", "Hi, we need to update the pricing page on our website by {day}. Please include the new enterprise tier."),
+    ("Q4 Report Draft Review", "Please review the Q4 financial report draft and send your feedback by {day}."),
+    ("Client Presentation", "Can you prepare the client presentation slides and send them for internal review by {day}?"),
+    ("Contract Renewal", "Could you check the renewal terms of the hosting contract and confirm with legal before {date}?"),
+    ("Onboarding Checklist", "Please set up accounts for the two new hires starting on {date}."),
+]
+MEETING_ATTENDEES = ["Alice", "Bob", "Priya", "Chen", "Maria"]
+MEETING_ACTIONS = ["send the revised deck", "book the venue", "update the roadmap", "draft the budget", "follow up with the vendor"]
+FYI_SUBJECTS = [
+    ("Project Status Update", "Here's the latest status update on the project. We're on track for the deadline."),
+    ("Team Lunch Photos", "Thanks everyone for coming to lunch yesterday, the photos are in the shared drive."),
+    ("Office Closure", "Just a reminder that the office is closed on the public holiday."),
+]
+NEWSLETTER_SUBJECTS = [
+    ("This Week in Engineering", "The top stories from the engineering blog this week, read them online."),
+    ("Your Monthly Digest", "Here is what happened in your workspace this month."),
+]
+PROMOTION_SUBJECTS = [
+    ("Holiday Sale Announcement", "Our holiday sale is live! 25% off all products until December 31st."),
+    ("Last Chance: 50% Off", "Upgrade your plan today and save 50% on your first year."),
+]
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
+
+
+def http_error(status: int, reason: str, retry_after: float | None = None) -> HttpError:
+    """An HttpError like the ones googleapiclient raises, with a Retry-After header when given"""
+    headers = {"status": status}
+    if retry_after is not None:
+        headers["retry-after"] = f"{retry_after:.3f}"
+    content = json.dumps({"error": {"code": status, "message": reason, "errors": [{"reason": reason}]}}).encode()
+    return HttpError(httplib2.Response(headers), content)
+
+
+def fault_error(fault: tuple[str, float]) -> HttpError:
+    kind, retry_after = fault
+    if kind == "rate_limited":
+        return http_error(429, "rateLimitExceeded", retry_after)
+    return http_error(500, "backendError")
+
+
+def parse_fields(fields: str) -> dict:
+    """
+    Parse a partial response field mask such as 'id,payload(mimeType,headers),history/messagesAdded/message/id'
+    into a tree of the fields kept, where None keeps a field whole
+    """
+    tree = {}
+    depth, start = 0, 0
+    for i, char in enumerate(fields + ","):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            item = fields[start:i].strip()
+            start = i + 1
+            if not item:
+                continue
+            path, _, sub = item.partition("(")
+            keys = path.split("/")
+            node = tree
+            for key in keys[:-1]:
+                if node.get(key, {}) is None:
+                    # A parent is already kept whole
+                    node = None
+                    break
+                node = node.setdefault(key, {})
+            if node is None:
+                continue
+            leaf = parse_fields(sub[:-1]) if sub else None
+            existing = node.get(keys[-1], {})
+            node[keys[-1]] = None if leaf is None or existing is None else {**existing, **leaf}
+    return tree
+
+
+def apply_fields(resource, tree: dict | None):
+    """Keep only the fields in a parsed field mask, as Gmail does for partial responses"""
+    if tree is None:
+        return resource
+    if isinstance(resource, list):
+        return [apply_fields(item, tree) for item in resource]
+    if not isinstance(resource, dict):
+        return resource
+    return {key: apply_fields(resource[key], sub) for key, sub in tree.items() if key in resource}
+
+
+class Mailbox:
+    def __init__(self, email_address: str, history_id: int = 1000):
+        """
+        The messages, attachment data and history of one Gmail account
+
+        Args:
+            email_address: returned by getProfile
+            history_id: the history id of the empty mailbox, each delivery adds one
+        """
+        self.email_address = email_address
+        self.messages = {}
+        self.attachments = {}
+        # (history id, message id) of every delivery since oldest_history_id
+        self.history = []
+        self.history_id = history_id
+        self.oldest_history_id = history_id
+        self._lock = threading.Lock()
+
+    def deliver(self, message: dict, attachments: dict | None = None) -> str:
+        """
+        Add a Gmail message resource, in format=full, and record it in the history
+
+        Args:
+            message: the resource, its historyId and internalDate are filled in
+            attachments: the base64url data of each of its attachments, keyed by attachment id
+
+        Returns:
+            str: the message id
+        """
+        with self._lock:
+            self.history_id += 1
+            message = dict(message, historyId=str(self.history_id))
+            message.setdefault("threadId", message["id"])
+            message.setdefault("internalDate", str(int(time.time() * 1000)))
+            self.messages[message["id"]] = message
+            self.attachments.update(attachments or {})
+            self.history.append((self.history_id, message["id"]))
+        return message["id"]
+
+    def expire_history(self):
+        """Forget the history, so a sync from any earlier cursor gets the 404 of an expired history id"""
+        with self._lock:
+            self.history = []
+            self.oldest_history_id = self.history_id
+
+    def mark_read(self, message_ids: list[str]):
+        with self._lock:
+            for message_id in message_ids:
+                message = self.messages[message_id]
+                message["labelIds"] = [label for label in message["labelIds"] if label != "UNREAD"]
+
+    def to_fixture(self) -> dict:
+        with self._lock:
+            return {
+                "email_address": self.email_address,
+                "messages": sorted(self.messages.values(), key=lambda message: int(message["internalDate"])),
+                "attachments": dict(self.attachments),
+            }
+
+
+def matches_query(message: dict, query: str) -> bool:
+    """
+    Match the search operators GmailService uses: is:unread, in:inbox,
+    -category:<name> and newer_than:<days>d. Other terms are ignored.
+    """
+    labels = set(message.get("labelIds", []))
+    for term in query.split():
+        negate = term.startswith("-")
+        name, _, value = term.lstrip("-").partition(":")
+        if name == "is":
+            found = value.upper() in labels
+        elif name == "in":
+            found = value.upper() in labels
+        elif name == "category":
+            found = f"CATEGORY_{value.upper()}" in labels
+        elif name == "newer_than" and value.endswith("d"):
+            found = int(message.get("internalDate", 0)) >= (time.time() - int(value[:-1]) * 86400) * 1000
+        else:
+            continue
+        if found == negate:
+            return False
+    return True
+
+
+class FakeRequest:
+    def __init__(self, gmail: "FakeGmail", respond):
+        """A request built by the fake service, run by execute() or as part of a batch"""
+        self.gmail = gmail
+        self.respond = respond
+
+    def execute(self, num_retries: int = 0):
+        fault = self.gmail.faults.inject()
+        self.gmail.count("requests")
+        if fault:
+            raise fault_error(fault)
+        return self.respond()
+
+
+class FakeBatch:
+    def __init__(self, gmail: "FakeGmail", callback=None):
+        """
+        A batch HTTP request: one round trip, but every request in it is
+        counted against the quota and can fail on its own
+        """
+        self.gmail = gmail
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request: FakeRequest, callback=None, request_id: str | None = None):
+        if len(self.requests) >= MAX_BATCH_SIZE:
+            raise ValueError(f"Exceeded the maximum of {MAX_BATCH_SIZE} calls in a single batch")
+        self.requests.append((request_id or str(len(self.requests)), request, callback or self.callback))
+
+    def execute(self):
+        delay = self.gmail.faults.delay()
+        if delay:
+            time.sleep(delay)
+        self.gmail.count("batches")
+        for request_id, request, callback in self.requests:
+            self.gmail.count("requests")
+            fault = self.gmail.faults.fault()
+            if fault:
+                callback(request_id, None, fault_error(fault))
+                continue
+            try:
+                response = request.respond()
+            except HttpError as e:
+                callback(request_id, None, e)
+                continue
+            callback(request_id, response, None)
+
+
+class _Resource:
+    """users(), messages(), attachments() and history() of the fake service"""
+    def __init__(self, gmail: "FakeGmail", mailbox: Mailbox):
+        self.gmail = gmail
+        self.mailbox = mailbox
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return _Messages(self.gmail, self.mailbox)
+
+    def history(self):
+        return _History(self.gmail, self.mailbox)
+
+    def getProfile(self, userId: str = "me"):
+        return FakeRequest(self.gmail, lambda: {
+            "emailAddress": self.mailbox.email_address,
+            "messagesTotal": len(self.mailbox.messages),
+            "historyId": str(self.mailbox.history_id),
+        })
+
+    def watch(self, userId: str = "me", body: dict | None = None):
+        return FakeRequest(self.gmail, lambda: {
+            "historyId": str(self.mailbox.history_id),
+            "expiration": str(int((time.time() + 7 * 86400) * 1000)),
+        })
+
+
+class _Messages(_Resource):
+    def get(self, userId: str = "me", id: str = "", format: str = "full", metadataHeaders: list[str] | None = None, fields: str | None = None):
+        def respond():
+            message = self.mailbox.messages.get(id)
+            if message is None:
+                raise http_error(404, "notFound")
+            if format in ("metadata", "minimal"):
+                payload = message["payload"]
+                headers = [] if format == "minimal" else [
+                    header for header in payload.get("headers", [])
+                    if metadataHeaders is None or header["name"] in metadataHeaders
+                ]
+                message = dict(message, payload={"mimeType": payload.get("mimeType"), "headers": headers})
+            return apply_fields(message, parse_fields(fields) if fields else None)
+        return FakeRequest(self.gmail, respond)
+
+    def list(self, userId: str = "me", maxResults: int = 100, q: str = "", fields: str | None = None, pageToken: str | None = None, **kwargs):
+        def respond():
+            with self.mailbox._lock:
+                found = [message for message in self.mailbox.messages.values() if matches_query(message, q)]
+            # Newest first, as Gmail lists them
+            found.sort(key=lambda message: int(message["internalDate"]), reverse=True)
+            offset = int(pageToken or 0)
+            page = found[offset:offset + maxResults]
+            response = {"messages": [{"id": message["id"], "threadId": message["threadId"]} for message in page], "resultSizeEstimate": len(found)}
+            if offset + maxResults < len(found):
+                response["nextPageToken"] = str(offset + maxResults)
+            return apply_fields(response, parse_fields(fields) if fields else None)
+        return FakeRequest(self.gmail, respond)
+
+    def attachments(self):
+        return _Attachments(self.gmail, self.mailbox)
+
+
+class _Attachments(_Resource):
+    def get(self, userId: str = "me", messageId: str = "", id: str = ""):
+        def respond():
+            data = self.mailbox.attachments.get(id)
+            if messageId not in self.mailbox.messages or data is None:
+                raise http_error(404, "notFound")
+            return {"attachmentId": id, "size": len(data) * 3 // 4, "data": data}
+        return FakeRequest(self.gmail, respond)
+
+
+class _History(_Resource):
+    def list(self, userId: str = "me", startHistoryId: str = "", historyTypes: list[str] | None = None, labelId: str | None = None,
+             fields: str | None = None, pageToken: str | None = None):
+        def respond():
+            start = int(startHistoryId)
+            with self.mailbox._lock:
+                if start < self.mailbox.oldest_history_id:
+                    raise http_error(404, "notFound")
+                records = [
+                    (history_id, self.mailbox.messages[message_id])
+                    for history_id, message_id in self.mailbox.history
+                    if history_id > start
+                ]
+                current = self.mailbox.history_id
+            records = [(history_id, message) for history_id, message in records if labelId is None or labelId in message["labelIds"]]
+            offset = int(pageToken or 0)
+            page = records[offset:offset + HISTORY_PAGE_SIZE]
+            response = {
+                "history": [
+                    {"id": str(history_id), "messagesAdded": [{"message": {"id": message["id"], "threadId": message["threadId"], "labelIds": message["labelIds"]}}]}
+                    for history_id, message in page
+                ],
+                "historyId": str(current),
+            }
+            if offset + HISTORY_PAGE_SIZE < len(records):
+                response["nextPageToken"] = str(offset + HISTORY_PAGE_SIZE)
+            return apply_fields(response, parse_fields(fields) if fields else None)
+        return FakeRequest(self.gmail, respond)
+
+
+class FakeService(_Resource):
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self.gmail, callback)
+
+
+def _header(name: str, value: str) -> dict:
+    return {"name": name, "value": value}
+
+
+def synthetic_message(rng: random.Random, message_id: str, kind: str, recipient: str = "me@company.com") -> tuple[dict, dict]:
+    """
+    Generate a Gmail message resource of one kind of mail
+
+    Args:
+        rng: the random source, seeded for repeatable mailboxes
+        message_id: the id of the message
+        kind: one of "task", "meeting", "fyi", "newsletter", "promotion" or "attachment"
+
+    Returns:
+        tuple: the message resource in format=full and its attachment data keyed by attachment id
+    """
+    labels = ["INBOX", "UNREAD", "CATEGORY_PERSONAL"]
+    sender = rng.choice(SENDERS)
+    extra_headers = []
+    day, due = rng.choice(WEEKDAYS), f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+    if kind in ("task", "attachment"):
+        subject, body = rng.choice(TASK_SUBJECTS)
+    elif kind == "meeting":
+        attendees = rng.sample(MEETING_ATTENDEES, 3)
+        actions = rng.sample(MEETING_ACTIONS, 3)
+        subject = "Team Meeting Notes"
+        body = "Thanks for joining today. Action items: " + "; ".join(f"{name} to {action}" for name, action in zip(attendees, actions))
+    elif kind == "fyi":
+        subject, body = rng.choice(FYI_SUBJECTS)
+    elif kind == "newsletter":
+        subject, body = rng.choice(NEWSLETTER_SUBJECTS)
+        sender = "newsletter@updates.example.com"
+        labels = ["INBOX", "UNREAD", "CATEGORY_UPDATES"]
+        extra_headers = [_header("List-Unsubscribe", "<mailto:unsubscribe@updates.example.com>"), _header("Precedence", "bulk")]
+    elif kind == "promotion":
+        subject, body = rng.choice(PROMOTION_SUBJECTS)
+        sender = "offers@shop.example.com"
+        labels = ["INBOX", "UNREAD", "CATEGORY_PROMOTIONS"]
+        extra_headers = [_header("List-Unsubscribe", "<mailto:unsubscribe@shop.example.com>")]
+    else:
+        raise ValueError(f"Unknown kind of synthetic message: {kind}")
+    body = body.format(day=day, date=due)
+
+    headers = [
+        _header("From", sender),
+        _header("To", recipient),
+        _header("Subject", subject),
+        _header("Date", time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime())),
+    ] + extra_headers
+    text = {"partId": "0", "filename": "", "mimeType": "text/plain", "headers": [], "body": {"size": len(body), "data": _encode(body)}}
+    attachments = {}
+    if kind == "attachment":
+        attachment_id = f"{message_id}-attachment"
+        data = _encode(f"%PDF-1.4 synthetic attachment of {message_id}\n" + "x" * rng.randint(1000, 20000))
+        attachments[attachment_id] = data
+        parts = [text, {"partId": "1", "filename": f"{subject.lower().replace(' ', '_')}.pdf", "mimeType": "application/pdf",
+                        "headers": [], "body": {"attachmentId": attachment_id, "size": len(data) * 3 // 4}}]
+        payload = {"mimeType": "multipart/mixed", "headers": headers, "body": {"size": 0}, "parts": parts}
+    else:
+        html = dict(text, partId="1", mimeType="text/html", body={"size": len(body) + 13, "data": _encode(f"<p>{body}</p>")})
+        payload = {"mimeType": "multipart/alternative", "headers": headers, "body": {"size": 0}, "parts": [text, html]}
+    message = {"id": message_id, "threadId": message_id, "labelIds": labels, "snippet": body[:200], "sizeEstimate": len(body), "payload": payload}
+    return message, attachments
+
+
+def _encode(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+
+class FakeGmail:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        quota: float | None = None,
+        seed: int | None = None
+    ):
+        """
+        Args:
+            latency: the seconds each request, or batch round trip, takes
+            jitter: up to this many seconds are added to the latency at random
+            error_rate: the share of requests that fail with a 500
+            quota: the requests allowed per second across all mailboxes, those over it get a 429
+            seed: seeds the faults and the synthetic mail so a run can be repeated
+        """
+        self.faults = FaultInjector(latency, jitter, error_rate, quota, seed)
+        self.mailboxes = {}
+        self.stats = {"requests": 0, "batches": 0, "builds": 0}
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def mailbox(self, token: str) -> Mailbox:
+        """The mailbox of an access token, created empty on first use"""
+        with self._lock:
+            if token not in self.mailboxes:
+                self.mailboxes[token] = Mailbox(f"user{len(self.mailboxes) + 1}@company.com")
+            return self.mailboxes[token]
+
+    def populate(self, token: str, count: int, rates: dict | None = None) -> list[str]:
+        """
+        Deliver `count` synthetic messages to a mailbox
+
+        Args:
+            token: the access token of the mailbox
+            count: the number of messages
+            rates: the share of each kind of mail, SYNTHETIC_RATES by default
+
+        Returns:
+            list: the ids of the messages delivered
+        """
+        rates = rates or SYNTHETIC_RATES
+        mailbox = self.mailbox(token)
+        delivered = []
+        for _ in range(count):
+            with self._lock:
+                kind = self._random.choices(list(rates), weights=list(rates.values()))[0]
+                message, attachments = synthetic_message(self._random, f"{next(self._ids):016x}", kind, mailbox.email_address)
+            delivered.append(mailbox.deliver(message, attachments))
+        return delivered
+
+    def load_fixture(self, token: str, path: str) -> Mailbox:
+        """Deliver the messages of a fixture written by record_mailbox, oldest first"""
+        with open(path) as f:
+            fixture = json.load(f)
+        mailbox = self.mailbox(token)
+        mailbox.email_address = fixture.get("email_address", mailbox.email_address)
+        for message in fixture["messages"]:
+            mailbox.deliver(message)
+        mailbox.attachments.update(fixture.get("attachments", {}))
+        return mailbox
+
+    def build(self, service_name: str, version: str, http=None, **kwargs) -> FakeService:
+        """Stands in for googleapiclient.discovery.build, picking the mailbox by the token of the credentials"""
+        self.count("builds")
+        credentials = getattr(http, "credentials", None)
+        return FakeService(self, self.mailbox(getattr(credentials, "token", None) or "anonymous"))
+
+    @contextmanager
+    def install(self):
+        """
+        Route every GmailService built inside the block to this fake. Clients
+        already in the gmail_clients cache keep talking to whatever built them.
+        """
+        original = gmail_service.build
+        gmail_service.build = self.build
+        try:
+            yield self
+        finally:
+            gmail_service.build = original
+
+
+def record_mailbox(service: "gmail_service.GmailService", path: str, limit: int = 100, query: str = "in:inbox") -> int:
+    """
+    Record up to `limit` messages of a real mailbox, with their attachments, into a fixture for FakeGmail.load_fixture
+
+    Args:
+        service: an authenticated GmailService
+        path: the fixture file written
+        limit: the most messages recorded
+        query: the Gmail search selecting the messages
+
+    Returns:
+        int: the number of messages recorded
+    """
+    users = service.service.users()
+    listed = service._execute(users.messages().list(userId="me", maxResults=limit, q=query, fields="messages/id"), kind="list")
+    message_ids = [message["id"] for message in listed.get("messages", [])]
+    messages = service._execute_batch({
+        message_id: users.messages().get(userId="me", id=message_id, format="full")
+        for message_id in message_ids
+    }, kind="record")
+    parts = {
+        part["body"]["attachmentId"]: (message_id, part)
+        for message_id, message in messages.items()
+        for part in message["payload"].get("parts", [])
+        if part.get("filename") and part.get("body", {}).get("attachmentId")
+    }
+    attachments = service._execute_batch({
+        attachment_id: users.messages().attachments().get(userId="me", messageId=message_id, id=attachment_id)
+        for attachment_id, (message_id, part) in parts.items()
+    }, kind="record")
+    profile = service._execute(users.getProfile(userId="me"), kind="profile")
+    fixture = {
+        "email_address": profile.get("emailAddress"),
+        "messages": sorted(messages.values(), key=lambda message: int(message.get("internalDate", 0))),
+        "attachments": {attachment_id: response["data"] for attachment_id, response in attachments.items()},
+    }
+    with open(path, "w") as f:
+        json.dump(fixture, f)
+    return len(messages)
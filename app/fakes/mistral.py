@@ -0,0 +1,244 @@
+"""
+in-process stand-in for the Mistral chat API, so TaskIdentifier runs with no network
+
+FakeMistral replaces the Mistral client in app.ai_agents.task_identifier. It
+replays completions recorded from the real API by RecordingMistral, and
+answers any other request with a keyword heuristic in the response format
+asked for: triage, structured extraction or the free text of the text mode.
+"""
+import json
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+import httpx
+from mistralai.models import SDKError
+
+from app.ai_agents import task_identifier
+from app.ai_agents.prompt import estimate_tokens
+from app.ai_agents.response_cache import ResponseCache
+from app.fakes.faults import FaultInjector
+
+CHAT_URL = "https://api.mistral.ai/v1/chat/completions"
+
+TASK_PATTERN = re.compile(
+    r"\b(please|can you|could you|need to|we need|action items?|asap|review|prepare|confirm|set up)\b",
+    re.IGNORECASE
+)
+NO_TASK_PATTERN = re.compile(r"\b(unsubscribe|sale|% off|digest|newsletter)\b|\d+% off", re.IGNORECASE)
+WEEKDAY_PATTERN = re.compile(r"\bby (monday|tuesday|wednesday|thursday|friday|saturday|sunday)\b", re.IGNORECASE)
+DATE_PATTERN = re.compile(r"\b(\d{4}-\d{2}-\d{2})\b")
+MESSAGE_ID_PATTERN = re.compile(r"^Message id: (\S+)$", re.MULTILINE)
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+def sdk_error(fault: tuple[str, float]) -> SDKError:
+    """An SDKError like the ones the mistralai client raises, with a Retry-After header on a 429"""
+    kind, retry_after = fault
+    request = httpx.Request("POST", CHAT_URL)
+    if kind == "rate_limited":
+        response = httpx.Response(429, headers={"retry-after": f"{retry_after:.3f}"}, request=request)
+        return SDKError("Requests rate limit exceeded", response)
+    return SDKError("Internal server error", httpx.Response(500, request=request))
+
+
+def split_messages(prompt: str) -> list[tuple[str, str]]:
+    """
+    Split the user prompt of a request into (message id, rendered message), a
+    prompt without "Message id:" lines is one message with id None
+    """
+    parts = MESSAGE_ID_PATTERN.split(prompt)
+    if len(parts) == 1:
+        return [(None, prompt)]
+    return [(parts[i], parts[i + 1].strip()) for i in range(1, len(parts), 2)]
+
+
+def field(rendered: str, name: str) -> str:
+    # The body runs over several lines, up to the attachment list if there is one
+    if name == "Body":
+        match = re.search(r"^Body: (.*?)(?:\nAttachments: |\Z)", rendered, re.MULTILINE | re.DOTALL)
+    else:
+        match = re.search(rf"^{name}: (.*)$", rendered, re.MULTILINE)
+    return match.group(1).strip() if match else ""
+
+
+def due_date(text: str, today: date) -> str | None:
+    match = DATE_PATTERN.search(text)
+    if match:
+        return match.group(1)
+    match = WEEKDAY_PATTERN.search(text)
+    if match:
+        days = (WEEKDAYS.index(match.group(1).lower()) - today.weekday()) % 7 or 7
+        return (today + timedelta(days=days)).isoformat()
+    return None
+
+
+def find_tasks(rendered: str, today: date | None = None) -> list[dict]:
+    """
+    The tasks a keyword heuristic finds in a rendered message: one per action item
+    of meeting notes, otherwise one titled after the subject if the body asks for something
+    """
+    today = today or date.today()
+    subject = re.sub(r"^((re|fwd?):\s*)+|\s*\(part \d+ of \d+\)$", "", field(rendered, "Subject"), flags=re.IGNORECASE)
+    body = field(rendered, "Body")
+    if NO_TASK_PATTERN.search(subject + " " + body) or not TASK_PATTERN.search(body):
+        return []
+    items = re.split(r"action items?:", body, flags=re.IGNORECASE)
+    if len(items) > 1:
+        return [
+            {"title": item.strip().rstrip(".")[:60].capitalize(), "due_date": due_date(item, today), "description": item.strip()}
+            for item in items[1].split(";") if item.strip()
+        ]
+    return [{"title": subject or body[:60], "due_date": due_date(body, today), "description": body}]
+
+
+def completion(model: str, content: str, messages: list[dict]) -> SimpleNamespace:
+    """A chat completion shaped like the mistralai ChatCompletionResponse, with its usage"""
+    prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+    completion_tokens = estimate_tokens(content)
+    return SimpleNamespace(
+        model=model,
+        choices=[SimpleNamespace(index=0, finish_reason="stop", message=SimpleNamespace(role="assistant", content=content))],
+        usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens),
+    )
+
+
+def request_key(model: str, messages: list[dict]) -> str:
+    """The key a recorded completion is replayed by: the model and every message of the request"""
+    return ResponseCache.make_key(model, *(message["content"] for message in messages))
+
+
+class FakeMistral:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        quota: float | None = None,
+        seed: int | None = None,
+        recording: str | None = None
+    ):
+        """
+        Args:
+            latency: the seconds each completion takes
+            jitter: up to this many seconds are added to the latency at random
+            error_rate: the share of completions that fail with a 500
+            quota: the completions allowed per second, those over it get a 429
+            seed: seeds the faults so a run can be repeated
+            recording: a file saved by RecordingMistral, replayed ahead of the heuristic
+        """
+        self.faults = FaultInjector(latency, jitter, error_rate, quota, seed)
+        self.responses = {}
+        self.stats = Counter(completions=0, replayed=0)
+        self._lock = threading.Lock()
+        if recording:
+            self.load(recording)
+
+    @property
+    def chat(self):
+        return self
+
+    def load(self, path: str):
+        with open(path) as f:
+            self.responses.update(json.load(f))
+
+    def complete(self, model: str, messages: list[dict], response_format: dict | None = None, **kwargs):
+        fault = self.faults.inject()
+        if fault:
+            raise sdk_error(fault)
+        return self._respond(model, messages, response_format)
+
+    async def complete_async(self, model: str, messages: list[dict], response_format: dict | None = None, **kwargs):
+        fault = await self.faults.inject_async()
+        if fault:
+            raise sdk_error(fault)
+        return self._respond(model, messages, response_format)
+
+    def _respond(self, model: str, messages: list[dict], response_format: dict | None):
+        schema = (response_format or {}).get("json_schema", {}).get("name", "text")
+        content = self.responses.get(request_key(model, messages))
+        with self._lock:
+            self.stats["completions"] += 1
+            self.stats[f"{schema}_completions"] += 1
+            self.stats["replayed"] += content is not None
+        if content is None:
+            content = self.answer(schema, messages[-1]["content"])
+        return completion(model, content, messages)
+
+    @staticmethod
+    def answer(schema: str, prompt: str) -> str:
+        """
+        Answer a prompt in the response format of a json schema name, or in the
+        free text mode when the name is "text"
+        """
+        found = [(message_id, find_tasks(rendered)) for message_id, rendered in split_messages(prompt)]
+        if schema == "BatchTaskTriage":
+            return json.dumps({"results": [
+                {"id": message_id, "has_task": bool(tasks), "confidence": 0.8 if tasks else 0.95}
+                for message_id, tasks in found
+            ]})
+        if schema == "BatchTaskExtraction":
+            return json.dumps({"results": [{"id": message_id, "tasks": tasks} for message_id, tasks in found]})
+        if schema == "TaskExtraction":
+            return json.dumps({"tasks": found[0][1]})
+        # The text mode asks for one task json per message, or None
+        if found[0][0] is None:
+            return json.dumps(found[0][1][0]) if found[0][1] else "None"
+        return json.dumps({message_id: tasks[0] if tasks else None for message_id, tasks in found})
+
+    @contextmanager
+    def install(self):
+        """Use this fake as the Mistral client of every TaskIdentifier built inside the block"""
+        original = task_identifier.Mistral
+        task_identifier.Mistral = lambda **kwargs: self
+        try:
+            yield self
+        finally:
+            task_identifier.Mistral = original
+
+
+class RecordingMistral:
+    def __init__(self, client):
+        """
+        Wraps a real Mistral client and records every completion, so a run
+        against the real API can be replayed by FakeMistral(recording=...)
+        """
+        self.client = client
+        self.responses = {}
+        self._lock = threading.Lock()
+
+    @property
+    def chat(self):
+        return self
+
+    def complete(self, model: str, messages: list[dict], **kwargs):
+        response = self.client.chat.complete(model=model, messages=messages, **kwargs)
+        self._record(model, messages, response)
+        return response
+
+    async def complete_async(self, model: str, messages: list[dict], **kwargs):
+        response = await self.client.chat.complete_async(model=model, messages=messages, **kwargs)
+        self._record(model, messages, response)
+        return response
+
+    def _record(self, model: str, messages: list[dict], response):
+        with self._lock:
+            self.responses[request_key(model, messages)] = response.choices[0].message.content
+
+    def save(self, path: str):
+        with self._lock:
+            responses = dict(self.responses)
+        with open(path, "w") as f:
+            json.dump(responses, f, indent=2)
+
+    @contextmanager
+    def install(self):
+        original = task_identifier.Mistral
+        task_identifier.Mistral = lambda **kwargs: self
+        try:
+            yield self
+        finally:
+            task_identifier.Mistral = original
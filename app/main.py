@@ -30,6 +30,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # The task list's pagination cursor, browsers hide other response headers from scripts
+    expose_headers=["X-Next-Cursor"],
 )
 
 
@@ -37,7 +39,7 @@ if __name__ == "__main__":
     # Create database
     create_database()
     
-    # Start the polling thread
+    # Start the polling thread, or with POLLING_MODE=worker run `python -m app.worker` instead
     # polling_thread = start_polling_thread()
     
     # Start the FastAPI app
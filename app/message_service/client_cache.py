@@ -0,0 +1,93 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from app.config import settings
+from app.message_service.gmail_service import GmailService
+from app.models import GmailCredentials
+from app.rate_limiter import RateLimitExceeded
+
+logger = logging.getLogger(__name__)
+
+
+class _CachedClient:
+    def __init__(self, fingerprint: tuple, service: GmailService):
+        self.fingerprint = fingerprint
+        self.service = service
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+
+class GmailClientCache:
+    def __init__(self, max_size: int = 1000, idle_seconds: float = 900):
+        """
+        Keeps a built GmailService, and with it an open HTTP connection, per user across polling cycles.
+
+        Args:
+            max_size: the most clients kept, least recently used are evicted first
+            idle_seconds: clients unused for longer than this are evicted
+        """
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _fingerprint(credentials: GmailCredentials) -> tuple:
+        # Changes whenever the token is refreshed or the user re-authenticates
+        return (credentials.encrypted_token, credentials.encrypted_refresh_token)
+
+    def _get(self, credentials: GmailCredentials) -> _CachedClient:
+        fingerprint = self._fingerprint(credentials)
+        with self._lock:
+            self._evict_idle()
+            client = self._clients.get(credentials.user_id)
+            if client is None or client.fingerprint != fingerprint:
+                logger.info(f"Building Gmail client for user {credentials.user_id}")
+                client = _CachedClient(fingerprint, GmailService(
+                    credentials.get_credentials(),
+                    user_key=str(credentials.user_id),
+                    verify=False
+                ))
+                self._clients[credentials.user_id] = client
+            self._clients.move_to_end(credentials.user_id)
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+            return client
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        for user_id in [user_id for user_id, client in self._clients.items() if now - client.last_used > self.idle_seconds]:
+            del self._clients[user_id]
+
+    @contextmanager
+    def lease(self, credentials: GmailCredentials):
+        """
+        Use the user's cached GmailService. HTTP connections are not thread
+        safe, so a client is only used by one worker at a time. A client that
+        raises is evicted and rebuilt on next use.
+        """
+        client = self._get(credentials)
+        with client.lock:
+            try:
+                yield client.service
+            except RateLimitExceeded:
+                raise
+            except Exception:
+                self.evict(credentials.user_id)
+                raise
+            finally:
+                client.last_used = time.monotonic()
+
+    def evict(self, user_id: int):
+        with self._lock:
+            self._clients.pop(user_id, None)
+
+
+# Shared by every polling worker
+gmail_clients = GmailClientCache(
+    max_size=settings.GMAIL_CLIENT_CACHE_SIZE,
+    idle_seconds=settings.GMAIL_CLIENT_IDLE_SECONDS
+)
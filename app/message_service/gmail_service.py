@@ -1,19 +1,92 @@
+import json
+import threading
+from collections import Counter
+from app.config import settings
 from app.message_service.base import BaseMessageService
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build 
+import google_auth_httplib2
+import httplib2
 from app.message_service.models import Message, Attachment
 from googleapiclient.errors import HttpError
+from app.rate_limiter import RateLimitExceeded, gmail_limiter, call_with_backoff, is_rate_limited, get_retry_after, backoff_delay
+
+# Partial responses: only the fields parse_message reads are sent back
+HISTORY_FIELDS = 'history/messagesAdded/message/id,historyId,nextPageToken'
+METADATA_FIELDS = 'id,labelIds,snippet,payload(mimeType,headers)'
+STRUCTURE_FIELDS = 'id,payload(parts(partId,filename,mimeType,body(attachmentId,size)))'
+
+
+class FetchStats:
+    """
+    Counts Gmail requests and response bytes, so the effect of partial responses is visible
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def record(self, kind: str, response=None):
+        """
+        Count one request of `kind` and the size of its response, estimated from its JSON
+        """
+        size = len(json.dumps(response, default=str)) if response is not None else 0
+        with self._lock:
+            self._counts["requests"] += 1
+            self._counts[f"{kind}_requests"] += 1
+            self._counts["response_bytes"] += size
+            self._counts[f"{kind}_bytes"] += size
+
+    def add(self, name: str, count: int = 1):
+        with self._lock:
+            self._counts[name] += count
+
+    def take(self) -> dict:
+        """Return the counts since the previous call and reset them"""
+        with self._lock:
+            counts, self._counts = dict(self._counts), Counter()
+        return counts
+
+
+gmail_stats = FetchStats()
+
+
+def is_excluded(labels: list[str]) -> bool:
+    """True unless the labels are those of unread inbox mail outside the excluded categories"""
+    excluded = {f"CATEGORY_{category.upper()}" for category in settings.GMAIL_EXCLUDED_CATEGORIES}
+    return 'UNREAD' not in labels or 'INBOX' not in labels or bool(excluded.intersection(labels))
+
+
+def has_attachment_parts(payload: dict) -> bool:
+    """
+    Whether a message's MIME type allows attachments. Single part messages and
+    multipart/alternative (the same body as text and HTML) never have any.
+    """
+    mime_type = payload.get('mimeType', '')
+    return mime_type.startswith('multipart/') and mime_type != 'multipart/alternative'
 
 
 class GmailService(BaseMessageService):
-    def __init__(self, credentials: Credentials):
+    def __init__(
+        self,
+        credentials: Credentials,
+        batch_size: int | None = None,
+        user_key: str | None = None,
+        verify: bool = True
+    ):
         """
         Initialize Gmail service with OAuth2 credentials
         
         Args:
             credentials: Google OAuth2 Credentials object
+            batch_size: the number of requests sent per batch HTTP request,
+                GMAIL_BATCH_SIZE by default (Gmail allows at most 100)
+            user_key: identifies the mailbox for the per-user Gmail rate limit
+            verify: test the connection with a getProfile call when authenticating
         """
         self.credentials = credentials
+        self.batch_size = min(batch_size or settings.GMAIL_BATCH_SIZE, 100)
+        self.user_key = user_key
+        self.verify = verify
         self.service = None
         self.authenticate()
     
@@ -26,10 +99,20 @@ class GmailService(BaseMessageService):
         """
         try:
             print("Creating Gmail service...")
-            self.service = build('gmail', 'v1', credentials=self.credentials)
+            # The discovery document ships with googleapiclient, so building needs no
+            # network call. The service keeps its own HTTP connection for reuse.
+            self.service = build(
+                'gmail',
+                'v1',
+                http=google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=60)),
+                static_discovery=True,
+                cache_discovery=False
+            )
+            if not self.verify:
+                return True
             
             print("Testing connection with getProfile...")
-            profile = self.service.users().getProfile(userId='me').execute()
+            profile = self._execute(self.service.users().getProfile(userId='me'), kind='profile')
             print(f"Successfully connected to Gmail for: {profile.get('emailAddress')}")
             return True
             
@@ -59,63 +142,292 @@ class GmailService(BaseMessageService):
             return []
             
         try:
-            results = self.service.users().messages().list(
-                userId='me',
-                maxResults=limit,
-                q='is:unread'  # Only get unread messages
-            ).execute()
-            messages = []
-            # Only get messages from inbox by excluding social and promotions labels
-            for msg in results.get('messages', []):
-                message = self.service.users().messages().get(
-                    userId='me', 
-                    id=msg['id'],
-                ).execute()
-                
-                # Skip messages with social/promotions labels
-                labels = message.get('labelIds', [])
-                if 'UNREAD' in labels and 'INBOX' in labels and 'CATEGORY_SOCIAL' not in labels and 'CATEGORY_PROMOTIONS' not in labels:
-                    print(labels)
-                    headers = message['payload']['headers']
-                    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), '')
-                    sender = next((h['value'] for h in headers if h['name'] == 'From'), '')
-                    
-                    # Handle attachments
-                    attachments = []
-                    if 'parts' in message['payload']:
-                        parts = message['payload']['parts']
-                        for part in parts:
-                            if part.get('filename'):
-                                attachment_id = part['body'].get('attachmentId')
-                                if attachment_id:
-                                    attachment = self.service.users().messages().attachments().get(
-                                        userId='me',
-                                        messageId=msg['id'],
-                                        id=attachment_id
-                                    ).execute()
-                                    attachments.append({
-                                        'filename': part['filename'],
-                                        'mimeType': part['mimeType'],
-                                        'data': attachment['data']
-                                    })
-                    messages.append(Message(
-                        id=msg['id'],
-                        subject=subject,
-                        sender=sender,
-                        body=message['snippet'],
-                        attachments=[Attachment(**attachment) for attachment in attachments]
-                    ))
-                    
-                    #TODO: Mark message as read
-                    #Need to add scope to credentials to modify messages
-                    
-                    # self.service.users().messages().modify(
-                    #     userId='me',
-                    #     id=msg['id'],
-                    #     body={'removeLabelIds': ['UNREAD']}
-                    # ).execute()
-            return messages
+            return self._get_messages(self._list_unread(limit))
         
+        except RateLimitExceeded:
+            raise
         except Exception as e:
             print(f"Error retrieving messages: {str(e)}")
-            return []
\ No newline at end of file
+            return []
+
+    def sync_messages(self, history_id: str | None, limit: int = 50, newer_than_days: int | None = None) -> tuple[list[Message], str | None]:
+        """
+        Get the messages added to the inbox since `history_id`.
+
+        Uses the Gmail history API so only new messages are fetched. Without a
+        cursor, or when Gmail no longer has history that old, falls back to a
+        full resync of at most `limit` unread messages.
+
+        Args:
+            history_id: the cursor returned by the previous sync, or None
+            limit: the maximum number of messages fetched by a full resync
+            newer_than_days: if set, a full resync ignores mail older than this
+
+        Returns:
+            tuple: the new messages and the cursor to pass to the next sync.
+            On error no messages are returned and the cursor is not advanced.
+
+        Raises:
+            RateLimitExceeded: if Gmail is still rate limiting after every retry
+        """
+        message_ids, new_history_id = self.sync_message_ids(history_id, limit, newer_than_days)
+        try:
+            return self._get_messages(message_ids), new_history_id
+        except RateLimitExceeded:
+            raise
+        except Exception as e:
+            print(f"Error syncing messages: {str(e)}")
+            return [], history_id
+
+    def sync_message_ids(self, history_id: str | None, limit: int = 50, newer_than_days: int | None = None) -> tuple[list[str], str | None]:
+        """
+        Get the ids of the messages added to the inbox since `history_id`, see sync_messages
+
+        Returns:
+            tuple: the new message ids and the cursor to pass to the next sync.
+            On error no ids are returned and the cursor is not advanced.
+
+        Raises:
+            RateLimitExceeded: if Gmail is still rate limiting after every retry
+        """
+        if not self._ensure_authenticated():
+            return [], history_id
+
+        try:
+            if history_id is None:
+                return self._resync(limit, newer_than_days)
+
+            message_ids = []
+            request = {'userId': 'me', 'startHistoryId': history_id, 'historyTypes': ['messageAdded'], 'labelId': 'INBOX', 'fields': HISTORY_FIELDS}
+            while True:
+                results = self._execute(self.service.users().history().list(**request), kind='history')
+                for record in results.get('history', []):
+                    for added in record.get('messagesAdded', []):
+                        if added['message']['id'] not in message_ids:
+                            message_ids.append(added['message']['id'])
+                if not results.get('nextPageToken'):
+                    break
+                request['pageToken'] = results['nextPageToken']
+
+            return message_ids, results.get('historyId', history_id)
+
+        except RateLimitExceeded:
+            raise
+        except HttpError as e:
+            # Gmail only keeps history for about a week, older cursors return 404
+            if e.resp.status == 404:
+                print(f"History {history_id} has expired, resyncing")
+                try:
+                    return self._resync(limit, newer_than_days)
+                except RateLimitExceeded:
+                    raise
+                except Exception as e:
+                    print(f"Error resyncing messages: {str(e)}")
+                    return [], history_id
+            print(f"Gmail API HTTP error: {e.resp.status} - {e.content}")
+            return [], history_id
+        except Exception as e:
+            print(f"Error syncing messages: {str(e)}")
+            return [], history_id
+
+    def watch(self, topic: str) -> dict | None:
+        """
+        Ask Gmail to publish a notification to a Pub/Sub topic whenever the inbox changes.
+        A watch lasts seven days and is renewed by calling this again.
+
+        Args:
+            topic: the full Pub/Sub topic name, projects/<project>/topics/<topic>
+
+        Returns:
+            dict: the current 'historyId' and the 'expiration' in epoch milliseconds,
+            None if the service could not authenticate
+        """
+        if not self._ensure_authenticated():
+            return None
+        return self._execute(self.service.users().watch(
+            userId='me',
+            body={'topicName': topic, 'labelIds': ['INBOX'], 'labelFilterBehavior': 'include'}
+        ), kind='watch')
+
+    def _resync(self, limit: int, newer_than_days: int | None = None) -> tuple[list[str], str | None]:
+        """
+        Full resync of the unread inbox, returning the message ids and a fresh cursor.
+        The cursor is read before listing so nothing that arrives in between is missed.
+        """
+        profile = self._execute(self.service.users().getProfile(userId='me'), kind='profile')
+        return self._list_unread(limit, newer_than_days), profile.get('historyId')
+
+    def _list_unread(self, limit: int, newer_than_days: int | None = None) -> list[str]:
+        # Only get unread inbox messages, excluding categories such as social and promotions
+        query = ' '.join(['is:unread', 'in:inbox'] + [f'-category:{category}' for category in settings.GMAIL_EXCLUDED_CATEGORIES])
+        if newer_than_days:
+            query += f' newer_than:{newer_than_days}d'
+        results = self._execute(self.service.users().messages().list(
+            userId='me',
+            maxResults=limit,
+            q=query,
+            fields='messages/id'
+        ), kind='list')
+        return [msg['id'] for msg in results.get('messages', [])]
+
+    def _execute(self, request, kind: str = 'request') -> dict:
+        """
+        Execute a request within the Gmail rate limits, backing off when rate limited
+        """
+        response = call_with_backoff(request.execute, gmail_limiter, key=self.user_key)
+        gmail_stats.record(kind, response)
+        return response
+
+    def _new_batch(self, callback):
+        return self.service.new_batch_http_request(callback=callback)
+
+    def _execute_batch(self, requests: dict, kind: str = 'batch') -> dict:
+        """
+        Execute requests through the Gmail batch endpoint, `batch_size` at a time.
+
+        Args:
+            requests: the requests to execute keyed by a unique request id
+            kind: what the requests are, for gmail_stats
+
+        Returns:
+            dict: the responses keyed by request id. Messages deleted since they
+            were listed (404) are logged and left out.
+
+        Raises:
+            RateLimitExceeded: if some requests are still rate limited after every retry
+            HttpError: if some requests still fail after every retry, so the caller
+                never advances its cursor past messages it could not fetch
+        """
+        responses = {}
+        rate_limited = {}
+        failed = {}
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                if is_rate_limited(exception):
+                    rate_limited[request_id] = exception
+                    return
+                if isinstance(exception, HttpError) and exception.resp.status == 404:
+                    print(f"Batch request {request_id} not found, skipping")
+                    return
+                failed[request_id] = exception
+                return
+            responses[request_id] = response
+            gmail_stats.record(kind, response)
+
+        items = list(requests.items())
+        for attempt in range(settings.BACKOFF_RETRIES + 1):
+            for i in range(0, len(items), self.batch_size):
+                chunk = items[i:i + self.batch_size]
+                # Every request in a batch counts against the quota
+                call_with_backoff(
+                    lambda: self._send_batch(chunk, callback),
+                    gmail_limiter,
+                    key=self.user_key,
+                    tokens=len(chunk)
+                )
+            if not rate_limited and not failed:
+                return responses
+
+            # Requeue only the rate limited and failed items
+            delay = max((get_retry_after(e) or 0 for e in rate_limited.values()), default=0) or backoff_delay(attempt)
+            if attempt == settings.BACKOFF_RETRIES:
+                break
+            print(f"{len(rate_limited)} batch requests rate limited and {len(failed)} failed, retrying in {delay:.1f}s")
+            gmail_limiter.defer(delay, self.user_key)
+            items = [(request_id, requests[request_id]) for request_id in list(rate_limited) + list(failed)]
+            rate_limited.clear()
+            failed.clear()
+        if rate_limited:
+            raise RateLimitExceeded(gmail_limiter.name, delay)
+        raise next(iter(failed.values()))
+
+    def _send_batch(self, items: list, callback):
+        batch = self._new_batch(callback)
+        for request_id, request in items:
+            batch.add(request, request_id=request_id)
+        batch.execute()
+
+    def _get_messages(self, msg_ids: list[str]) -> list[Message]:
+        """
+        Batch fetch messages, keeping only unread inbox messages
+        """
+        return [self.parse_message(message) for message in self.fetch_messages(msg_ids)]
+
+    def fetch_messages(self, msg_ids: list[str]) -> list[dict]:
+        """
+        Batch fetch the Gmail resources of unread inbox messages, ready for parse_message.
+
+        Fetches metadata first: the labels, snippet and the headers in
+        GMAIL_METADATA_HEADERS. Only messages that pass the label filter and
+        can have attachments then have their MIME structure fetched, without
+        the body data. Attachment data is never downloaded, the structure
+        already has the name, type and id of each attachment.
+        """
+        details = self._execute_batch({
+            msg_id: self.service.users().messages().get(
+                userId='me',
+                id=msg_id,
+                format='metadata',
+                metadataHeaders=settings.GMAIL_METADATA_HEADERS,
+                fields=METADATA_FIELDS
+            )
+            for msg_id in msg_ids
+        }, kind='metadata')
+
+        # History sync can't filter by label, so filter here too
+        inbox = {}
+        for msg_id in msg_ids:
+            message = details.get(msg_id)
+            if message is None:
+                continue
+            if is_excluded(message.get('labelIds', [])):
+                gmail_stats.add('excluded')
+                continue
+            inbox[msg_id] = dict(message, id=msg_id)
+
+        structures = self._execute_batch({
+            msg_id: self.service.users().messages().get(userId='me', id=msg_id, format='full', fields=STRUCTURE_FIELDS)
+            for msg_id, message in inbox.items()
+            if has_attachment_parts(message['payload'])
+        }, kind='structure')
+        for msg_id, structure in structures.items():
+            inbox[msg_id]['payload'] = dict(inbox[msg_id]['payload'], parts=structure.get('payload', {}).get('parts', []))
+
+        #TODO: Mark message as read
+        #Need to add scope to credentials to modify messages
+
+        # self.service.users().messages().modify(
+        #     userId='me',
+        #     id=msg_id,
+        #     body={'removeLabelIds': ['UNREAD']}
+        # ).execute()
+
+        return list(inbox.values())
+
+    @staticmethod
+    def parse_message(message: dict) -> Message:
+        """
+        Build a Message from a Gmail message resource returned by fetch_messages
+        """
+        headers = message['payload']['headers']
+        subject = next((h['value'] for h in headers if h['name'] == 'Subject'), '')
+        sender = next((h['value'] for h in headers if h['name'] == 'From'), '')
+        attachments = [
+            Attachment(
+                filename=part['filename'],
+                mimeType=part['mimeType'],
+                attachmentId=part['body']['attachmentId'],
+                data=part['body'].get('data')
+            )
+            for part in message['payload'].get('parts', [])
+            if part.get('filename') and part['body'].get('attachmentId')
+        ]
+        return Message(
+            id=message['id'],
+            subject=subject,
+            sender=sender,
+            body=message.get('snippet', ''),
+            attachments=attachments,
+            headers={h['name']: h['value'] for h in headers}
+        )
@@ -3,7 +3,9 @@ from pydantic import BaseModel
 class Attachment(BaseModel):
     filename: str
     mimeType: str
-    data: str
+    # Only the name and type reach the prompt, the data can be fetched by attachmentId if ever needed
+    attachmentId: str | None = None
+    data: str | None = None
 
 class Message(BaseModel):
     id: str
@@ -11,13 +13,14 @@ class Message(BaseModel):
     sender: str
     body: str
     attachments: list[Attachment]
+    headers: dict[str, str] = {}
 
     def __str__(self):
         return f"""
         Sender: {self.sender}
         Subject: {self.subject}
         Body: {self.body}
-        Attachments: {self.attachments} 
+        Attachments: {[f"{attachment.filename} ({attachment.mimeType})" for attachment in self.attachments]}
         """
 
     def __repr__(self):
@@ -1,10 +1,13 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, create_engine
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Float, UniqueConstraint, Index
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
+from functools import lru_cache
 from sqlalchemy.orm import relationship
 from cryptography.fernet import Fernet
 from app.config import settings
+from app.database import create_db_engine, create_async_db_engine
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 
@@ -13,6 +16,10 @@ cipher = Fernet(settings.FERNET_KEY)
 def encrypt_token(token:str):
     return cipher.encrypt(token.encode()).decode()
 
+# Tokens are decrypted on every property access, so decryptions are cached by
+# ciphertext. A row whose token changes gets a new ciphertext and so misses the
+# cache, and the old entry ages out of the LRU.
+@lru_cache(maxsize=settings.TOKEN_CACHE_SIZE)
 def decrypt_token(encrypted_token:str):
     return cipher.decrypt(encrypted_token.encode()).decode()
 
@@ -26,9 +33,13 @@ def decrypt_password(encrypted_password:str):
 Base = declarative_base()
 
 # Define engine and SessionLocal at module level
-engine = create_engine("sqlite:///mail_tasks.db")
+engine = create_db_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine for the API routes, so queries do not block the event loop
+async_engine = create_async_db_engine()
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 class User(Base):
     __tablename__ = "users"
 
@@ -63,6 +74,8 @@ class GmailCredentials(Base):
     encrypted_token = Column(String, nullable=False)
     encrypted_refresh_token = Column(String, nullable=True)
     token_expiry = Column(DateTime, nullable=True) 
+    history_id = Column(String, nullable=True)  # Gmail history cursor of the last sync
+    watch_expiration = Column(DateTime, nullable=True)  # when the Gmail push watch must be renewed by
     
     def __repr__(self):
         return f"<GmailCredentials(id={self.id}, token_expiry={self.token_expiry})>"
@@ -118,13 +131,20 @@ class GmailCredentials(Base):
 
 class Task(Base):
     __tablename__ = "tasks"
+    # Match the filters and sort orders of GET /tasks, ending in id so every
+    # keyset page is a range scan of one index
+    __table_args__ = (
+        Index("ix_tasks_user_created", "user_id", "created_at", "id"),
+        Index("ix_tasks_user_due", "user_id", "due_date", "id"),
+        Index("ix_tasks_user_completed_created", "user_id", "completed", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     title = Column(String, nullable=False)
     description = Column(String, nullable=True)
     completed = Column(Boolean, default=False)
-    created_at = Column(DateTime, default=datetime.now)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
     due_date = Column(DateTime, nullable=True)
 
@@ -133,6 +153,81 @@ class Task(Base):
     def __repr__(self):
         return f"<Task(id={self.id}, user_id={self.user_id}, title='{self.title}', completed={self.completed})>"
 
+class ProcessedMessage(Base):
+    """
+    Ledger of the messages that have been classified for a user, so a message is
+    only ever sent to the LLM and turned into tasks once
+    """
+    __tablename__ = "processed_messages"
+    __table_args__ = (
+        UniqueConstraint("user_id", "message_id", name="uq_processed_messages_user_message"),
+        Index("ix_processed_messages_processed_at", "processed_at"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    message_id = Column(String, nullable=False)
+    processed_at = Column(DateTime, default=datetime.now, nullable=False)
+
+    def __repr__(self):
+        return f"<ProcessedMessage(user_id={self.user_id}, message_id='{self.message_id}')>"
+
+class MessageFailure(Base):
+    """
+    The polls a message has failed in. A message that keeps failing is recorded
+    in the ledger as a dead letter once it reaches PIPELINE_MAX_MESSAGE_FAILURES,
+    so it stops holding back the user's sync cursor. The row is kept for inspection.
+    """
+    __tablename__ = "message_failures"
+    __table_args__ = (
+        UniqueConstraint("user_id", "message_id", name="uq_message_failures_user_message"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    message_id = Column(String, nullable=False)
+    failures = Column(Integer, default=0, nullable=False)
+    last_error = Column(String, nullable=True)
+    failed_at = Column(DateTime, default=datetime.now, nullable=False)
+
+    def __repr__(self):
+        return f"<MessageFailure(user_id={self.user_id}, message_id='{self.message_id}', failures={self.failures})>"
+
+class PollJob(Base):
+    """
+    A user's place in the database backed polling queue. Worker processes claim
+    due jobs by taking a lease, so each mailbox is only polled by one worker at a time.
+    """
+    __tablename__ = "poll_jobs"
+    __table_args__ = (
+        Index("ix_poll_jobs_due_at", "due_at"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, unique=True)
+    due_at = Column(DateTime, default=datetime.now, nullable=False)
+    interval_seconds = Column(Float, nullable=True)
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    last_polled_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<PollJob(user_id={self.user_id}, due_at={self.due_at}, lease_owner={self.lease_owner})>"
+
+class ServiceLease(Base):
+    """
+    A lease on a job that must run in only one worker process at a time, such
+    as token refresh or watch renewal. The holder extends it on every run.
+    """
+    __tablename__ = "service_leases"
+
+    name = Column(String, primary_key=True)
+    owner = Column(String, nullable=True)
+    expires_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<ServiceLease(name={self.name}, owner={self.owner}, expires_at={self.expires_at})>"
+
 def create_database():
     Base.metadata.create_all(bind=engine)
 
@@ -142,3 +237,7 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
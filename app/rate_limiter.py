@@ -0,0 +1,202 @@
+"""
+token bucket rate limiting and retry with backoff for the upstream APIs (Gmail, Mistral)
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import httpx
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when a call is still rate limited after every retry. The work should
+    be deferred for `retry_after` seconds rather than dropped.
+    """
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"{upstream} rate limit exceeded, retry after {retry_after:.1f}s")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float | None = None):
+        """
+        Args:
+            rate: the tokens added per second
+            capacity: the largest burst, one second worth of tokens by default
+        """
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1) -> float:
+        """
+        Take `tokens` from the bucket, going into debt if there are not enough.
+
+        Returns:
+            float: the seconds to wait before the reserved tokens may be used
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.paused_until - now)
+
+    def pause(self, seconds: float):
+        """
+        Hold every caller of the bucket for `seconds`, e.g. for a Retry-After
+        """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    def __init__(self, name: str, rate: float, per_key_rate: float | None = None):
+        """
+        A global token bucket for an upstream, plus one bucket per key (e.g. per user)
+
+        Args:
+            name: the upstream name, used in logs and errors
+            rate: the requests per second allowed across all keys
+            per_key_rate: the requests per second allowed for each key
+        """
+        self.name = name
+        self.bucket = TokenBucket(rate)
+        self.per_key_rate = per_key_rate
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _key_bucket(self, key: str | None) -> TokenBucket | None:
+        if key is None or self.per_key_rate is None:
+            return None
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(self.per_key_rate)
+            return self._buckets[key]
+
+    def reserve(self, key: str | None = None, tokens: float = 1) -> float:
+        wait = self.bucket.reserve(tokens)
+        key_bucket = self._key_bucket(key)
+        if key_bucket is not None:
+            wait = max(wait, key_bucket.reserve(tokens))
+        return wait
+
+    def acquire(self, key: str | None = None, tokens: float = 1):
+        wait = self.reserve(key, tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, key: str | None = None, tokens: float = 1):
+        wait = self.reserve(key, tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def defer(self, seconds: float, key: str | None = None):
+        """
+        Pause the key's bucket, or the whole upstream if the limit is not per key
+        """
+        key_bucket = self._key_bucket(key)
+        (key_bucket or self.bucket).pause(seconds)
+
+
+def is_rate_limited(exception: Exception) -> bool:
+    """
+    Whether an upstream error is a quota or rate limit error worth retrying
+    """
+    resp = getattr(exception, "resp", None)  # googleapiclient HttpError
+    if resp is not None:
+        content = getattr(exception, "content", b"") or b""
+        return resp.status == 429 or (resp.status == 403 and b"ateLimitExceeded" in content)
+    return getattr(exception, "status_code", None) == 429  # mistralai SDKError
+
+
+def is_transient(exception: Exception) -> bool:
+    """
+    Whether an error is likely to pass on its own: rate limits, timeouts,
+    connection errors and upstream server errors, rather than a fault of the request
+    """
+    if isinstance(exception, (RateLimitExceeded, TimeoutError, ConnectionError, httpx.TransportError)):
+        return True
+    if is_rate_limited(exception):
+        return True
+    resp = getattr(exception, "resp", None)
+    status = resp.status if resp is not None else getattr(exception, "status_code", None)
+    return isinstance(status, int) and status >= 500
+
+
+def get_retry_after(exception: Exception) -> float | None:
+    """
+    Return the Retry-After of an upstream error in seconds, if it has one
+    """
+    resp = getattr(exception, "resp", None)
+    if resp is not None:
+        value = resp.get("retry-after")
+    else:
+        raw_response = getattr(exception, "raw_response", None)
+        value = raw_response.headers.get("retry-after") if raw_response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Exponential backoff with full jitter, so retries from many workers spread out
+    """
+    return random.uniform(0, min(settings.BACKOFF_MAX_SECONDS, settings.BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def call_with_backoff(fn, limiter: RateLimiter, key: str | None = None, tokens: float = 1):
+    """
+    Call `fn` once the limiter allows it, retrying rate limit errors up to BACKOFF_RETRIES times.
+    Retry-After is honoured for every caller of the limiter, not just this one.
+
+    Raises:
+        RateLimitExceeded: if the call is still rate limited after every retry
+    """
+    for attempt in range(settings.BACKOFF_RETRIES + 1):
+        limiter.acquire(key, tokens)
+        try:
+            return fn()
+        except Exception as e:
+            if not is_rate_limited(e):
+                raise
+            delay = get_retry_after(e) or backoff_delay(attempt)
+            logger.warning(f"{limiter.name} rate limited, retrying in {delay:.1f}s")
+            limiter.defer(delay, key)
+    raise RateLimitExceeded(limiter.name, delay)
+
+
+async def call_with_backoff_async(fn, limiter: RateLimiter, key: str | None = None, tokens: float = 1):
+    """
+    Async call_with_backoff, `fn` returns the awaitable to retry
+    """
+    for attempt in range(settings.BACKOFF_RETRIES + 1):
+        await limiter.acquire_async(key, tokens)
+        try:
+            return await fn()
+        except Exception as e:
+            if not is_rate_limited(e):
+                raise
+            delay = get_retry_after(e) or backoff_delay(attempt)
+            logger.warning(f"{limiter.name} rate limited, retrying in {delay:.1f}s")
+            limiter.defer(delay, key)
+    raise RateLimitExceeded(limiter.name, delay)
+
+
+# Shared by every worker so the quotas hold across the whole process
+gmail_limiter = RateLimiter("gmail", settings.GMAIL_RATE_LIMIT, settings.GMAIL_USER_RATE_LIMIT)
+mistral_limiter = RateLimiter("mistral", settings.MISTRAL_RATE_LIMIT)
@@ -0,0 +1,111 @@
+"""
+this script load tests the polling pipeline against the offline Gmail and Mistral fakes, with no network
+
+    python -m app.scripts.benchmark_pipeline --users 50 --messages 200 --gmail-latency 0.05 --mistral-latency 0.5
+
+Every user's mailbox is filled with synthetic mail, or the messages of a
+fixture recorded with app.fakes.gmail.record_mailbox, and the whole userbase
+is polled twice: a full resync, then an incremental history sync of the mail
+delivered since. The run uses its own temporary SQLite database.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+from cryptography.fernet import Fernet
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=50, help="synthetic messages per mailbox for the resync")
+    parser.add_argument("--new-messages", type=int, default=10, help="synthetic messages per mailbox for the incremental sync")
+    parser.add_argument("--fixture", help="a recorded mailbox loaded into every user's mailbox instead of synthetic mail")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--gmail-latency", type=float, default=0.0)
+    parser.add_argument("--gmail-error-rate", type=float, default=0.0)
+    parser.add_argument("--gmail-quota", type=float, help="Gmail requests per second before 429s")
+    parser.add_argument("--mistral-latency", type=float, default=0.0)
+    parser.add_argument("--mistral-error-rate", type=float, default=0.0)
+    parser.add_argument("--mistral-quota", type=float, help="Mistral completions per second before 429s")
+    parser.add_argument("--mistral-recording", help="completions recorded by app.fakes.mistral.RecordingMistral to replay")
+    parser.add_argument("--mistral-rate-limit", type=float, help="overrides MISTRAL_RATE_LIMIT, the client side limit")
+    return parser.parse_args(argv)
+
+
+def configure(args, database_path: str):
+    # Settings are read when app modules are first imported, so this runs before them
+    os.environ["DATABASE_URL"] = f"sqlite:///{database_path}"
+    os.environ["LLM_CACHE_PATH"] = ""
+    os.environ["PREFILTER_MODEL_PATH"] = ""
+    os.environ.setdefault("MISTRAL_TOKEN", "offline")
+    os.environ.setdefault("GOOGLE_CLIENT_ID", "offline")
+    os.environ.setdefault("GOOGLE_CLIENT_SECRET", "offline")
+    os.environ.setdefault("FERNET_KEY", Fernet.generate_key().decode())
+    if args.mistral_rate_limit:
+        os.environ["MISTRAL_RATE_LIMIT"] = str(args.mistral_rate_limit)
+
+
+def run(args):
+    from app.models import SessionLocal, User, GmailCredentials, Task, create_database
+    from app.ai_agents.prompt import prompt_builder
+    from app.ai_agents.task_identifier import llm_stats
+    from app.fakes.gmail import FakeGmail
+    from app.fakes.mistral import FakeMistral
+    from app.message_service.gmail_service import gmail_stats
+    from app.services.gmail_polling import poll_userbase
+    from app.services.pipeline import get_pipeline
+
+    create_database()
+    gmail = FakeGmail(args.gmail_latency, 0.0, args.gmail_error_rate, args.gmail_quota, args.seed)
+    mistral = FakeMistral(args.mistral_latency, 0.0, args.mistral_error_rate, args.mistral_quota, args.seed, args.mistral_recording)
+
+    db = SessionLocal()
+    for i in range(1, args.users + 1):
+        db.add(User(id=i, email=f"user{i}@company.com", password="benchmark", is_google_authenticated=True))
+        db.add(GmailCredentials(user_id=i, token=f"token-{i}", refresh_token=f"refresh-{i}"))
+        if args.fixture:
+            gmail.load_fixture(f"token-{i}", args.fixture)
+        else:
+            gmail.populate(f"token-{i}", args.messages)
+    db.commit()
+    db.close()
+
+    def poll(name: str):
+        gmail_stats.take()
+        start = time.monotonic()
+        poll_userbase()
+        elapsed = time.monotonic() - start
+        db = SessionLocal()
+        tasks = db.query(Task).count()
+        db.close()
+        fetched = gmail_stats.take()
+        messages = fetched.get("metadata_requests", 0)
+        print(f"\n{name}: {messages} messages in {elapsed:.2f}s, {messages / max(elapsed, 1e-9):.1f} messages/s, {tasks} tasks in total")
+        print(f"Gmail fetch stats: {fetched}")
+
+    with gmail.install(), mistral.install():
+        poll("Resync")
+        for i in range(1, args.users + 1):
+            gmail.populate(f"token-{i}", args.new_messages)
+        poll("Incremental sync")
+
+    print(f"\nPipeline stats: {get_pipeline().stats()}")
+    print(f"Prompt stats: {dict(prompt_builder.stats)}")
+    print(f"LLM stats: {llm_stats.snapshot()}")
+    print(f"Fake Gmail: {gmail.stats}, faults {dict(gmail.faults.stats)}")
+    print(f"Fake Mistral: {dict(mistral.stats)}, faults {dict(mistral.faults.stats)}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        configure(args, os.path.join(tmpdir, "benchmark.db"))
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
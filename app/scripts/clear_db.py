@@ -1,9 +1,7 @@
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import text
+from app.models import SessionLocal
 
-engine = create_engine('sqlite:///mail_tasks.db')
-Session = sessionmaker(bind=engine)
-session = Session()
+session = SessionLocal()
 
 session.execute(text("DELETE FROM tasks"))
 session.execute(text("DELETE FROM users"))
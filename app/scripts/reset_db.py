@@ -1,11 +1,9 @@
 """
-this scripts deletes the database file and creates a new one
+this scripts drops every table in the configured database and creates them again
 """
 
-import os
-from app.models import create_database
+from app.models import Base, engine, create_database
 
-if os.path.exists('mail_tasks.db'):
-    os.remove('mail_tasks.db')
+Base.metadata.drop_all(bind=engine)
 
 create_database()
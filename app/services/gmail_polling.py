@@ -1,70 +1,282 @@
 import logging
 import threading
 import time
-from typing import List
-from sqlalchemy.orm import Session
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from sqlalchemy import func
 
-from app.models import User, GmailCredentials, Task, get_db
-from app.message_service.models import Message
-from app.message_service.gmail_service import GmailService
-from app.ai_agents.task_identifier import TaskIdentifier
+from app.config import settings
+from app.models import User, GmailCredentials, SessionLocal, get_db
+from app.ai_agents.prefilter import prefilter
+from app.ai_agents.prompt import prompt_builder
+from app.ai_agents.response_cache import response_cache
+from app.ai_agents.task_identifier import llm_stats
+from app.message_service.gmail_service import gmail_stats
+from app.services.token_refresh import start_token_refresh_thread
+from app.services.gmail_push import start_watch_renewal_thread
+from app.services.poll_scheduler import poll_scheduler
+from app.services.message_ledger import compact_ledger
+from app.services.pipeline import get_pipeline
 
 logger = logging.getLogger(__name__)
 
-def poll_gmail(credentials: GmailCredentials, db: Session) -> List[Message]:
+# Worker pool shared across polling cycles, and the users it is currently polling.
+# A user that is still in flight when the next cycle starts is skipped rather than
+# polled twice, so one slow inbox only ever occupies a single worker.
+_executor = None
+_executor_lock = threading.Lock()
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+# Users whose poll hit an upstream rate limit, with the monotonic time they may be retried
+_deferred_until = {}
+# Users notified of new mail while already being polled, polled again once that finishes
+_repoll = set()
+
+def get_executor() -> ThreadPoolExecutor:
+    """Return the polling worker pool, creating it on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.POLLING_WORKERS,
+                thread_name_prefix="PollingWorker"
+            )
+        return _executor
+
+def run_user_poll(user_id: int, credentials_id: int | None = None) -> tuple[int, float | None]:
+    """
+    Poll a single user's inbox through the ingestion pipeline and wait for every
+    new message to be classified and stored.
+
+    Args:
+        user_id: the user to poll
+        credentials_id: the user's Gmail credentials, their latest by default
+
+    Returns:
+        tuple: the number of tasks created, and the seconds before the user may
+        be retried if Gmail or the LLM rate limited the poll
+    """
+    run = get_pipeline().submit(user_id, credentials_id)
+    if not run.wait(settings.PIPELINE_RUN_TIMEOUT_SECONDS):
+        # Drop the run's queued messages, and keep the user until the work
+        # already under way drains, so the next poll does not classify the
+        # same messages again and then lose its writes to the ledger
+        run.cancel(TimeoutError(f"poll still running after {settings.PIPELINE_RUN_TIMEOUT_SECONDS}s"))
+        logger.error(f"Poll of user {user_id} timed out with {run.outstanding} messages outstanding, cancelling it")
+        if not run.wait(settings.PIPELINE_RUN_TIMEOUT_SECONDS):
+            logger.error(f"Cancelled poll of user {user_id} is still running, releasing the user")
+    if run.retry_after:
+        # Nothing past the rate limit was committed and the cursor was not
+        # advanced, so the same messages are picked up again once the user is retried
+        logger.warning(f"Deferring user {user_id} for {run.retry_after:.1f}s")
+    return run.created, run.retry_after
+
+def poll_user(user_id: int, credentials_id: int | None = None) -> int:
+    """
+    Poll a single user on a polling worker, then release the user and reschedule them
+
+    Returns:
+        int: the number of tasks created
+    """
+    created, retry_after = 0, None
+    try:
+        created, retry_after = run_user_poll(user_id, credentials_id)
+        return created
+    finally:
+        with _in_flight_lock:
+            _in_flight.discard(user_id)
+            if retry_after:
+                _deferred_until[user_id] = time.monotonic() + retry_after
+            repoll = user_id in _repoll
+            _repoll.discard(user_id)
+        poll_scheduler.complete(user_id, created, retry_after)
+        if repoll:
+            request_poll(user_id)
+
+def request_poll(user_id: int) -> bool:
+    """
+    Poll a user as soon as a worker is free, e.g. when Gmail notifies us of new mail.
+
+    A user already being polled is polled again once that finishes, since the
+    running poll may have synced before the new mail arrived. A rate limited
+    user is left for the polling cycle to pick up once their deferral expires.
+
+    Returns:
+        bool: True if a poll was queued now
+    """
+    with _in_flight_lock:
+        if user_id in _in_flight:
+            _repoll.add(user_id)
+            return False
+        if _deferred_until.get(user_id, 0) > time.monotonic():
+            logger.info(f"User {user_id} is rate limited, leaving for the polling cycle")
+            return False
+        _deferred_until.pop(user_id, None)
+        _in_flight.add(user_id)
+    get_executor().submit(poll_user, user_id)
+    return True
+
+def iter_pollable_users(batch_size: int | None = None):
     """
-    Poll Gmail for new messages and return a list of tasks
+    Yield (user id, credentials id) for every active, Google authenticated user
+    and their latest credentials.
+
+    Users are read a page of `batch_size` (POLLING_USER_BATCH_SIZE by default)
+    at a time by keyset on the user id, each page in a short lived session, so
+    neither memory nor a read transaction grows with the size of the userbase.
+    """
+    batch_size = batch_size or settings.POLLING_USER_BATCH_SIZE
+    last_id = 0
+    while True:
+        db = next(get_db())
+        try:
+            latest = db.query(func.max(GmailCredentials.id).label("id")).group_by(GmailCredentials.user_id).subquery()
+            page = db.query(User.id, GmailCredentials.id).join(
+                GmailCredentials, GmailCredentials.user_id == User.id
+            ).join(
+                latest, latest.c.id == GmailCredentials.id
+            ).filter(
+                User.is_active == True,
+                User.is_google_authenticated == True,
+                User.id > last_id
+            ).order_by(User.id).limit(batch_size).all()
+        finally:
+            db.close()
+        yield from page
+        if len(page) < batch_size:
+            return
+        last_id = page[-1][0]
+
+def poll_userbase(timeout: float | None = None):
+    """
+    Poll every active, Google authenticated user on the worker pool.
+
+    Users are read from the database a page at a time and at most twice as
+    many users as there are workers are queued at once, so memory stays flat
+    however many users there are. Waits at most `timeout` seconds (POLLING_CYCLE_TIMEOUT_SECONDS
+    by default) for the cycle to finish. Users still running after that keep
+    their worker and are skipped by the following cycles until they complete.
     """
-    if credentials and credentials.is_expired:
-        credentials.update_token()
-        db.add(credentials)
-        db.commit()
-    logger.info(f"Credentials: {credentials}")
-
-    gmail_service = GmailService(credentials.get_credentials())
-    messages = gmail_service.get_messages(limit=50)
-    task_identifier = TaskIdentifier()
-    tasks = []
-    for message in messages:
-        logger.info(f"Message: {message}")
-        task = task_identifier.get_task(message)
-        if task:
-            tasks.append(task)
-    return tasks
-
-def poll_userbase():
     logger.info("Polling userbase")
-    db = next(get_db())
+    if timeout is None:
+        timeout = settings.POLLING_CYCLE_TIMEOUT_SECONDS
+    deadline = time.monotonic() + timeout
+    max_pending = settings.POLLING_WORKERS * 2
+    executor = get_executor()
+    pending = set()
+    polled = 0
+    created = 0
+
     try:
-        users = db.query(User).all()
-        logger.info(f"Found {len(users)} users")
-        for user in users:
-            logger.info(f"User: {user}")
-            if user.is_active and user.is_google_authenticated:
-                credentials = db.query(GmailCredentials).filter(GmailCredentials.user_id == user.id).first()
-                tasks = poll_gmail(credentials, db)
-                for task in tasks:
-                    logger.info(f"Task: {task}")
-                    db.add(Task(title=task.title, due_date=task.due_date, description=task.description, user_id=user.id))
-                db.commit()
+        for user_id, credentials_id in iter_pollable_users():
+            with _in_flight_lock:
+                if user_id in _in_flight:
+                    logger.info(f"User {user_id} is still being polled, skipping")
+                    continue
+                if _deferred_until.get(user_id, 0) > time.monotonic():
+                    logger.info(f"User {user_id} is rate limited, skipping")
+                    continue
+                _deferred_until.pop(user_id, None)
+
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+                created += sum(future.result() for future in done)
+                if not done:
+                    logger.warning(f"Polling cycle timed out after {timeout}s, remaining users are skipped")
+                    break
+
+            with _in_flight_lock:
+                _in_flight.add(user_id)
+            pending.add(executor.submit(poll_user, user_id, credentials_id))
+            polled += 1
     except Exception as e:
         logger.error(f"Error in polling userbase: {e}")
-    finally:
-        db.close()
-    logger.info("Done polling userbase")
+
+    done, not_done = wait(pending, timeout=max(deadline - time.monotonic(), 0))
+    created += sum(future.result() for future in done)
+    if not_done:
+        logger.warning(f"{len(not_done)} users still polling after {timeout}s")
+    logger.info(f"Done polling userbase: polled {polled} users and created {created} tasks")
+    logger.info(f"Pre-filter stats: {dict(prefilter.stats)}")
+    try:
+        prefilter.save()
+    except Exception as e:
+        logger.error(f"Error saving pre-filter model: {e}")
+
+def dispatch_due_users(now: float | None = None) -> int:
+    """
+    Submit the users the scheduler says are due, without taking more than the
+    scheduler's concurrency cap of workers, so users never queue behind a full pool
+
+    Returns:
+        int: the number of users submitted
+    """
+    with _in_flight_lock:
+        free = poll_scheduler.max_concurrency - len(_in_flight)
+    if free <= 0:
+        return 0
+    executor = get_executor()
+    submitted = 0
+    for user_id in poll_scheduler.due(now, limit=free):
+        with _in_flight_lock:
+            # An in flight user is rescheduled when its poll completes
+            if user_id in _in_flight:
+                continue
+            retry_at = _deferred_until.get(user_id, 0)
+            if retry_at > time.monotonic():
+                poll_scheduler.schedule(user_id, retry_at)
+                continue
+            _deferred_until.pop(user_id, None)
+            _in_flight.add(user_id)
+        executor.submit(poll_user, user_id)
+        submitted += 1
+    return submitted
 
 def run_polling():
     thread_name = threading.current_thread().name
     logger.info(f"Starting polling thread: {thread_name}")
+    last_reload = None
+    last_compaction = None
     while True:
         try:
-            poll_userbase()
+            # Reload periodically to pick up new, deactivated and disconnected users
+            if last_reload is None or time.monotonic() - last_reload >= settings.POLLING_USER_RELOAD_SECONDS:
+                poll_scheduler.sync(user_id for user_id, _ in iter_pollable_users())
+                last_reload = time.monotonic()
+                logger.info(f"Poll scheduler stats: {poll_scheduler.stats()}")
+                logger.info(f"Pipeline stats: {get_pipeline().stats()}")
+                logger.info(f"Gmail fetch stats: {gmail_stats.take()}")
+                logger.info(f"Pre-filter stats: {dict(prefilter.stats)}")
+                logger.info(f"Prompt stats: {dict(prompt_builder.stats)}")
+                logger.info(f"LLM stats: {llm_stats.snapshot()}")
+                logger.info(f"Response cache stats: {response_cache.stats()}")
+                prefilter.save()
+            dispatch_due_users()
         except Exception as e:
             logger.error(f"Error in polling thread: {e}")
-        time.sleep(10)
+        if last_compaction is None or time.monotonic() - last_compaction >= settings.LEDGER_COMPACTION_INTERVAL_SECONDS:
+            db = SessionLocal()
+            try:
+                compact_ledger(db)
+                last_compaction = time.monotonic()
+            except Exception as e:
+                logger.error(f"Error compacting message ledger: {e}")
+            finally:
+                db.close()
+        # Sleep until the next user is due, or while every worker is busy until one is freed
+        next_due = poll_scheduler.next_due()
+        with _in_flight_lock:
+            full = len(_in_flight) >= poll_scheduler.max_concurrency
+        if next_due is None or full:
+            timeout = settings.POLLING_USER_RELOAD_SECONDS
+        else:
+            timeout = min(max(next_due - time.monotonic(), 0), settings.POLLING_USER_RELOAD_SECONDS)
+        poll_scheduler.wait(timeout)
 
 def start_polling_thread():
-    """Start and return the polling thread"""
+    """Start and return the polling thread, along with the token refresh and watch renewal threads it relies on"""
+    start_token_refresh_thread()
+    if settings.GMAIL_PUSH_TOPIC:
+        start_watch_renewal_thread()
     polling_thread = threading.Thread(target=run_polling, name="PollingThread", daemon=True)
     polling_thread.start()
     return polling_thread 
\ No newline at end of file
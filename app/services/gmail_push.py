@@ -0,0 +1,171 @@
+"""
+Gmail push notifications: decoding Pub/Sub push messages, renewing each user's
+Gmail watch, and a local publisher that stands in for Pub/Sub in development and tests
+"""
+import base64
+import json
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from google.auth.transport import requests as google_requests
+from google.oauth2 import id_token
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.models import User, GmailCredentials, SessionLocal
+from app.message_service.client_cache import gmail_clients
+from app.services.job_queue import acquire_service_lease
+
+logger = logging.getLogger(__name__)
+
+
+def decode_push_notification(envelope: dict) -> tuple[str, str]:
+    """
+    Decode the Gmail notification in a Pub/Sub push request body
+
+    Returns:
+        tuple: the email address of the mailbox that changed and its new history id
+
+    Raises:
+        ValueError: if the body is not a Gmail push notification
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(envelope["message"]["data"]))
+        email, history_id = data["emailAddress"], str(data["historyId"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid push notification: {e}")
+    if not history_id.isdigit():
+        raise ValueError(f"Invalid push notification: history id {history_id}")
+    return email, history_id
+
+
+def verify_push_identity(authorization: str | None) -> dict:
+    """
+    Verify the OIDC token a Pub/Sub push subscription signs its requests with,
+    against GMAIL_PUSH_AUDIENCE and GMAIL_PUSH_SERVICE_ACCOUNT
+
+    Args:
+        authorization: the Authorization header of the push request
+
+    Returns:
+        dict: the claims of the token
+
+    Raises:
+        ValueError: if the token is missing, invalid, or not issued for the push subscription
+    """
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise ValueError("Missing push bearer token")
+    claims = id_token.verify_oauth2_token(token, google_requests.Request(), audience=settings.GMAIL_PUSH_AUDIENCE)
+    if settings.GMAIL_PUSH_SERVICE_ACCOUNT and (
+        claims.get("email") != settings.GMAIL_PUSH_SERVICE_ACCOUNT or not claims.get("email_verified")
+    ):
+        raise ValueError(f"Push token issued for {claims.get('email')}")
+    return claims
+
+
+def make_push_envelope(email: str, history_id: str) -> dict:
+    """
+    Build a Pub/Sub push request body for a Gmail notification
+    """
+    data = json.dumps({"emailAddress": email, "historyId": int(history_id)}).encode()
+    return {
+        "message": {
+            "data": base64.urlsafe_b64encode(data).decode(),
+            "messageId": uuid.uuid4().hex,
+            "publishTime": datetime.now(timezone.utc).isoformat(),
+        },
+        "subscription": "projects/local/subscriptions/gmail-push",
+    }
+
+
+class LocalPublisher:
+    def __init__(self, client, path: str = "/integrations/google/push", token: str | None = None):
+        """
+        Delivers Gmail notifications the way a Pub/Sub push subscription would
+
+        Args:
+            client: an HTTP client for the app, e.g. a TestClient or httpx.Client
+            path: the push endpoint
+            token: the push verification token, GMAIL_PUSH_TOKEN by default
+        """
+        self.client = client
+        self.path = path
+        self.token = token if token is not None else settings.GMAIL_PUSH_TOKEN
+
+    def publish(self, email: str, history_id: str):
+        params = {"token": self.token} if self.token else None
+        return self.client.post(self.path, params=params, json=make_push_envelope(email, history_id))
+
+
+def renew_watches(db: Session, topic: str | None = None, now: datetime | None = None) -> int:
+    """
+    Start or renew the Gmail watch of every user whose watch expires within
+    GMAIL_WATCH_RENEWAL_SECONDS, so notifications keep arriving.
+
+    Returns:
+        int: the number of watches renewed
+    """
+    topic = topic or settings.GMAIL_PUSH_TOPIC
+    now = now or datetime.now()
+    threshold = now + timedelta(seconds=settings.GMAIL_WATCH_RENEWAL_SECONDS)
+    latest = db.query(func.max(GmailCredentials.id).label("id")).group_by(GmailCredentials.user_id).subquery()
+    due = db.query(GmailCredentials).join(
+        latest, latest.c.id == GmailCredentials.id
+    ).join(
+        User, User.id == GmailCredentials.user_id
+    ).filter(
+        User.is_active == True,
+        User.is_google_authenticated == True,
+        or_(GmailCredentials.watch_expiration == None, GmailCredentials.watch_expiration < threshold)
+    ).all()
+
+    renewed = 0
+    for credentials in due:
+        try:
+            with gmail_clients.lease(credentials) as gmail_service:
+                response = gmail_service.watch(topic)
+            if not response:
+                continue
+            credentials.watch_expiration = datetime.fromtimestamp(int(response["expiration"]) / 1000)
+            db.commit()
+            renewed += 1
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error renewing Gmail watch for user {credentials.user_id}: {e}")
+    logger.info(f"Renewed {renewed} of {len(due)} Gmail watches")
+    return renewed
+
+
+def run_watch_renewal(owner: str | None = None):
+    """
+    Args:
+        owner: the worker process running the thread. When set, watches are
+            only renewed while it holds the watch renewal lease, so one worker
+            in the fleet renews each watch.
+    """
+    thread_name = threading.current_thread().name
+    logger.info(f"Starting watch renewal thread: {thread_name}")
+    lease_seconds = settings.GMAIL_WATCH_CHECK_INTERVAL_SECONDS + settings.POLL_JOB_LEASE_SECONDS
+    while True:
+        db = SessionLocal()
+        try:
+            if owner is None or acquire_service_lease(db, "watch_renewal", owner, lease_seconds):
+                renew_watches(db)
+        except Exception as e:
+            logger.error(f"Error in watch renewal thread: {e}")
+        finally:
+            db.close()
+        time.sleep(settings.GMAIL_WATCH_CHECK_INTERVAL_SECONDS)
+
+
+def start_watch_renewal_thread(owner: str | None = None):
+    """Start and return the watch renewal thread, see run_watch_renewal"""
+    if not settings.GMAIL_PUSH_TOKEN:
+        logger.warning("GMAIL_PUSH_TOPIC is set without GMAIL_PUSH_TOKEN, every push notification will be rejected")
+    renewal_thread = threading.Thread(target=run_watch_renewal, args=(owner,), name="WatchRenewalThread", daemon=True)
+    renewal_thread.start()
+    return renewal_thread
@@ -0,0 +1,174 @@
+"""
+database backed queue of per-user poll jobs, shared by any number of worker processes,
+and the leases that keep fleet-wide jobs such as token refresh to one process
+"""
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import DateTime, delete, exists, insert, literal, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.models import User, GmailCredentials, PollJob, ServiceLease
+from app.services.poll_scheduler import poll_scheduler
+
+logger = logging.getLogger(__name__)
+
+
+def _pollable_user_ids():
+    return select(User.id).where(
+        User.is_active == True,
+        User.is_google_authenticated == True,
+        exists().where(GmailCredentials.user_id == User.id)
+    )
+
+
+def sync_jobs(db: Session) -> tuple[int, int]:
+    """
+    Create a job for every pollable user without one and remove the jobs of
+    users that can no longer be polled. Safe to run from several workers at once.
+
+    Returns:
+        tuple: the number of jobs created and removed
+    """
+    try:
+        created = db.execute(
+            insert(PollJob).from_select(
+                ["user_id", "due_at"],
+                select(User.id, literal(datetime.now(), DateTime)).where(
+                    User.id.in_(_pollable_user_ids()),
+                    ~exists().where(PollJob.user_id == User.id)
+                )
+            )
+        ).rowcount
+        removed = db.execute(
+            delete(PollJob).where(PollJob.user_id.not_in(_pollable_user_ids()))
+        ).rowcount
+        db.commit()
+        return created, removed
+    except IntegrityError:
+        # Another worker created the same jobs first
+        db.rollback()
+        return 0, 0
+
+
+def claim_jobs(db: Session, owner: str, limit: int, lease_seconds: float | None = None, now: datetime | None = None) -> list[tuple[int, int]]:
+    """
+    Lease up to `limit` due jobs to `owner`, most overdue first. A job is due
+    once its due time has passed and it has no live lease, so jobs held by a
+    worker that died are picked up again once the lease expires.
+
+    The claim is a single UPDATE. On Postgres the due jobs are selected with
+    FOR UPDATE SKIP LOCKED so concurrent workers claim different jobs without
+    waiting on each other. SQLite has no row locks, but it runs one write
+    transaction at a time, which makes the UPDATE just as exclusive.
+
+    Returns:
+        list: the (job id, user id) of each claimed job
+    """
+    if limit <= 0:
+        return []
+    now = now or datetime.now()
+    lease_seconds = lease_seconds or settings.POLL_JOB_LEASE_SECONDS
+    due = select(PollJob.id).where(
+        PollJob.due_at <= now,
+        or_(PollJob.lease_expires_at == None, PollJob.lease_expires_at < now)
+    ).order_by(PollJob.due_at).limit(limit).with_for_update(skip_locked=True)
+    claimed = db.execute(
+        update(PollJob).where(PollJob.id.in_(due.scalar_subquery())).values(
+            lease_owner=owner,
+            lease_expires_at=now + timedelta(seconds=lease_seconds)
+        ).returning(PollJob.id, PollJob.user_id)
+    ).all()
+    db.commit()
+    return [(job_id, user_id) for job_id, user_id in claimed]
+
+
+def heartbeat(db: Session, owner: str, job_ids: list[int], lease_seconds: float | None = None, now: datetime | None = None) -> set[int]:
+    """
+    Extend the leases `owner` still holds on `job_ids`
+
+    Returns:
+        set: the job ids whose lease was extended, any others have been lost
+    """
+    if not job_ids:
+        return set()
+    now = now or datetime.now()
+    lease_seconds = lease_seconds or settings.POLL_JOB_LEASE_SECONDS
+    extended = db.execute(
+        update(PollJob).where(PollJob.id.in_(job_ids), PollJob.lease_owner == owner).values(
+            lease_expires_at=now + timedelta(seconds=lease_seconds)
+        ).returning(PollJob.id)
+    ).scalars().all()
+    db.commit()
+    return set(extended)
+
+
+def complete_job(
+    db: Session,
+    owner: str,
+    job_id: int,
+    created: int,
+    retry_after: float | None = None,
+    claimed_at: datetime | None = None,
+    now: datetime | None = None
+) -> bool:
+    """
+    Release a job's lease and schedule its next poll, sooner if the poll created
+    tasks and later if it did not. A job made due again while it was leased,
+    e.g. by a push notification, stays due since the poll may have missed that mail.
+
+    Returns:
+        bool: False if the lease had already been lost to another worker
+    """
+    now = now or datetime.now()
+    job = db.execute(select(PollJob).where(PollJob.id == job_id, PollJob.lease_owner == owner)).scalars().first()
+    if job is None:
+        logger.warning(f"Lease on poll job {job_id} was lost before it completed")
+        return False
+    job.interval_seconds = poll_scheduler.next_interval(job.interval_seconds, created)
+    if retry_after or claimed_at is None or job.due_at <= claimed_at:
+        job.due_at = now + timedelta(seconds=max(job.interval_seconds, retry_after or 0))
+    job.lease_owner = None
+    job.lease_expires_at = None
+    job.last_polled_at = now
+    db.commit()
+    return True
+
+
+def mark_due_statement(user_id: int, now: datetime | None = None):
+    """
+    The statement that makes a user's job due now, e.g. on a push notification.
+    Returned rather than executed so both sync and async sessions can run it.
+    """
+    return update(PollJob).where(PollJob.user_id == user_id).values(
+        due_at=now or datetime.now(),
+        interval_seconds=poll_scheduler.min_interval
+    )
+
+
+def acquire_service_lease(db: Session, name: str, owner: str, lease_seconds: float, now: datetime | None = None) -> bool:
+    """
+    Take or extend the lease on a fleet-wide job. The lease is taken when it
+    is free, has expired or is already held by `owner`, in a single UPDATE so
+    two workers never both hold it.
+
+    Returns:
+        bool: True if `owner` holds the lease for the next `lease_seconds`
+    """
+    now = now or datetime.now()
+    if db.get(ServiceLease, name) is None:
+        try:
+            db.add(ServiceLease(name=name))
+            db.commit()
+        except IntegrityError:
+            # Another worker created the lease first
+            db.rollback()
+    acquired = db.execute(
+        update(ServiceLease).where(
+            ServiceLease.name == name,
+            or_(ServiceLease.owner == None, ServiceLease.owner == owner, ServiceLease.expires_at < now)
+        ).values(owner=owner, expires_at=now + timedelta(seconds=lease_seconds)).returning(ServiceLease.name)
+    ).first()
+    db.commit()
+    return acquired is not None
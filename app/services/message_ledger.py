@@ -0,0 +1,93 @@
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.models import ProcessedMessage, MessageFailure
+
+logger = logging.getLogger(__name__)
+
+def filter_unprocessed(db: Session, user_id: int, message_ids: list[str]) -> list[str]:
+    """
+    Return the message ids that are not in the user's ledger yet, in their original order
+    """
+    if not message_ids:
+        return []
+    processed = {
+        message_id for (message_id,) in db.query(ProcessedMessage.message_id).filter(
+            ProcessedMessage.user_id == user_id,
+            ProcessedMessage.message_id.in_(message_ids)
+        )
+    }
+    return [message_id for message_id in message_ids if message_id not in processed]
+
+def record_processed(db: Session, user_id: int, message_ids: list[str]):
+    """
+    Add message ids to the user's ledger.
+
+    Not committed here: callers commit the ledger in the same transaction as the
+    tasks created from the messages. If another worker recorded one of the
+    messages first, the commit fails on the (user_id, message_id) constraint and
+    rolling back discards the duplicate tasks.
+    """
+    if not message_ids:
+        return
+    now = datetime.now()
+    db.execute(insert(ProcessedMessage), [
+        {"user_id": user_id, "message_id": message_id, "processed_at": now}
+        for message_id in message_ids
+    ])
+
+def record_failures(db: Session, user_id: int, errors: dict[str, Exception], max_failures: int | None = None) -> list[str]:
+    """
+    Count one more failure for each message, and record the messages that have
+    now failed `max_failures` times (PIPELINE_MAX_MESSAGE_FAILURES by default)
+    in the ledger as dead letters.
+
+    Not committed here, like record_processed.
+
+    Returns:
+        list: the ids of the messages dead lettered
+    """
+    if max_failures is None:
+        max_failures = settings.PIPELINE_MAX_MESSAGE_FAILURES
+    existing = {
+        failure.message_id: failure for failure in db.query(MessageFailure).filter(
+            MessageFailure.user_id == user_id,
+            MessageFailure.message_id.in_(list(errors))
+        )
+    }
+    now = datetime.now()
+    dead = []
+    for message_id, error in errors.items():
+        failure = existing.get(message_id)
+        if failure is None:
+            failure = MessageFailure(user_id=user_id, message_id=message_id, failures=0)
+            db.add(failure)
+        failure.failures += 1
+        failure.last_error = f"{type(error).__name__}: {error}"[:1000]
+        failure.failed_at = now
+        if failure.failures >= max_failures:
+            dead.append(message_id)
+    record_processed(db, user_id, dead)
+    return dead
+
+def compact_ledger(db: Session, retention_days: int | None = None) -> int:
+    """
+    Delete ledger entries older than `retention_days` (LEDGER_RETENTION_DAYS by default).
+
+    Syncs never return mail older than the retention window, so an entry is
+    only removed once its message can no longer be seen again.
+
+    Returns:
+        int: the number of entries deleted
+    """
+    if retention_days is None:
+        retention_days = settings.LEDGER_RETENTION_DAYS
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    deleted = db.query(ProcessedMessage).filter(ProcessedMessage.processed_at < cutoff).delete(synchronize_session=False)
+    db.query(MessageFailure).filter(MessageFailure.failed_at < cutoff).delete(synchronize_session=False)
+    db.commit()
+    logger.info(f"Compacted message ledger: deleted {deleted} entries older than {cutoff}")
+    return deleted
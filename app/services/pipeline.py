@@ -0,0 +1,486 @@
+"""
+staged ingestion pipeline: fetch -> parse -> prefilter -> classify -> persist
+
+Each stage has its own workers and reads from a bounded queue, so Gmail
+fetches, LLM calls and database writes for different messages and users
+overlap. A full queue blocks the stage feeding it, so a slow LLM stage holds
+back the fetcher instead of letting fetched mail pile up in memory.
+"""
+import asyncio
+import logging
+import queue
+import threading
+import time
+from typing import Dict
+from sqlalchemy import insert, update
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.models import GmailCredentials, Task, SessionLocal
+from app.message_service.client_cache import gmail_clients
+from app.message_service.gmail_service import GmailService
+from app.ai_agents.models import Task as TaskModel
+from app.ai_agents.task_identifier import TaskIdentifier
+from app.ai_agents.prefilter import prefilter
+from app.rate_limiter import RateLimitExceeded, is_transient
+from app.services.message_ledger import filter_unprocessed, record_failures, record_processed
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def persist_results(db: Session, user_id: int, results: Dict[str, list[TaskModel]]) -> int:
+    """
+    Bulk insert every task found in a user's messages and record the messages in the ledger.
+
+    Not committed here: callers commit the tasks and ledger rows together so
+    each message creates its tasks exactly once.
+
+    Returns:
+        int: the number of tasks created
+    """
+    rows = [
+        {"user_id": user_id, "title": task.title, "description": task.description, "due_date": task.due_date}
+        for tasks in results.values() for task in tasks
+    ]
+    for row in rows:
+        logger.info(f"Task: {row['title']}")
+    if rows:
+        db.execute(insert(Task), rows)
+    record_processed(db, user_id, list(results))
+    return len(rows)
+
+
+class UserRun:
+    def __init__(self, user_id: int, credentials_id: int | None = None):
+        """
+        One poll of a user's inbox as it moves through the pipeline. The user's
+        sync cursor only advances once every message fetched has been persisted.
+        """
+        self.user_id = user_id
+        self.credentials_id = credentials_id
+        self.history_id = None
+        self.created = 0
+        self.retry_after = None
+        self.failed = False
+        self.cancelled = False
+        self.outstanding = 0
+        self.fetched = False
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def add(self, count: int):
+        with self._lock:
+            self.outstanding += count
+
+    def fail(self, error: Exception):
+        with self._lock:
+            self.failed = True
+            if isinstance(error, RateLimitExceeded):
+                self.retry_after = max(self.retry_after or 0, error.retry_after)
+
+    def cancel(self, error: Exception):
+        """
+        Fail the run and drop its messages still queued in the pipeline, so a
+        later poll of the user is not racing it for the same messages
+        """
+        self.fail(error)
+        with self._lock:
+            self.cancelled = True
+
+    def finish(self, count: int = 0, created: int = 0, fetched: bool = False) -> bool:
+        """
+        Mark `count` messages as persisted, or the fetch as finished
+
+        Returns:
+            bool: True for the one call that completes the run
+        """
+        with self._lock:
+            if self.done.is_set():
+                return False
+            self.outstanding -= count
+            self.created += created
+            self.fetched = self.fetched or fetched
+            return self.fetched and self.outstanding == 0
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return self.done.wait(timeout)
+
+
+class Stage:
+    def __init__(self, name: str, handler, workers: int = 1, queue_size: int = 100, batch_size: int = 1):
+        """
+        A pool of workers calling `handler` with up to `batch_size` items at a time from a bounded queue
+
+        Args:
+            name: the stage name, used in logs and stats
+            handler: called with a list of queued items
+            workers: the number of worker threads
+            queue_size: the most items waiting, a full queue blocks whoever feeds it
+            batch_size: the most items passed to one handler call
+        """
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.processed = 0
+        self.errors = 0
+        self.busy = 0
+        self._threads = []
+        self._lock = threading.Lock()
+        self._last_stats = (time.monotonic(), 0)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"Pipeline-{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for _ in self._threads:
+            self.queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def _work(self):
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not _STOP and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is _STOP
+            if stopping:
+                batch.pop()
+            if batch:
+                with self._lock:
+                    self.busy += 1
+                try:
+                    self.handler(batch)
+                except Exception as e:
+                    with self._lock:
+                        self.errors += 1
+                    logger.error(f"Error in pipeline stage {self.name}: {e}")
+                finally:
+                    with self._lock:
+                        self.busy -= 1
+                        self.processed += len(batch)
+            if stopping:
+                return
+
+    def stats(self) -> dict:
+        """
+        Queue depth, busy workers and throughput since the previous call
+        """
+        now = time.monotonic()
+        with self._lock:
+            last_time, last_processed = self._last_stats
+            self._last_stats = (now, self.processed)
+            return {
+                "queue_depth": self.queue.qsize(),
+                "busy": self.busy,
+                "processed": self.processed,
+                "errors": self.errors,
+                "per_second": (self.processed - last_processed) / max(now - last_time, 1e-9),
+            }
+
+
+class IngestPipeline:
+    def __init__(
+        self,
+        fetch_workers: int | None = None,
+        parse_workers: int | None = None,
+        prefilter_workers: int | None = None,
+        classify_workers: int | None = None,
+        persist_workers: int | None = None,
+        queue_size: int | None = None
+    ):
+        queue_size = queue_size or settings.PIPELINE_QUEUE_SIZE
+        self.fetch = Stage("fetch", self._fetch, fetch_workers or settings.PIPELINE_FETCH_WORKERS, queue_size)
+        self.parse = Stage("parse", self._parse, parse_workers or settings.PIPELINE_PARSE_WORKERS, queue_size)
+        self.prefilter = Stage("prefilter", self._prefilter, prefilter_workers or settings.PIPELINE_PREFILTER_WORKERS, queue_size)
+        self.classify = Stage(
+            "classify",
+            self._classify,
+            classify_workers or settings.LLM_CONCURRENCY,
+            queue_size,
+            batch_size=settings.LLM_BATCH_SIZE
+        )
+        self.persist = Stage(
+            "persist",
+            self._persist,
+            persist_workers or settings.PIPELINE_PERSIST_WORKERS,
+            queue_size,
+            batch_size=settings.PIPELINE_PERSIST_BATCH_SIZE
+        )
+        self.stages = [self.fetch, self.parse, self.prefilter, self.classify, self.persist]
+        self._runs = {}
+        self._runs_lock = threading.Lock()
+        # Each classify worker keeps one TaskIdentifier, and so one Mistral
+        # client, with the event loop its async requests run on
+        self._classifiers = threading.local()
+        self._loops = []
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        """Stop each stage once the stages before it have drained"""
+        for stage in self.stages:
+            stage.stop()
+        for loop in self._loops:
+            loop.close()
+        self._loops = []
+
+    def submit(self, user_id: int, credentials_id: int | None = None) -> UserRun:
+        """
+        Queue a poll of the user's inbox, blocking while the fetch queue is full
+
+        Returns:
+            UserRun: completes once every new message has been persisted
+        """
+        run = UserRun(user_id, credentials_id)
+        with self._runs_lock:
+            self._runs[id(run)] = run
+        self.fetch.put(run)
+        return run
+
+    def stats(self) -> dict:
+        stats = {stage.name: stage.stats() for stage in self.stages}
+        with self._runs_lock:
+            stats["outstanding"] = {run.user_id: run.outstanding for run in self._runs.values()}
+        return stats
+
+    def _complete(self, run: UserRun):
+        """
+        Advance the user's cursor if every message was persisted, and release the run
+        """
+        try:
+            if not run.failed and run.history_id is not None:
+                db = SessionLocal()
+                try:
+                    db.execute(update(GmailCredentials).where(GmailCredentials.id == run.credentials_id).values(history_id=run.history_id))
+                    db.commit()
+                finally:
+                    db.close()
+        except Exception as e:
+            logger.error(f"Error saving sync cursor for user {run.user_id}: {e}")
+        finally:
+            with self._runs_lock:
+                self._runs.pop(id(run), None)
+            run.done.set()
+
+    def _release(self, run: UserRun, count: int):
+        """Finish `count` of a run's messages without persisting them"""
+        if run.finish(count):
+            self._complete(run)
+
+    def _fail_messages(self, run: UserRun, errors: dict[str, Exception]):
+        """
+        Finish messages that failed in a stage. Failures that are not transient
+        are counted per message, and a message that has failed in
+        PIPELINE_MAX_MESSAGE_FAILURES polls is dead lettered in the ledger, so
+        it no longer holds back the cursor. Any other failure fails the run.
+        """
+        counted = {message_id: e for message_id, e in errors.items() if message_id and not is_transient(e)}
+        dead = []
+        if counted:
+            db = SessionLocal()
+            try:
+                dead = record_failures(db, run.user_id, counted)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                dead = []
+                logger.error(f"Error recording message failures for user {run.user_id}: {e}")
+            finally:
+                db.close()
+        for message_id in dead:
+            logger.warning(f"Dead lettered message {message_id} of user {run.user_id}: {errors[message_id]}")
+        for message_id, e in errors.items():
+            if message_id not in dead:
+                run.fail(e)
+        self._release(run, len(errors))
+
+    def _fetch(self, runs: list[UserRun]):
+        for run in runs:
+            try:
+                self._fetch_run(run)
+            except Exception as e:
+                run.fail(e)
+                logger.error(f"Error fetching messages for user {run.user_id}: {e}")
+            if run.finish(fetched=True):
+                self._complete(run)
+
+    def _fetch_run(self, run: UserRun):
+        if run.cancelled:
+            return
+        db = SessionLocal()
+        try:
+            if run.credentials_id is not None:
+                credentials = db.get(GmailCredentials, run.credentials_id)
+            else:
+                credentials = db.query(GmailCredentials).filter(GmailCredentials.user_id == run.user_id).order_by(GmailCredentials.id.desc()).first()
+            if not credentials:
+                logger.warning(f"No Gmail credentials for user {run.user_id}")
+                return
+            run.credentials_id = credentials.id
+            # Tokens are normally refreshed ahead of expiry by the token refresh thread,
+            # this only happens if it has fallen behind
+            if credentials.is_expired:
+                logger.warning(f"Refreshing expired token inline for user {run.user_id}")
+                credentials.update_token()
+                db.commit()
+
+            with gmail_clients.lease(credentials) as gmail_service:
+                message_ids, history_id = gmail_service.sync_message_ids(
+                    credentials.history_id,
+                    limit=settings.GMAIL_RESYNC_LIMIT,
+                    newer_than_days=settings.LEDGER_RETENTION_DAYS
+                )
+                if history_id != credentials.history_id:
+                    run.history_id = history_id
+                new_ids = filter_unprocessed(db, run.user_id, message_ids)
+                db.rollback()
+                # Fetch a batch at a time, blocking while the pipeline is full
+                for i in range(0, len(new_ids), settings.GMAIL_BATCH_SIZE):
+                    if run.cancelled:
+                        return
+                    resources = gmail_service.fetch_messages(new_ids[i:i + settings.GMAIL_BATCH_SIZE])
+                    run.add(len(resources))
+                    for resource in resources:
+                        self.parse.put((run, resource))
+        finally:
+            db.close()
+
+    def _parse(self, items: list):
+        for run, resource in items:
+            if run.cancelled:
+                self._release(run, 1)
+                continue
+            try:
+                message = GmailService.parse_message(resource)
+            except Exception as e:
+                logger.error(f"Error parsing message {resource.get('id')} for user {run.user_id}: {e}")
+                self._fail_messages(run, {resource.get('id'): e})
+                continue
+            logger.info(f"Message: {message}")
+            self.prefilter.put((run, message))
+
+    def _prefilter(self, items: list):
+        for run, message in items:
+            if run.cancelled:
+                self._release(run, 1)
+                continue
+            try:
+                skip = prefilter.should_skip(message)
+            except Exception as e:
+                logger.error(f"Error pre-filtering message {message.id} for user {run.user_id}: {e}")
+                self._fail_messages(run, {message.id: e})
+                continue
+            # Messages the pre-filter is confident have no task never reach the LLM
+            if skip:
+                self.persist.put((run, message.id, []))
+            else:
+                self.classify.put((run, message))
+
+    def _classifier(self) -> tuple[TaskIdentifier, asyncio.AbstractEventLoop]:
+        """The TaskIdentifier and event loop of the calling classify worker, created on first use"""
+        local = self._classifiers
+        if not hasattr(local, "identifier"):
+            local.identifier = TaskIdentifier()
+            local.loop = asyncio.new_event_loop()
+            with self._runs_lock:
+                self._loops.append(local.loop)
+        return local.identifier, local.loop
+
+    def _classify(self, items: list):
+        # Each request only holds one user's mail
+        runs = {}
+        for run, message in items:
+            runs.setdefault(id(run), (run, []))[1].append(message)
+        for run, messages in runs.values():
+            if run.cancelled:
+                self._release(run, len(messages))
+                continue
+            errors = {}
+            identifier = None
+            try:
+                # Each batch runs LLM_CONCURRENCY requests at a time on the async client
+                identifier, loop = self._classifier()
+                tasks = loop.run_until_complete(identifier.get_tasks_async(messages))
+            except Exception as e:
+                logger.error(f"Error classifying messages for user {run.user_id}: {e}")
+                if identifier is None:
+                    # Not the fault of any message, so nothing is counted against them
+                    run.fail(e)
+                    self._release(run, len(messages))
+                    continue
+                if is_transient(e) or len(messages) == 1:
+                    self._fail_messages(run, {message.id: e for message in messages})
+                    continue
+                # Classify each message alone, so one the LLM rejects does not count against the rest
+                classified = []
+                for message in messages:
+                    try:
+                        classified.append((message, loop.run_until_complete(identifier.get_tasks_async([message]))[0]))
+                    except Exception as e:
+                        errors[message.id] = e
+                messages, tasks = [message for message, _ in classified], [found for _, found in classified]
+            if errors:
+                self._fail_messages(run, errors)
+            try:
+                for message, found in zip(messages, tasks):
+                    prefilter.observe(message, bool(found))
+            except Exception as e:
+                run.fail(e)
+                logger.error(f"Error updating the pre-filter for user {run.user_id}: {e}")
+                if run.finish(len(messages)):
+                    self._complete(run)
+                continue
+            for message, found in zip(messages, tasks):
+                self.persist.put((run, message.id, found))
+
+    def _persist(self, items: list):
+        # One transaction per user, so a failed write never loses another user's results
+        runs = {}
+        for run, message_id, tasks in items:
+            runs.setdefault(id(run), (run, {}))[1][message_id] = tasks
+        for run, results in runs.values():
+            if run.cancelled:
+                self._release(run, len(results))
+                continue
+            created = 0
+            db = SessionLocal()
+            try:
+                created = persist_results(db, run.user_id, results)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                run.fail(e)
+                logger.error(f"Error persisting tasks for user {run.user_id}: {e}")
+            finally:
+                db.close()
+            if run.finish(len(results), created):
+                self._complete(run)
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+def get_pipeline() -> IngestPipeline:
+    """Return the ingestion pipeline, starting it on first use"""
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = IngestPipeline()
+            _pipeline.start()
+        return _pipeline
@@ -0,0 +1,149 @@
+import heapq
+import random
+import threading
+import time
+
+from app.config import settings
+
+
+class PollScheduler:
+    def __init__(self, min_interval: float = 10, max_interval: float = 900, backoff: float = 2.0, max_concurrency: int = 8):
+        """
+        Decides when each user is next polled. Inboxes that just produced tasks
+        are polled every `min_interval`, each idle poll multiplies the interval
+        by `backoff` up to `max_interval`.
+
+        Args:
+            min_interval: the seconds between polls of a busy inbox
+            max_interval: the most seconds between polls of an idle inbox
+            backoff: how much an idle poll lengthens the interval
+            max_concurrency: the most users dispatched to be polled at once
+        """
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = backoff
+        self.max_concurrency = max_concurrency
+        # Min-heap of (poll at, user id) on the monotonic clock. `_scheduled` holds the
+        # latest time for each user so entries superseded by a reschedule are skipped.
+        self._heap = []
+        self._scheduled = {}
+        self._intervals = {}
+        # Seconds each user's last poll started after it was due
+        self.lag = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def _schedule(self, user_id: int, poll_at: float):
+        self._scheduled[user_id] = poll_at
+        heapq.heappush(self._heap, (poll_at, user_id))
+
+    def schedule(self, user_id: int, poll_at: float):
+        with self._lock:
+            if user_id in self._intervals:
+                self._schedule(user_id, poll_at)
+        self._wakeup.set()
+
+    def sync(self, user_ids, now: float | None = None):
+        """
+        Track exactly `user_ids`. New users are spread over the first interval
+        so a restart does not poll everyone at once.
+        """
+        now = now or time.monotonic()
+        user_ids = set(user_ids)
+        with self._lock:
+            for user_id in set(self._intervals) - user_ids:
+                del self._intervals[user_id]
+                self._scheduled.pop(user_id, None)
+                self.lag.pop(user_id, None)
+            for user_id in user_ids - set(self._intervals):
+                self._intervals[user_id] = self.min_interval
+                self._schedule(user_id, now + random.uniform(0, self.min_interval))
+        self._wakeup.set()
+
+    def poll_now(self, user_id: int, now: float | None = None):
+        """
+        Poll a user as soon as possible, e.g. when we know new mail has arrived
+        """
+        with self._lock:
+            if user_id in self._intervals:
+                self._intervals[user_id] = self.min_interval
+                self._schedule(user_id, now or time.monotonic())
+        self._wakeup.set()
+
+    def due(self, now: float | None = None, limit: int | None = None) -> list[int]:
+        """
+        Pop up to `limit` users due to be polled by `now`, recording how late each is
+        """
+        now = now or time.monotonic()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and (limit is None or len(due) < limit):
+                poll_at, user_id = heapq.heappop(self._heap)
+                if self._scheduled.get(user_id) == poll_at:
+                    del self._scheduled[user_id]
+                    self.lag[user_id] = now - poll_at
+                    due.append(user_id)
+        return due
+
+    def next_due(self) -> float | None:
+        with self._lock:
+            while self._heap and self._scheduled.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def complete(self, user_id: int, created: int, retry_after: float | None = None, now: float | None = None):
+        """
+        Reschedule a user after a poll, sooner if it created tasks and later if it did not
+
+        Args:
+            user_id: the user that was polled
+            created: the number of tasks the poll created
+            retry_after: if the poll was rate limited, the seconds before it may be retried
+        """
+        now = now or time.monotonic()
+        with self._lock:
+            if user_id in self._intervals:
+                interval = self.next_interval(self._intervals[user_id], created)
+                self._intervals[user_id] = interval
+                self._schedule(user_id, now + max(interval, retry_after or 0))
+        # A worker is free again
+        self._wakeup.set()
+
+    def next_interval(self, interval: float | None, created: int) -> float:
+        """
+        The interval after a poll that created `created` tasks
+        """
+        if created or interval is None:
+            return self.min_interval
+        return min(interval * self.backoff, self.max_interval)
+
+    def interval(self, user_id: int) -> float | None:
+        with self._lock:
+            return self._intervals.get(user_id)
+
+    def wait(self, timeout: float):
+        """
+        Sleep until `timeout`, or until a user is rescheduled or a worker is freed
+        """
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lags = sorted(self.lag.values())
+            return {
+                "users": len(self._intervals),
+                "busy_users": sum(1 for interval in self._intervals.values() if interval == self.min_interval),
+                "median_lag": lags[len(lags) // 2] if lags else 0.0,
+                "max_lag": lags[-1] if lags else 0.0,
+            }
+
+
+poll_scheduler = PollScheduler(
+    # With push notifications new mail is polled as it arrives, so the
+    # schedule only has to catch notifications that were lost
+    min_interval=settings.POLLING_SAFETY_NET_SECONDS if settings.GMAIL_PUSH_TOPIC else settings.POLLING_INTERVAL_SECONDS,
+    max_interval=settings.POLLING_MAX_INTERVAL_SECONDS,
+    backoff=settings.POLLING_BACKOFF_FACTOR,
+    max_concurrency=settings.POLLING_WORKERS
+)
@@ -0,0 +1,179 @@
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from google.auth.exceptions import RefreshError
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.models import User, GmailCredentials, SessionLocal
+from app.services.job_queue import acquire_service_lease
+
+logger = logging.getLogger(__name__)
+
+
+class TokenRefreshScheduler:
+    def __init__(self, lead_seconds: float = 300, batch_size: int = 50, retry_seconds: float = 60):
+        """
+        Refreshes Gmail access tokens shortly before they expire, so polling never refreshes inline.
+
+        Args:
+            lead_seconds: how long before expiry a token is refreshed
+            batch_size: the most tokens refreshed per run
+            retry_seconds: how long to wait before retrying a failed refresh
+        """
+        self.lead_seconds = lead_seconds
+        self.batch_size = batch_size
+        self.retry_seconds = retry_seconds
+        # Min-heap of (refresh at, credentials id). `_scheduled` holds the latest
+        # time for each id so entries superseded by a reschedule are skipped.
+        self._heap = []
+        self._scheduled = {}
+        self._lock = threading.Lock()
+
+    def schedule(self, credentials_id: int, expiry: datetime | None):
+        if expiry is None:
+            return
+        refresh_at = expiry - timedelta(seconds=self.lead_seconds)
+        with self._lock:
+            if self._scheduled.get(credentials_id) == refresh_at:
+                return
+            self._scheduled[credentials_id] = refresh_at
+            heapq.heappush(self._heap, (refresh_at, credentials_id))
+
+    def reset(self):
+        """Forget every scheduled refresh"""
+        with self._lock:
+            self._heap = []
+            self._scheduled = {}
+
+    def load(self, db: Session):
+        """
+        Schedule the latest credentials of every active, Google authenticated
+        user that can be refreshed. Older rows left by re-authenticating are never polled.
+        """
+        latest = db.query(func.max(GmailCredentials.id).label("id")).group_by(GmailCredentials.user_id).subquery()
+        rows = db.query(GmailCredentials.id, GmailCredentials.token_expiry).join(
+            latest, latest.c.id == GmailCredentials.id
+        ).join(
+            User, User.id == GmailCredentials.user_id
+        ).filter(
+            User.is_active == True,
+            User.is_google_authenticated == True,
+            GmailCredentials.encrypted_refresh_token != None
+        )
+        for credentials_id, expiry in rows:
+            self.schedule(credentials_id, expiry)
+
+    def due(self, now: datetime | None = None) -> list[int]:
+        """
+        Pop up to `batch_size` credentials that should be refreshed by `now`
+        """
+        now = now or datetime.now()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+                refresh_at, credentials_id = heapq.heappop(self._heap)
+                if self._scheduled.get(credentials_id) == refresh_at:
+                    del self._scheduled[credentials_id]
+                    due.append(credentials_id)
+        return due
+
+    def refresh_due(self, db: Session, now: datetime | None = None) -> int:
+        """
+        Refresh one batch of due tokens, committing them together
+
+        Returns:
+            int: the number of tokens refreshed
+        """
+        now = now or datetime.now()
+        refreshed = 0
+        for credentials_id in self.due(now):
+            credentials = db.get(GmailCredentials, credentials_id)
+            if credentials is None:
+                continue
+            try:
+                credentials.update_token()
+                refreshed += 1
+                self.schedule(credentials.id, credentials.token_expiry)
+            except RefreshError as e:
+                if "invalid_grant" not in str(e):
+                    logger.error(f"Error refreshing token for credentials {credentials_id}: {e}")
+                    self.schedule(credentials_id, now + timedelta(seconds=self.lead_seconds + self.retry_seconds))
+                    continue
+                # Revoked or expired for good, retrying never succeeds
+                self.disconnect(db, credentials)
+            except Exception as e:
+                logger.error(f"Error refreshing token for credentials {credentials_id}: {e}")
+                self.schedule(credentials_id, now + timedelta(seconds=self.lead_seconds + self.retry_seconds))
+        db.commit()
+        if refreshed:
+            logger.info(f"Refreshed {refreshed} Gmail tokens")
+        return refreshed
+
+    @staticmethod
+    def disconnect(db: Session, credentials: GmailCredentials):
+        """
+        Mark the user as no longer Google authenticated after their refresh token
+        was revoked, unless they have authenticated again since. They are then
+        neither polled nor refreshed until they reconnect Gmail.
+        """
+        newer = db.query(GmailCredentials.id).filter(
+            GmailCredentials.user_id == credentials.user_id,
+            GmailCredentials.id > credentials.id
+        ).first()
+        if newer is not None:
+            return
+        logger.warning(f"Refresh token of user {credentials.user_id} was revoked, disconnecting Gmail")
+        db.query(User).filter(User.id == credentials.user_id).update({"is_google_authenticated": False})
+
+    def run(self, owner: str | None = None):
+        """
+        Args:
+            owner: the worker process running the thread. When set, tokens are
+                only refreshed while it holds the token refresh lease, so one
+                worker in the fleet refreshes each token.
+        """
+        thread_name = threading.current_thread().name
+        logger.info(f"Starting token refresh thread: {thread_name}")
+        last_load = None
+        leading = owner is None
+        lease_seconds = settings.TOKEN_REFRESH_INTERVAL_SECONDS + settings.POLL_JOB_LEASE_SECONDS
+        while True:
+            db = SessionLocal()
+            try:
+                if owner is not None:
+                    held = acquire_service_lease(db, "token_refresh", owner, lease_seconds)
+                    if held and not leading:
+                        # Another worker refreshed tokens meanwhile, start from what is stored
+                        logger.info(f"Took the token refresh lease: {owner}")
+                        self.reset()
+                        last_load = None
+                    leading = held
+                # Reload periodically to pick up new and re-authenticated credentials
+                if leading and (last_load is None or time.monotonic() - last_load >= settings.TOKEN_REFRESH_RELOAD_SECONDS):
+                    self.load(db)
+                    last_load = time.monotonic()
+                # Keep going while whole batches are due, then wait for the next tick
+                while leading and self.refresh_due(db) == self.batch_size:
+                    pass
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Error in token refresh thread: {e}")
+            finally:
+                db.close()
+            time.sleep(settings.TOKEN_REFRESH_INTERVAL_SECONDS)
+
+
+token_refresh_scheduler = TokenRefreshScheduler(
+    lead_seconds=settings.TOKEN_REFRESH_LEAD_SECONDS,
+    batch_size=settings.TOKEN_REFRESH_BATCH_SIZE
+)
+
+def start_token_refresh_thread(owner: str | None = None):
+    """Start and return the token refresh thread, see TokenRefreshScheduler.run"""
+    refresh_thread = threading.Thread(target=token_refresh_scheduler.run, args=(owner,), name="TokenRefreshThread", daemon=True)
+    refresh_thread.start()
+    return refresh_thread
@@ -0,0 +1,203 @@
+"""
+standalone polling worker, run any number of them with `python -m app.worker`
+
+Each worker claims per-user poll jobs from the database queue with a lease it
+keeps alive by heartbeat, so workers on any number of processes or machines
+share the userbase without two of them polling the same mailbox at once.
+"""
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from app.config import settings
+from app.models import SessionLocal, create_database
+from app.ai_agents.prefilter import prefilter
+from app.ai_agents.prompt import prompt_builder
+from app.ai_agents.response_cache import response_cache
+from app.ai_agents.task_identifier import llm_stats
+from app.message_service.gmail_service import gmail_stats
+from app.services.gmail_polling import run_user_poll
+from app.services.gmail_push import start_watch_renewal_thread
+from app.services.job_queue import sync_jobs, claim_jobs, heartbeat, complete_job, acquire_service_lease
+from app.services.message_ledger import compact_ledger
+from app.services.pipeline import get_pipeline
+from app.services.token_refresh import start_token_refresh_thread
+
+logger = logging.getLogger(__name__)
+
+
+class PollWorker:
+    def __init__(
+        self,
+        owner: str | None = None,
+        concurrency: int | None = None,
+        lease_seconds: float | None = None,
+        heartbeat_seconds: float | None = None
+    ):
+        """
+        Args:
+            owner: identifies this worker's leases, unique per process by default
+            concurrency: the most jobs polled at once, POLLING_WORKERS by default
+            lease_seconds: how long a claimed job is held without a heartbeat
+            heartbeat_seconds: how often the leases of running jobs are extended
+        """
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.concurrency = concurrency or settings.POLLING_WORKERS
+        self.lease_seconds = lease_seconds or settings.POLL_JOB_LEASE_SECONDS
+        self.heartbeat_seconds = heartbeat_seconds or settings.POLL_JOB_HEARTBEAT_SECONDS
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="PollWorker")
+        # The claim time of each job this worker is polling
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._last_compaction = None
+
+    def claim(self) -> int:
+        """
+        Claim as many due jobs as there are free workers and start polling them
+
+        Returns:
+            int: the number of jobs claimed
+        """
+        with self._lock:
+            free = self.concurrency - len(self._jobs)
+        if free <= 0 or self._stopping.is_set():
+            return 0
+        db = SessionLocal()
+        try:
+            claimed_at = datetime.now()
+            claimed = claim_jobs(db, self.owner, free, self.lease_seconds, claimed_at)
+        finally:
+            db.close()
+        for job_id, user_id in claimed:
+            with self._lock:
+                self._jobs[job_id] = claimed_at
+            self._executor.submit(self._poll, job_id, user_id, claimed_at)
+        return len(claimed)
+
+    def _poll(self, job_id: int, user_id: int, claimed_at: datetime):
+        created, retry_after = 0, None
+        try:
+            created, retry_after = run_user_poll(user_id)
+        finally:
+            db = SessionLocal()
+            try:
+                complete_job(db, self.owner, job_id, created, retry_after, claimed_at)
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Error completing poll job {job_id}: {e}")
+            finally:
+                db.close()
+            with self._lock:
+                self._jobs.pop(job_id, None)
+            self._wakeup.set()
+
+    def heartbeat(self) -> int:
+        """
+        Extend the leases of the running jobs
+
+        Returns:
+            int: the number of leases extended
+        """
+        with self._lock:
+            job_ids = list(self._jobs)
+        if not job_ids:
+            return 0
+        db = SessionLocal()
+        try:
+            extended = heartbeat(db, self.owner, job_ids, self.lease_seconds)
+        finally:
+            db.close()
+        lost = set(job_ids) - extended
+        if lost:
+            # The ledger's unique constraint stops a job polled twice creating tasks twice
+            logger.warning(f"Lost the lease on poll jobs {sorted(lost)}")
+        return len(extended)
+
+    def _run_heartbeat(self):
+        while not self._stopping.wait(self.heartbeat_seconds):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logger.error(f"Error in poll job heartbeat: {e}")
+
+    def _maintain(self):
+        db = SessionLocal()
+        try:
+            created, removed = sync_jobs(db)
+            if created or removed:
+                logger.info(f"Created {created} and removed {removed} poll jobs")
+            if self._last_compaction is None or time.monotonic() - self._last_compaction >= settings.LEDGER_COMPACTION_INTERVAL_SECONDS:
+                self._last_compaction = time.monotonic()
+                # One worker compacts for the whole fleet. The lease outlives the
+                # interval, so its holder keeps it until it stops compacting
+                lease_seconds = 2 * settings.LEDGER_COMPACTION_INTERVAL_SECONDS
+                if acquire_service_lease(db, "ledger_compaction", self.owner, lease_seconds):
+                    compact_ledger(db)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error maintaining poll jobs: {e}")
+        finally:
+            db.close()
+        logger.info(f"Pipeline stats: {get_pipeline().stats()}")
+        logger.info(f"Gmail fetch stats: {gmail_stats.take()}")
+        logger.info(f"Pre-filter stats: {dict(prefilter.stats)}")
+        logger.info(f"Prompt stats: {dict(prompt_builder.stats)}")
+        logger.info(f"LLM stats: {llm_stats.snapshot()}")
+        logger.info(f"Response cache stats: {response_cache.stats()}")
+        try:
+            prefilter.save()
+        except Exception as e:
+            logger.error(f"Error saving pre-filter model: {e}")
+
+    def run(self):
+        logger.info(f"Starting poll worker {self.owner}")
+        threading.Thread(target=self._run_heartbeat, name="PollJobHeartbeat", daemon=True).start()
+        last_maintenance = None
+        while not self._stopping.is_set():
+            if last_maintenance is None or time.monotonic() - last_maintenance >= settings.POLLING_USER_RELOAD_SECONDS:
+                self._maintain()
+                last_maintenance = time.monotonic()
+            try:
+                claimed = self.claim()
+            except Exception as e:
+                logger.error(f"Error claiming poll jobs: {e}")
+                claimed = 0
+            # Claim again straight away while there is work, otherwise wait for
+            # a job to finish or for the next check of the queue
+            if not claimed:
+                self._wakeup.wait(settings.POLL_JOB_CLAIM_INTERVAL_SECONDS)
+                self._wakeup.clear()
+        logger.info(f"Stopping poll worker {self.owner}, waiting for {len(self._jobs)} running jobs")
+        self._executor.shutdown(wait=True)
+
+    def stop(self, *args):
+        self._stopping.set()
+        self._wakeup.set()
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    create_database()
+    worker = PollWorker()
+    # Every worker runs these threads, but only the holder of each lease does the work
+    start_token_refresh_thread(worker.owner)
+    if settings.GMAIL_PUSH_TOPIC:
+        start_watch_renewal_thread(worker.owner)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import json
+import os
+import random
+import tempfile
+import unittest
+from unittest.mock import patch
+from google.oauth2.credentials import Credentials
+from sqlalchemy.orm import sessionmaker
+from app.config import settings
+from app.database import create_db_engine
+from app.models import Base, User, GmailCredentials, Task, ProcessedMessage
+from app.ai_agents.response_cache import ResponseCache
+from app.ai_agents.task_identifier import TaskIdentifier
+from app.fakes.gmail import FakeGmail, synthetic_message
+from app.fakes.mistral import FakeMistral, RecordingMistral
+from app.message_service.client_cache import gmail_clients
+from app.message_service.gmail_service import GmailService
+from app.message_service.models import Message
+from app.rate_limiter import RateLimiter
+from app.services import gmail_polling, pipeline
+
+
+class TestFakeGmail(unittest.TestCase):
+    def setUp(self):
+        self.gmail = FakeGmail(seed=1)
+        installed = self.gmail.install()
+        installed.__enter__()
+        self.addCleanup(installed.__exit__, None, None, None)
+
+    def service(self, token: str = "token") -> GmailService:
+        return GmailService(Credentials(token=token), user_key=token)
+
+    def test_resync_then_history_sync(self):
+        first = self.gmail.populate("token", 5, {"task": 1})
+        service = self.service()
+
+        message_ids, history_id = service.sync_message_ids(None)
+        self.assertEqual(sorted(message_ids), sorted(first))
+        self.assertEqual(history_id, "1005")
+
+        second = self.gmail.populate("token", 2, {"task": 1})
+        self.assertEqual(service.sync_message_ids(history_id), (second, "1007"))
+
+    def test_expired_history_resyncs(self):
+        self.gmail.populate("token", 3, {"task": 1})
+        self.gmail.mailbox("token").expire_history()
+
+        message_ids, history_id = self.service().sync_message_ids("1001")
+
+        self.assertEqual(len(message_ids), 3)
+        self.assertEqual(history_id, "1003")
+
+    def test_fetch_messages_filters_categories_and_lists_attachments(self):
+        self.gmail.populate("token", 4, {"attachment": 1})
+        self.gmail.populate("token", 2, {"promotion": 1})
+        service = self.service()
+
+        messages = service._get_messages(list(self.gmail.mailbox("token").messages))
+
+        self.assertEqual(len(messages), 4)
+        self.assertTrue(all(len(message.attachments) == 1 for message in messages))
+        self.assertTrue(all(message.attachments[0].data is None for message in messages))
+        # Metadata, then structure, and no batch for the attachment data
+        self.assertEqual(self.gmail.stats["batches"], 2)
+
+    def test_metadata_is_a_partial_response(self):
+        message, _ = synthetic_message(random.Random(0), "m1", "newsletter")
+        self.gmail.mailbox("token").deliver(message)
+        subject = next(header for header in message["payload"]["headers"] if header["name"] == "Subject")
+
+        users = self.service().service.users()
+        response = users.messages().get(userId="me", id="m1", format="metadata", metadataHeaders=["Subject"], fields="id,payload(headers)").execute()
+
+        self.assertEqual(response, {"id": "m1", "payload": {"headers": [subject]}})
+
+    def test_quota_is_retried_after_retry_after(self):
+        self.gmail.populate("token", 1, {"task": 1})
+        service = self.service()
+        self.gmail.faults.quota = 1
+
+        message_ids, _ = service.sync_message_ids(None)
+
+        self.assertEqual(len(message_ids), 1)
+        self.assertGreaterEqual(self.gmail.faults.stats["rate_limited"], 1)
+
+
+class TestFakeMistral(unittest.TestCase):
+    def setUp(self):
+        patcher = patch('app.ai_agents.task_identifier.mistral_limiter', RateLimiter("mistral", 1000))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.messages = [
+            Message(id="1", subject="Q4 Report Draft Review", sender="finance@company.com", body="Please review the Q4 report by 2025-01-25.", attachments=[]),
+            Message(id="2", subject="Holiday Sale", sender="offers@shop.example.com", body="25% off everything, unsubscribe here.", attachments=[]),
+            Message(id="3", subject="Team Meeting Notes", sender="teammate@company.com", body="Action items: Alice to book the venue; Bob to draft the budget", attachments=[]),
+        ]
+
+    def test_cascade_extracts_every_task(self):
+        mistral = FakeMistral()
+        with mistral.install():
+            tasks = TaskIdentifier(cache=ResponseCache()).get_tasks(self.messages)
+
+        self.assertEqual([task.title for task in tasks[0]], ["Q4 Report Draft Review"])
+        self.assertEqual(str(tasks[0][0].due_date), "2025-01-25")
+        self.assertEqual(tasks[1], [])
+        self.assertEqual([task.title for task in tasks[2]], ["Alice to book the venue", "Bob to draft the budget"])
+        self.assertEqual(mistral.stats["BatchTaskTriage_completions"], 1)
+
+    def test_quota_is_retried(self):
+        mistral = FakeMistral(quota=1)
+        with mistral.install():
+            identifier = TaskIdentifier(cache=ResponseCache(), cascade=False)
+            self.assertEqual(len(identifier.get_tasks(self.messages[:1])[0]), 1)
+            self.assertEqual(len(identifier.get_tasks(self.messages[2:])[0]), 2)
+
+        self.assertEqual(mistral.faults.stats["rate_limited"], 1)
+
+    def test_recorded_completions_are_replayed(self):
+        recorder = RecordingMistral(FakeMistral())
+        with recorder.install():
+            TaskIdentifier(cache=ResponseCache()).get_tasks(self.messages)
+        # Change one recorded completion so the replay is visible
+        key = next(key for key, response in recorder.responses.items() if "Alice" in response)
+        response = json.loads(recorder.responses[key])
+        for result in response["results"]:
+            if "Alice" in json.dumps(result):
+                result["tasks"] = [{"title": "Recorded", "due_date": None, "description": "Recorded"}]
+        recorder.responses[key] = json.dumps(response)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "recording.json")
+            recorder.save(path)
+            mistral = FakeMistral(recording=path)
+
+        with mistral.install():
+            tasks = TaskIdentifier(cache=ResponseCache()).get_tasks(self.messages)
+
+        self.assertEqual([task.title for task in tasks[2]], ["Recorded"])
+        self.assertEqual(mistral.stats["replayed"], mistral.stats["completions"])
+
+
+class TestPipelineOffline(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.engine = create_db_engine(f"sqlite:///{os.path.join(tmpdir.name, 'offline.db')}")
+        self.addCleanup(self.engine.dispose)
+        Base.metadata.create_all(self.engine)
+        self.TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+
+        db = self.TestingSessionLocal()
+        db.add(User(id=1, email="user1@example.com", password="test_password", is_google_authenticated=True))
+        db.add(GmailCredentials(user_id=1, token="token1", refresh_token="refresh1"))
+        db.commit()
+        db.close()
+
+        self.gmail = FakeGmail(seed=2)
+        self.mistral = FakeMistral(seed=2)
+        patchers = [
+            patch.object(pipeline, 'SessionLocal', self.TestingSessionLocal),
+            patch('app.ai_agents.task_identifier.mistral_limiter', RateLimiter("mistral", 1000)),
+            patch('app.ai_agents.task_identifier.response_cache', ResponseCache()),
+            patch.object(pipeline, '_pipeline', None),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: pipeline._pipeline and pipeline._pipeline.stop())
+        for fake in (self.gmail, self.mistral):
+            installed = fake.install()
+            installed.__enter__()
+            self.addCleanup(installed.__exit__, None, None, None)
+        self.addCleanup(gmail_clients._clients.clear)
+
+    def test_run_user_poll_with_faults(self):
+        self.gmail.populate("token1", 20, {"task": 1})
+        self.gmail.populate("token1", 20, {"fyi": 1})
+        self.mistral.faults.error_rate = 1.0
+
+        # Every completion fails, so the cursor stays put and nothing is recorded
+        self.assertEqual(gmail_polling.run_user_poll(1)[0], 0)
+        db = self.TestingSessionLocal()
+        self.assertEqual(db.query(ProcessedMessage).count(), 0)
+        self.assertIsNone(db.query(GmailCredentials).first().history_id)
+        db.close()
+
+        self.mistral.faults.error_rate = 0.0
+        self.assertEqual(gmail_polling.run_user_poll(1), (20, None))
+        self.gmail.populate("token1", 5, {"meeting": 1})
+        self.assertEqual(gmail_polling.run_user_poll(1), (15, None))
+
+        db = self.TestingSessionLocal()
+        self.assertEqual(db.query(Task).count(), 35)
+        self.assertEqual(db.query(ProcessedMessage).count(), 45)
+        self.assertEqual(db.query(GmailCredentials).first().history_id, "1045")
+        db.close()
+
+    def test_gmail_faults_never_lose_messages(self):
+        self.gmail.populate("token1", 20, {"task": 1})
+        self.gmail.faults.error_rate = 0.3
+
+        # Without retries most polls fail part way, and must leave the cursor behind every message not persisted
+        with patch.object(settings, 'BACKOFF_RETRIES', 0):
+            for _ in range(3):
+                gmail_polling.run_user_poll(1)
+        self.gmail.faults.error_rate = 0.0
+        gmail_polling.run_user_poll(1)
+
+        db = self.TestingSessionLocal()
+        self.assertEqual(db.query(ProcessedMessage).count(), 20)
+        self.assertEqual(db.query(Task).count(), 20)
+        self.assertEqual(db.query(GmailCredentials).first().history_id, "1020")
+        db.close()
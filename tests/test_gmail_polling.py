@@ -0,0 +1,404 @@
+import os
+import tempfile
+import unittest
+import threading
+from unittest.mock import patch, MagicMock, AsyncMock
+from sqlalchemy.orm import sessionmaker
+from datetime import datetime, timedelta
+from app.database import create_db_engine
+from app.models import Base, User, GmailCredentials, Task, ProcessedMessage, MessageFailure
+from app.ai_agents.models import Task as TaskModel
+from app.services import gmail_polling, pipeline
+from app.message_service.client_cache import gmail_clients
+from app.rate_limiter import RateLimitExceeded
+from app.services.message_ledger import compact_ledger
+from app.services.poll_scheduler import PollScheduler
+
+
+def gmail_message(msg_id: str, subject: str) -> dict:
+    """A Gmail message resource as returned by GmailService.fetch_messages"""
+    return {
+        'id': msg_id,
+        'labelIds': ['INBOX', 'UNREAD'],
+        'snippet': f"Body of {subject}",
+        'payload': {
+            'headers': [{'name': 'Subject', 'value': subject}, {'name': 'From', 'value': 'sender@example.com'}],
+            'parts': []
+        }
+    }
+
+
+class TestGmailPolling(unittest.TestCase):
+    def setUp(self):
+        # A database file so every polling worker gets its own connection and transaction
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.engine = create_db_engine(f"sqlite:///{os.path.join(tmpdir.name, 'polling.db')}")
+        self.addCleanup(self.engine.dispose)
+        Base.metadata.create_all(self.engine)
+        self.TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+
+        db = self.TestingSessionLocal()
+        for i in range(1, 4):
+            db.add(User(id=i, email=f"user{i}@example.com", password="test_password", is_google_authenticated=True))
+            db.add(GmailCredentials(user_id=i, token=f"token{i}", refresh_token=f"refresh{i}"))
+        db.add(User(id=4, email="inactive@example.com", password="test_password", is_active=False, is_google_authenticated=True))
+        db.commit()
+        db.close()
+
+        def override_get_db():
+            db = self.TestingSessionLocal()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        # Each user's inbox holds one message by default, and every message has a task
+        self.inboxes = {user_id: [f"msg{user_id}"] for user_id in range(1, 4)}
+        self.sync = lambda user_id, history_id: (self.inboxes.get(user_id, []), "1000")
+        self.classify = lambda message: [TaskModel(title=f"Task for {message.subject}", description="Test Description")]
+        self.tokens = []
+
+        def gmail_service(credentials, user_key, verify):
+            user_id = int(user_key)
+            self.tokens.append(credentials.token)
+            service = MagicMock()
+            service.sync_message_ids.side_effect = lambda history_id, **kwargs: self.sync(user_id, history_id)
+            service.fetch_messages.side_effect = lambda ids: [gmail_message(msg_id, f"{user_id}/{msg_id}") for msg_id in ids]
+            return service
+
+        self.mock_task_identifier = MagicMock()
+        self.mock_task_identifier.return_value.get_tasks_async = AsyncMock(
+            side_effect=lambda messages: [self.classify(message) for message in messages]
+        )
+
+        patchers = [
+            patch.object(gmail_polling, 'SessionLocal', self.TestingSessionLocal),
+            patch.object(gmail_polling, 'get_db', override_get_db),
+            patch.object(pipeline, 'SessionLocal', self.TestingSessionLocal),
+            patch.object(pipeline, 'TaskIdentifier', self.mock_task_identifier),
+            patch('app.message_service.client_cache.GmailService', side_effect=gmail_service),
+            # A pipeline of its own, whose classify workers build their TaskIdentifier from the mock
+            patch.object(pipeline, '_pipeline', None),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(gmail_clients._clients.clear)
+        self.addCleanup(lambda: pipeline._pipeline and pipeline._pipeline.stop())
+
+    def tearDown(self):
+        Base.metadata.drop_all(bind=self.engine)
+
+    def wait_for_idle(self):
+        while gmail_polling._in_flight:
+            threading.Event().wait(0.01)
+
+    def test_poll_userbase_creates_tasks_for_active_users(self):
+        gmail_polling.poll_userbase()
+
+        db = self.TestingSessionLocal()
+        tasks = db.query(Task).order_by(Task.user_id).all()
+        self.assertEqual([task.user_id for task in tasks], [1, 2, 3])
+        self.assertEqual(tasks[0].title, "Task for 1/msg1")
+        db.close()
+
+    def test_poll_userbase_isolates_failing_user(self):
+        def sync(user_id, history_id):
+            if user_id == 2:
+                raise Exception("Gmail API error")
+            return self.inboxes[user_id], "1000"
+        self.sync = sync
+
+        gmail_polling.poll_userbase()
+
+        db = self.TestingSessionLocal()
+        self.assertEqual(sorted(task.user_id for task in db.query(Task).all()), [1, 3])
+        db.close()
+
+    def test_poll_userbase_skips_users_still_in_flight(self):
+        release = threading.Event()
+        polled = []
+
+        def sync(user_id, history_id):
+            polled.append(user_id)
+            if user_id == 1:
+                release.wait(5)
+            return [], history_id
+        self.sync = sync
+
+        # User 1 blocks past the cycle timeout, so the next cycle must not poll it again
+        gmail_polling.poll_userbase(timeout=0.5)
+        gmail_polling.poll_userbase(timeout=0.5)
+        polled = list(polled)
+        release.set()
+        self.wait_for_idle()
+
+        self.assertEqual(polled.count(1), 1)
+        self.assertEqual(polled.count(2), 2)
+
+    def test_poll_userbase_defers_rate_limited_user(self):
+        polled = []
+
+        def sync(user_id, history_id):
+            polled.append(user_id)
+            if user_id == 2:
+                raise RateLimitExceeded("gmail", 60)
+            return [], history_id
+        self.sync = sync
+        self.addCleanup(gmail_polling._deferred_until.clear)
+
+        gmail_polling.poll_userbase()
+        gmail_polling.poll_userbase()
+
+        self.assertEqual(len(polled), 5)
+        self.assertIn(2, gmail_polling._deferred_until)
+
+    def test_request_poll_repolls_user_notified_while_in_flight(self):
+        release = threading.Event()
+        polled = []
+
+        def sync(user_id, history_id):
+            polled.append(user_id)
+            release.wait(5)
+            return [], history_id
+        self.sync = sync
+
+        self.assertTrue(gmail_polling.request_poll(1))
+        self.assertFalse(gmail_polling.request_poll(1))
+        release.set()
+        while len(polled) < 2 or gmail_polling._in_flight:
+            threading.Event().wait(0.01)
+
+        self.assertEqual(polled, [1, 1])
+
+    def test_dispatch_due_users_respects_concurrency_cap(self):
+        release = threading.Event()
+        self.sync = lambda user_id, history_id: release.wait(5) and ([], history_id)
+        scheduler = PollScheduler(min_interval=10, max_concurrency=2)
+        scheduler.sync([1, 2, 3], now=1000.0)
+        patcher = patch.object(gmail_polling, 'poll_scheduler', scheduler)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.assertEqual(gmail_polling.dispatch_due_users(now=1010.0), 2)
+        self.assertEqual(gmail_polling.dispatch_due_users(now=1010.0), 0)
+        release.set()
+        self.wait_for_idle()
+
+        # The two polled users are rescheduled with a backed off interval, the third is still due
+        self.assertEqual(len(scheduler.due(1010.0)), 1)
+        self.assertEqual(sorted(scheduler.interval(user_id) for user_id in [1, 2, 3]), [10, 20, 20])
+
+    def test_poll_userbase_uses_latest_credentials(self):
+        db = self.TestingSessionLocal()
+        db.add(GmailCredentials(user_id=1, token="newer_token", refresh_token="newer_refresh"))
+        db.commit()
+        db.close()
+
+        gmail_polling.poll_userbase()
+
+        self.assertEqual(sorted(self.tokens), ["newer_token", "token2", "token3"])
+
+    def test_poll_userbase_bulk_inserts_many_tasks(self):
+        self.inboxes = {user_id: [f"msg{i}" for i in range(100)] for user_id in range(1, 4)}
+        self.classify = lambda message: [TaskModel(title=message.subject, description="Test Description")] if message.id[-1] in "13579" else []
+
+        gmail_polling.poll_userbase()
+
+        db = self.TestingSessionLocal()
+        self.assertEqual(db.query(Task).count(), 150)
+        self.assertEqual(db.query(ProcessedMessage).count(), 300)
+        db.close()
+
+    def test_poll_user_never_classifies_a_message_twice(self):
+        self.inboxes = {1: ["msg1"]}
+
+        gmail_polling.poll_user(1)
+        gmail_polling.poll_user(1)
+
+        self.mock_task_identifier.return_value.get_tasks_async.assert_awaited_once()
+        db = self.TestingSessionLocal()
+        self.assertEqual(db.query(Task).filter(Task.user_id == 1).count(), 1)
+        self.assertEqual(db.query(ProcessedMessage).filter(ProcessedMessage.user_id == 1).count(), 1)
+        self.assertEqual(db.query(GmailCredentials).filter(GmailCredentials.user_id == 1).first().history_id, "1000")
+        db.close()
+
+    def test_poll_user_records_messages_without_tasks(self):
+        self.inboxes = {1: ["msg1"]}
+        self.classify = lambda message: []
+
+        gmail_polling.poll_user(1)
+        gmail_polling.poll_user(1)
+
+        self.mock_task_identifier.return_value.get_tasks_async.assert_awaited_once()
+
+    def test_poll_user_keeps_cursor_when_classification_fails(self):
+        self.inboxes = {1: ["msg1", "msg2"]}
+
+        def classify(message):
+            if message.id == "msg2":
+                raise RateLimitExceeded("mistral", 30)
+            return [TaskModel(title=message.subject, description="Test Description")]
+        self.mock_task_identifier.return_value.get_tasks_async.side_effect = lambda messages: [classify(message) for message in messages]
+        self.addCleanup(gmail_polling._deferred_until.clear)
+
+        self.assertEqual(gmail_polling.run_user_poll(1), (0, 30))
+
+        db = self.TestingSessionLocal()
+        self.assertIsNone(db.query(GmailCredentials).filter(GmailCredentials.user_id == 1).first().history_id)
+        db.close()
+
+    def test_poll_user_fails_run_when_prefilter_raises(self):
+        self.inboxes = {1: ["msg1", "msg2"]}
+
+        with patch.object(pipeline.prefilter, 'should_skip', side_effect=Exception("pre-filter error")):
+            self.assertEqual(gmail_polling.run_user_poll(1), (0, None))
+
+        db = self.TestingSessionLocal()
+        self.assertIsNone(db.query(GmailCredentials).filter(GmailCredentials.user_id == 1).first().history_id)
+        db.close()
+
+    def test_message_that_keeps_failing_is_dead_lettered(self):
+        self.inboxes = {1: ["msg1", "msg2"]}
+
+        def classify(message):
+            if message.id == "msg2":
+                raise ValueError("request rejected")
+            return [TaskModel(title=message.subject, description="Test Description")]
+        self.classify = classify
+
+        with patch.object(gmail_polling.settings, 'PIPELINE_MAX_MESSAGE_FAILURES', 2):
+            # The batch is retried a message at a time, so msg1 is persisted and only msg2 fails
+            self.assertEqual(gmail_polling.run_user_poll(1), (1, None))
+            db = self.TestingSessionLocal()
+            self.assertIsNone(db.query(GmailCredentials).filter(GmailCredentials.user_id == 1).first().history_id)
+            db.close()
+
+            # Its second failure dead letters it, so the cursor moves on
+            self.assertEqual(gmail_polling.run_user_poll(1), (0, None))
+            self.assertEqual(gmail_polling.run_user_poll(1), (0, None))
+
+        db = self.TestingSessionLocal()
+        self.assertEqual(db.query(GmailCredentials).filter(GmailCredentials.user_id == 1).first().history_id, "1000")
+        self.assertEqual(sorted(entry.message_id for entry in db.query(ProcessedMessage).all()), ["msg1", "msg2"])
+        failure = db.query(MessageFailure).one()
+        self.assertEqual((failure.message_id, failure.failures, failure.last_error), ("msg2", 2, "ValueError: request rejected"))
+        db.close()
+
+    def test_transient_failures_are_not_counted(self):
+        self.inboxes = {1: ["msg1"]}
+
+        def classify(message):
+            raise TimeoutError("request timed out")
+        self.classify = classify
+
+        with patch.object(gmail_polling.settings, 'PIPELINE_MAX_MESSAGE_FAILURES', 1):
+            self.assertEqual(gmail_polling.run_user_poll(1), (0, None))
+
+        db = self.TestingSessionLocal()
+        self.assertEqual(db.query(MessageFailure).count(), 0)
+        self.assertEqual(db.query(ProcessedMessage).count(), 0)
+        self.assertIsNone(db.query(GmailCredentials).filter(GmailCredentials.user_id == 1).first().history_id)
+        db.close()
+
+    def test_run_user_poll_times_out(self):
+        release = threading.Event()
+        self.sync = lambda user_id, history_id: release.wait(5) and (self.inboxes[user_id], "1000")
+
+        with patch.object(gmail_polling.settings, 'PIPELINE_RUN_TIMEOUT_SECONDS', 0.2):
+            self.assertEqual(gmail_polling.run_user_poll(1), (0, None))
+        release.set()
+        while pipeline.get_pipeline()._runs:
+            threading.Event().wait(0.01)
+
+        # The cancelled run never fetches, classifies or saves its cursor
+        self.mock_task_identifier.return_value.get_tasks_async.assert_not_awaited()
+        db = self.TestingSessionLocal()
+        self.assertEqual(db.query(ProcessedMessage).count(), 0)
+        self.assertIsNone(db.query(GmailCredentials).filter(GmailCredentials.user_id == 1).first().history_id)
+        db.close()
+
+    def test_timed_out_run_holds_the_user_until_it_drains(self):
+        self.inboxes = {1: ["msg1"]}
+
+        def classify(message):
+            threading.Event().wait(0.3)
+            return [TaskModel(title=message.subject, description="Test Description")]
+        self.classify = classify
+
+        with patch.object(gmail_polling.settings, 'PIPELINE_RUN_TIMEOUT_SECONDS', 0.2):
+            self.assertEqual(gmail_polling.run_user_poll(1), (0, None))
+
+        # The classification under way finished before the poll returned, and its result was dropped
+        self.assertEqual(pipeline.get_pipeline()._runs, {})
+        db = self.TestingSessionLocal()
+        self.assertEqual(db.query(ProcessedMessage).count(), 0)
+        db.close()
+        # So the next poll classifies the message once and persists it
+        self.assertEqual(gmail_polling.run_user_poll(1), (1, None))
+
+    def test_poll_user_persists_every_task_in_a_message(self):
+        self.inboxes = {1: ["minutes"]}
+        self.classify = lambda message: [
+            TaskModel(title=f"Action item {i}", description="Test Description") for i in range(5)
+        ]
+
+        self.assertEqual(gmail_polling.run_user_poll(1), (5, None))
+
+        db = self.TestingSessionLocal()
+        self.assertEqual(db.query(Task).filter(Task.user_id == 1).count(), 5)
+        self.assertEqual(db.query(ProcessedMessage).filter(ProcessedMessage.user_id == 1).count(), 1)
+        db.close()
+
+    def test_classify_workers_reuse_their_task_identifier(self):
+        self.inboxes = {user_id: [f"msg{i}" for i in range(20)] for user_id in range(1, 4)}
+
+        gmail_polling.poll_userbase()
+        self.inboxes = {user_id: [f"new{i}" for i in range(20)] for user_id in range(1, 4)}
+        gmail_polling.poll_userbase()
+
+        self.assertLessEqual(self.mock_task_identifier.call_count, pipeline.get_pipeline().classify.workers)
+        self.assertGreater(self.mock_task_identifier.return_value.get_tasks_async.await_count, 1)
+
+    def test_pipeline_stats(self):
+        gmail_polling.run_user_poll(1)
+
+        stats = pipeline.get_pipeline().stats()
+        self.assertEqual(set(stats), {"fetch", "parse", "prefilter", "classify", "persist", "outstanding"})
+        self.assertEqual(stats["fetch"]["queue_depth"], 0)
+        self.assertGreaterEqual(stats["persist"]["processed"], 1)
+
+    def test_compact_ledger(self):
+        db = self.TestingSessionLocal()
+        db.add(ProcessedMessage(user_id=1, message_id="old", processed_at=datetime.now() - timedelta(days=31)))
+        db.add(ProcessedMessage(user_id=1, message_id="new", processed_at=datetime.now()))
+        db.add(MessageFailure(user_id=1, message_id="old", failures=3, failed_at=datetime.now() - timedelta(days=31)))
+        db.commit()
+
+        self.assertEqual(compact_ledger(db, retention_days=30), 1)
+        self.assertEqual([entry.message_id for entry in db.query(ProcessedMessage).all()], ["new"])
+        self.assertEqual(db.query(MessageFailure).count(), 0)
+        db.close()
+
+
+class TestIngestPipeline(unittest.TestCase):
+    def test_full_queue_blocks_the_stage_feeding_it(self):
+        release = threading.Event()
+        handled = []
+        downstream = pipeline.Stage("slow", lambda items: release.wait(5) and handled.extend(items), workers=1, queue_size=1)
+        upstream = pipeline.Stage("fast", lambda items: [downstream.put(item) for item in items], workers=1, queue_size=10)
+        downstream.start()
+        upstream.start()
+
+        for i in range(5):
+            upstream.put(i)
+        threading.Event().wait(0.2)
+        # One item is being handled, one waits in the full queue and upstream is blocked on the next
+        self.assertEqual(downstream.stats()["queue_depth"], 1)
+        self.assertEqual(upstream.stats()["busy"], 1)
+
+        release.set()
+        upstream.stop()
+        downstream.stop()
+        self.assertEqual(handled, [0, 1, 2, 3, 4])
@@ -0,0 +1,158 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock, AsyncMock
+from datetime import datetime, timedelta
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from app.models import Base, User, GmailCredentials, get_async_db
+from app.api.routes.integrations.google import router as google_router
+from app.message_service.client_cache import gmail_clients
+from app.services.gmail_push import LocalPublisher, decode_push_notification, make_push_envelope, renew_watches
+
+
+class TestPushRoute(unittest.TestCase):
+    def setUp(self):
+        self.app = FastAPI()
+        self.app.include_router(google_router)
+        self.publisher = LocalPublisher(TestClient(self.app), token="secret")
+
+        self.mock_db = MagicMock(spec=AsyncSession)
+        self.set_user(SimpleNamespace(id=1, history_id="1000"))
+        self.app.dependency_overrides[get_async_db] = lambda: self.mock_db
+
+        patcher = patch('app.api.routes.integrations.google.settings')
+        self.mock_settings = patcher.start()
+        self.mock_settings.GMAIL_PUSH_TOKEN = "secret"
+        self.mock_settings.GMAIL_PUSH_AUDIENCE = None
+        self.addCleanup(patcher.stop)
+
+    def set_user(self, user):
+        execute_result = MagicMock()
+        execute_result.first.return_value = user
+        self.mock_db.execute = AsyncMock(return_value=execute_result)
+
+    @patch('app.api.routes.integrations.google.request_poll')
+    def test_push_polls_notified_user(self, mock_request_poll):
+        response = self.publisher.publish("user@example.com", "1001")
+
+        self.assertEqual(response.status_code, 204)
+        mock_request_poll.assert_called_once_with(1)
+
+    @patch('app.api.routes.integrations.google.request_poll')
+    def test_push_skips_already_synced_history(self, mock_request_poll):
+        response = self.publisher.publish("user@example.com", "1000")
+
+        self.assertEqual(response.status_code, 204)
+        mock_request_poll.assert_not_called()
+
+    @patch('app.api.routes.integrations.google.request_poll')
+    def test_push_acknowledges_unknown_mailbox(self, mock_request_poll):
+        self.set_user(None)
+
+        response = self.publisher.publish("unknown@example.com", "1001")
+
+        self.assertEqual(response.status_code, 204)
+        mock_request_poll.assert_not_called()
+
+    @patch('app.api.routes.integrations.google.request_poll')
+    def test_push_rejects_invalid_token(self, mock_request_poll):
+        response = LocalPublisher(self.publisher.client, token="wrong").publish("user@example.com", "1001")
+
+        self.assertEqual(response.status_code, 403)
+        mock_request_poll.assert_not_called()
+
+    @patch('app.api.routes.integrations.google.request_poll')
+    def test_push_rejected_without_configured_token(self, mock_request_poll):
+        self.mock_settings.GMAIL_PUSH_TOKEN = None
+
+        response = LocalPublisher(self.publisher.client, token="").publish("user@example.com", "1001")
+
+        self.assertEqual(response.status_code, 403)
+        mock_request_poll.assert_not_called()
+
+    @patch('app.services.gmail_push.settings')
+    @patch('app.services.gmail_push.id_token.verify_oauth2_token')
+    @patch('app.api.routes.integrations.google.request_poll')
+    def test_push_verifies_oidc_token(self, mock_request_poll, mock_verify, mock_push_settings):
+        self.mock_settings.GMAIL_PUSH_AUDIENCE = "https://example.com/integrations/google/push"
+        mock_push_settings.GMAIL_PUSH_AUDIENCE = self.mock_settings.GMAIL_PUSH_AUDIENCE
+        mock_push_settings.GMAIL_PUSH_SERVICE_ACCOUNT = "push@project.iam.gserviceaccount.com"
+        mock_verify.return_value = {"email": "push@project.iam.gserviceaccount.com", "email_verified": True}
+        envelope = make_push_envelope("user@example.com", "1001")
+
+        unsigned = self.publisher.client.post("/integrations/google/push", params={"token": "secret"}, json=envelope)
+        signed = self.publisher.client.post(
+            "/integrations/google/push", params={"token": "secret"}, json=envelope, headers={"Authorization": "Bearer oidc"}
+        )
+        mock_verify.return_value = {"email": "other@project.iam.gserviceaccount.com", "email_verified": True}
+        other = self.publisher.client.post(
+            "/integrations/google/push", params={"token": "secret"}, json=envelope, headers={"Authorization": "Bearer oidc"}
+        )
+
+        self.assertEqual([unsigned.status_code, signed.status_code, other.status_code], [403, 204, 403])
+        self.assertEqual(mock_verify.call_args.kwargs["audience"], "https://example.com/integrations/google/push")
+        mock_request_poll.assert_called_once_with(1)
+
+    @patch('app.api.routes.integrations.google.request_poll')
+    def test_push_marks_job_due_in_worker_mode(self, mock_request_poll):
+        self.mock_settings.POLLING_MODE = "worker"
+
+        response = self.publisher.publish("user@example.com", "1001")
+
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.mock_db.execute.await_count, 2)
+        self.mock_db.commit.assert_awaited_once()
+        mock_request_poll.assert_not_called()
+
+    def test_push_rejects_malformed_notification(self):
+        response = self.publisher.client.post(
+            "/integrations/google/push", params={"token": "secret"}, json={"message": {"data": "not base64 json"}}
+        )
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_decode_push_notification(self):
+        self.assertEqual(decode_push_notification(make_push_envelope("user@example.com", "42")), ("user@example.com", "42"))
+        with self.assertRaises(ValueError):
+            decode_push_notification({"message": {}})
+
+
+class TestWatchRenewal(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite:///:memory:')
+        Base.metadata.create_all(self.engine)
+        self.db = sessionmaker(bind=self.engine)()
+        now = datetime.now()
+        self.db.add(User(id=1, email="new@example.com", password="test_password", is_google_authenticated=True))
+        self.db.add(User(id=2, email="expiring@example.com", password="test_password", is_google_authenticated=True))
+        self.db.add(User(id=3, email="fresh@example.com", password="test_password", is_google_authenticated=True))
+        self.db.add(GmailCredentials(user_id=1, token="token1", refresh_token="refresh1"))
+        self.db.add(GmailCredentials(user_id=2, token="token2", refresh_token="refresh2", watch_expiration=now + timedelta(hours=1)))
+        self.db.add(GmailCredentials(user_id=3, token="token3", refresh_token="refresh3", watch_expiration=now + timedelta(days=6)))
+        self.db.commit()
+        self.addCleanup(gmail_clients._clients.clear)
+
+    def tearDown(self):
+        self.db.close()
+        Base.metadata.drop_all(self.engine)
+
+    @patch('app.message_service.client_cache.GmailService')
+    def test_renew_watches_renews_expiring_watches(self, mock_gmail_service):
+        expiration = datetime.now() + timedelta(days=7)
+        mock_gmail_service.return_value.watch.return_value = {'historyId': '1', 'expiration': str(int(expiration.timestamp() * 1000))}
+
+        self.assertEqual(renew_watches(self.db, topic="projects/test/topics/gmail"), 2)
+
+        self.assertEqual(mock_gmail_service.return_value.watch.call_count, 2)
+        renewed = self.db.query(GmailCredentials).filter(GmailCredentials.user_id.in_([1, 2])).all()
+        for credentials in renewed:
+            self.assertAlmostEqual(credentials.watch_expiration.timestamp(), expiration.timestamp(), delta=1)
+
+    @patch('app.message_service.client_cache.GmailService')
+    def test_renew_watches_isolates_failing_user(self, mock_gmail_service):
+        mock_gmail_service.return_value.watch.side_effect = [Exception("Gmail API error"), {'historyId': '1', 'expiration': '1900000000000'}]
+
+        self.assertEqual(renew_watches(self.db, topic="projects/test/topics/gmail"), 1)
@@ -0,0 +1,138 @@
+import os
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from sqlalchemy.orm import sessionmaker
+from app.database import create_db_engine
+from app.models import Base, User, GmailCredentials, PollJob
+from app.services.job_queue import sync_jobs, claim_jobs, heartbeat, complete_job, mark_due_statement, acquire_service_lease
+from app.worker import PollWorker
+
+
+class TestJobQueue(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.engine = create_db_engine(f"sqlite:///{os.path.join(tmpdir.name, 'jobs.db')}")
+        self.addCleanup(self.engine.dispose)
+        Base.metadata.create_all(self.engine)
+        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        self.db = self.SessionLocal()
+        self.addCleanup(self.db.close)
+        for i in range(1, 4):
+            self.db.add(User(id=i, email=f"user{i}@example.com", password="test_password", is_google_authenticated=True))
+            self.db.add(GmailCredentials(user_id=i, token=f"token{i}", refresh_token=f"refresh{i}"))
+        self.db.add(User(id=4, email="inactive@example.com", password="test_password", is_active=False, is_google_authenticated=True))
+        self.db.commit()
+        sync_jobs(self.db)
+        self.now = datetime.now() + timedelta(seconds=1)
+
+    def test_sync_jobs(self):
+        self.assertEqual(sorted(job.user_id for job in self.db.query(PollJob).all()), [1, 2, 3])
+        self.assertEqual(sync_jobs(self.db), (0, 0))
+
+        self.db.query(User).filter(User.id == 2).update({"is_active": False})
+        self.db.commit()
+        self.assertEqual(sync_jobs(self.db), (0, 1))
+
+    def test_service_lease_is_held_by_one_worker(self):
+        self.assertTrue(acquire_service_lease(self.db, "token_refresh", "worker-a", 60, now=self.now))
+        self.assertFalse(acquire_service_lease(self.db, "token_refresh", "worker-b", 60, now=self.now))
+        # The holder extends it, and another worker takes it once it expires
+        self.assertTrue(acquire_service_lease(self.db, "token_refresh", "worker-a", 60, now=self.now + timedelta(seconds=30)))
+        self.assertFalse(acquire_service_lease(self.db, "token_refresh", "worker-b", 60, now=self.now + timedelta(seconds=60)))
+        self.assertTrue(acquire_service_lease(self.db, "token_refresh", "worker-b", 60, now=self.now + timedelta(seconds=91)))
+        self.assertTrue(acquire_service_lease(self.db, "watch_renewal", "worker-a", 60, now=self.now))
+
+    def test_claims_are_exclusive(self):
+        first = claim_jobs(self.db, "worker-a", 2, now=self.now)
+        second = claim_jobs(self.db, "worker-b", 2, now=self.now)
+
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse({user_id for _, user_id in first} & {user_id for _, user_id in second})
+        self.assertEqual(claim_jobs(self.db, "worker-c", 2, now=self.now), [])
+
+    def test_concurrent_claims_never_share_a_job(self):
+        claimed = []
+
+        def claim(owner):
+            db = self.SessionLocal()
+            try:
+                claimed.extend(claim_jobs(db, owner, 1, now=self.now))
+            finally:
+                db.close()
+        threads = [threading.Thread(target=claim, args=(f"worker-{i}",)) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(user_id for _, user_id in claimed), [1, 2, 3])
+
+    def test_expired_lease_is_reclaimed(self):
+        claim_jobs(self.db, "worker-a", 3, lease_seconds=60, now=self.now)
+
+        self.assertEqual(claim_jobs(self.db, "worker-b", 3, now=self.now + timedelta(seconds=30)), [])
+        self.assertEqual(len(claim_jobs(self.db, "worker-b", 3, now=self.now + timedelta(seconds=61))), 3)
+
+    def test_heartbeat_extends_only_owned_leases(self):
+        (job_id, _), = claim_jobs(self.db, "worker-a", 1, lease_seconds=60, now=self.now)
+
+        self.assertEqual(heartbeat(self.db, "worker-a", [job_id], lease_seconds=60, now=self.now + timedelta(seconds=50)), {job_id})
+        self.assertTrue(claim_jobs(self.db, "worker-b", 1, now=self.now + timedelta(seconds=61)))
+        self.assertEqual(heartbeat(self.db, "worker-b", [job_id]), set())
+
+    def test_complete_job_reschedules_and_releases(self):
+        (job_id, _), = claim_jobs(self.db, "worker-a", 1, now=self.now)
+
+        self.assertTrue(complete_job(self.db, "worker-a", job_id, created=0, claimed_at=self.now, now=self.now))
+        job = self.db.get(PollJob, job_id)
+        self.assertIsNone(job.lease_owner)
+        self.assertGreater(job.due_at, self.now)
+        self.assertFalse(complete_job(self.db, "worker-a", job_id, created=0))
+
+    def test_job_made_due_while_leased_stays_due(self):
+        (job_id, user_id), = claim_jobs(self.db, "worker-a", 1, now=self.now)
+        self.db.execute(mark_due_statement(user_id, now=self.now + timedelta(seconds=5)))
+        self.db.commit()
+
+        complete_job(self.db, "worker-a", job_id, created=0, claimed_at=self.now, now=self.now + timedelta(seconds=10))
+
+        self.assertEqual([claimed for claimed in claim_jobs(self.db, "worker-b", 3, now=self.now + timedelta(seconds=10)) if claimed[0] == job_id], [(job_id, user_id)])
+
+    @patch('app.worker.run_user_poll')
+    def test_worker_polls_claimed_jobs(self, mock_run_user_poll):
+        mock_run_user_poll.return_value = (1, None)
+        patcher = patch('app.worker.SessionLocal', self.SessionLocal)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        worker = PollWorker(owner="worker-a", concurrency=2)
+        self.assertEqual(worker.claim(), 2)
+        worker._executor.shutdown(wait=True)
+
+        self.assertEqual(mock_run_user_poll.call_count, 2)
+        self.db.expire_all()
+        self.assertEqual(self.db.query(PollJob).filter(PollJob.lease_owner != None).count(), 0)
+        self.assertEqual(self.db.query(PollJob).filter(PollJob.last_polled_at != None).count(), 2)
+
+    @patch('app.worker.get_pipeline')
+    @patch('app.worker.compact_ledger')
+    def test_ledger_is_compacted_once_per_interval_across_workers(self, mock_compact_ledger, mock_get_pipeline):
+        patcher = patch('app.worker.SessionLocal', self.SessionLocal)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        workers = [PollWorker(owner="worker-a"), PollWorker(owner="worker-b")]
+        for worker in workers:
+            self.addCleanup(worker._executor.shutdown)
+
+        for _ in range(3):
+            for worker in workers:
+                worker._maintain()
+
+        # Only the first maintenance of the lease holder falls due within the interval
+        self.assertEqual(mock_compact_ledger.call_count, 1)
+
@@ -1,8 +1,8 @@
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.models import User
 from app.api.routes.auth import router as login_router
 
@@ -22,20 +22,17 @@ class TestLoginRoutes(unittest.TestCase):
         self.mock_user = SerializableUser()
         
         # Set up mock db 
-        self.mock_db = MagicMock(spec=Session)
+        self.mock_db = MagicMock(spec=AsyncSession)
         
-        # Set up query chain
-        filter_result = MagicMock()
-        filter_result.first.return_value = self.mock_user
+        # Set up execute result chain
+        execute_result = MagicMock()
+        execute_result.scalars.return_value.first.return_value = self.mock_user
         
-        query_result = MagicMock()
-        query_result.filter.return_value = filter_result
-        
-        self.mock_db.query.return_value = query_result
+        self.mock_db.execute = AsyncMock(return_value=execute_result)
         
         # Override the dependency
-        from app.models import get_db
-        self.app.dependency_overrides[get_db] = lambda: self.mock_db
+        from app.models import get_async_db
+        self.app.dependency_overrides[get_async_db] = lambda: self.mock_db
 
     def test_login_success(self):
         response = self.client.post("/login", json={
@@ -49,13 +46,10 @@ class TestLoginRoutes(unittest.TestCase):
 
     def test_login_invalid_credentials(self):
         # Change mock to return None for this test
-        filter_result = MagicMock()
-        filter_result.first.return_value = None
-        
-        query_result = MagicMock()
-        query_result.filter.return_value = filter_result
+        execute_result = MagicMock()
+        execute_result.scalars.return_value.first.return_value = None
         
-        self.mock_db.query.return_value = query_result
+        self.mock_db.execute = AsyncMock(return_value=execute_result)
         
         response = self.client.post("/login", json={
             "email": "test@example.com", 
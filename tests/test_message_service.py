@@ -1,13 +1,44 @@
 import unittest
 from unittest.mock import patch, MagicMock
 from google.auth.credentials import Credentials
-from app.message_service.gmail_service import GmailService
+from googleapiclient.errors import HttpError
+from app.message_service.gmail_service import GmailService, gmail_stats, HISTORY_FIELDS, METADATA_FIELDS, STRUCTURE_FIELDS
 from app.message_service.models import Message, Attachment
+from app.message_service.client_cache import GmailClientCache
+from app.models import GmailCredentials
+
+
+class FakeBatch:
+    """
+    Stand-in for a Gmail batch HTTP request that executes each request in turn
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.execute(), None)
+            except Exception as e:
+                self.callback(request_id, None, e)
 
 
 class TestGmailService(unittest.TestCase):
     def setUp(self) -> None:
         self.test_credentials = MagicMock(spec=Credentials)
+        self.batches = []
+
+        def new_batch(service, callback):
+            self.batches.append(FakeBatch(callback))
+            return self.batches[-1]
+
+        patcher = patch.object(GmailService, '_new_batch', new_batch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
         return super().setUp()
     @patch('app.message_service.gmail_service.build')
     def test_authenticate(self, mock_build):
@@ -92,6 +123,7 @@ class TestGmailService(unittest.TestCase):
             'id': '123',
             'labelIds': ['INBOX', 'UNREAD'],
             'payload': {
+                'mimeType': 'multipart/mixed',
                 'headers': [
                     {'name': 'Subject', 'value': 'Test Subject'},
                     {'name': 'From', 'value': 'sender@example.com'}
@@ -108,9 +140,6 @@ class TestGmailService(unittest.TestCase):
         mock_service = mock_build.return_value
         mock_service.users().messages().list().execute.return_value = mock_messages_response
         mock_service.users().messages().get().execute.return_value = mock_message_detail
-        mock_service.users().messages().attachments().get().execute.return_value = {
-            'data': 'base64data'
-        }
 
         gmail_service = GmailService(self.test_credentials)
         messages = gmail_service.get_messages()
@@ -120,6 +149,61 @@ class TestGmailService(unittest.TestCase):
         self.assertEqual(len(messages[0].attachments), 1)
         self.assertEqual(messages[0].attachments[0].filename, 'test.pdf')
         self.assertEqual(messages[0].attachments[0].mimeType, 'application/pdf')
+        self.assertEqual(messages[0].attachments[0].attachmentId, 'att123')
+        # Only the name and type are used, so the attachment itself is never downloaded
+        self.assertIsNone(messages[0].attachments[0].data)
+        mock_service.users().messages().attachments().get().execute.assert_not_called()
+
+    @patch('app.message_service.gmail_service.build')
+    def test_get_messages_fetches_metadata_first(self, mock_build):
+        """
+        Test that message bodies are only fetched for messages that pass the label filter.
+
+        Tests:
+            - Excluded categories are left out of the list query
+            - Every message is fetched with format=metadata and a fields mask
+            - Only the survivor that can have attachments has its structure fetched
+            - Requests and response bytes are counted
+        """
+        def metadata(msg_id, labels, mime_type):
+            return {
+                'id': msg_id,
+                'labelIds': labels,
+                'snippet': f'Body {msg_id}',
+                'payload': {'mimeType': mime_type, 'headers': [{'name': 'Subject', 'value': f'Subject {msg_id}'}]}
+            }
+        details = {
+            '1': metadata('1', ['INBOX', 'UNREAD'], 'multipart/mixed'),
+            '2': metadata('2', ['INBOX', 'UNREAD', 'CATEGORY_PROMOTIONS'], 'multipart/mixed'),
+            '3': metadata('3', ['INBOX', 'UNREAD'], 'multipart/alternative'),
+        }
+
+        def get(userId, id, format, fields, metadataHeaders=None):
+            request = MagicMock()
+            if format == 'metadata':
+                request.execute.return_value = details[id]
+            else:
+                request.execute.return_value = {'id': id, 'payload': {'parts': [
+                    {'filename': 'notes.txt', 'mimeType': 'text/plain', 'body': {'attachmentId': 'att1'}}
+                ]}}
+            return request
+
+        mock_service = mock_build.return_value
+        mock_service.users().messages().list().execute.return_value = {'messages': [{'id': msg_id} for msg_id in details]}
+        mock_service.users().messages().get = MagicMock(side_effect=get)
+        gmail_stats.take()
+
+        messages = GmailService(self.test_credentials, verify=False).get_messages()
+
+        self.assertEqual([message.id for message in messages], ['1', '3'])
+        self.assertEqual([attachment.filename for attachment in messages[0].attachments], ['notes.txt'])
+        self.assertIn('-category:promotions', mock_service.users().messages().list.call_args.kwargs['q'])
+        formats = [(call.kwargs['format'], call.kwargs['fields']) for call in mock_service.users().messages().get.call_args_list]
+        self.assertEqual(formats, [('metadata', METADATA_FIELDS)] * 3 + [('full', STRUCTURE_FIELDS)])
+        stats = gmail_stats.take()
+        self.assertEqual((stats['metadata_requests'], stats['structure_requests'], stats['excluded']), (3, 1, 1))
+        self.assertNotIn('attachment_requests', stats)
+        self.assertGreater(stats['response_bytes'], 0)
 
     @patch('app.message_service.gmail_service.build')
     def test_get_messages_error_handling(self, mock_build):
@@ -197,4 +281,213 @@ class TestGmailService(unittest.TestCase):
         self.assertEqual(messages[0].body, 'Test message body 1')
         self.assertEqual(messages[1].body, 'Test message body 2')
 
-    
\ No newline at end of file
+    @patch('app.message_service.gmail_service.build')
+    def test_sync_messages_with_history_id(self, mock_build):
+        """
+        Test incremental sync from a history cursor.
+        
+        Tests:
+            - Only messages added since the cursor are fetched
+            - The new cursor is taken from the history response
+        """
+        mock_history_response = {
+            'history': [
+                {'messagesAdded': [{'message': {'id': '123'}}]},
+                {'messagesAdded': [{'message': {'id': '123'}}, {'message': {'id': '456'}}]}
+            ],
+            'historyId': '2000'
+        }
+        mock_message_detail = {
+            'id': '123',
+            'labelIds': ['INBOX', 'UNREAD'],
+            'payload': {
+                'headers': [
+                    {'name': 'Subject', 'value': 'Test Subject'},
+                    {'name': 'From', 'value': 'sender@example.com'}
+                ],
+                'parts': []
+            },
+            'snippet': 'Test message body'
+        }
+
+        mock_service = mock_build.return_value
+        mock_service.users().history().list().execute.return_value = mock_history_response
+        mock_service.users().messages().get().execute.return_value = mock_message_detail
+
+        gmail_service = GmailService(self.test_credentials)
+        messages, history_id = gmail_service.sync_messages('1000')
+
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(history_id, '2000')
+        mock_service.users().history().list.assert_called_with(
+            userId='me', startHistoryId='1000', historyTypes=['messageAdded'], labelId='INBOX', fields=HISTORY_FIELDS
+        )
+        mock_service.users().messages().list().execute.assert_not_called()
+
+    @patch('app.message_service.gmail_service.build')
+    def test_sync_messages_without_history_id(self, mock_build):
+        """
+        Test that the first sync does a full resync and returns the profile cursor.
+        """
+        mock_service = mock_build.return_value
+        mock_service.users().getProfile().execute.return_value = {'historyId': '3000'}
+        mock_service.users().messages().list().execute.return_value = {'messages': []}
+
+        gmail_service = GmailService(self.test_credentials)
+        messages, history_id = gmail_service.sync_messages(None)
+
+        self.assertEqual(messages, [])
+        self.assertEqual(history_id, '3000')
+
+    @patch('app.message_service.gmail_service.build')
+    def test_sync_messages_with_expired_history_id(self, mock_build):
+        """
+        Test that an expired cursor falls back to a full resync.
+        """
+        mock_service = mock_build.return_value
+        mock_service.users().getProfile().execute.return_value = {'historyId': '3000'}
+        mock_service.users().history().list().execute.side_effect = HttpError(MagicMock(status=404), b'Not Found')
+        mock_service.users().messages().list().execute.return_value = {'messages': []}
+
+        gmail_service = GmailService(self.test_credentials)
+        messages, history_id = gmail_service.sync_messages('1000')
+
+        self.assertEqual(messages, [])
+        self.assertEqual(history_id, '3000')
+
+    @patch('app.message_service.gmail_service.build')
+    def test_sync_messages_error_keeps_history_id(self, mock_build):
+        """
+        Test that a failed sync does not advance the cursor.
+        """
+        mock_service = mock_build.return_value
+        mock_service.users().history().list().execute.side_effect = Exception('API Error')
+
+        gmail_service = GmailService(self.test_credentials)
+        messages, history_id = gmail_service.sync_messages('1000')
+
+        self.assertEqual(messages, [])
+        self.assertEqual(history_id, '1000')
+
+    @patch('app.message_service.gmail_service.build')
+    def test_watch(self, mock_build):
+        """
+        Test that a watch is requested for the inbox on the given topic.
+        """
+        mock_service = mock_build.return_value
+        mock_service.users().watch().execute.return_value = {'historyId': '3000', 'expiration': '1700000000000'}
+
+        gmail_service = GmailService(self.test_credentials)
+        response = gmail_service.watch('projects/test/topics/gmail')
+
+        self.assertEqual(response['expiration'], '1700000000000')
+        mock_service.users().watch.assert_called_with(
+            userId='me',
+            body={'topicName': 'projects/test/topics/gmail', 'labelIds': ['INBOX'], 'labelFilterBehavior': 'include'}
+        )
+
+    @patch('app.message_service.gmail_service.build')
+    def test_get_messages_in_batches(self, mock_build):
+        """
+        Test that message details are fetched through batch requests.
+        
+        Tests:
+            - Requests are split into batches of `batch_size`
+            - A deleted (404) item is skipped without failing the rest of the batch
+        """
+        mock_messages_response = {
+            'messages': [{'id': str(i), 'threadId': f'thread{i}'} for i in range(5)]
+        }
+        mock_message_detail = {
+            'id': '0',
+            'labelIds': ['INBOX', 'UNREAD'],
+            'payload': {
+                'headers': [
+                    {'name': 'Subject', 'value': 'Test Subject'},
+                    {'name': 'From', 'value': 'sender@example.com'}
+                ],
+                'parts': []
+            },
+            'snippet': 'Test message body'
+        }
+
+        mock_service = mock_build.return_value
+        mock_service.users().messages().list().execute.return_value = mock_messages_response
+        mock_service.users().messages().get().execute.side_effect = [
+            mock_message_detail, HttpError(MagicMock(status=404), b'Not Found'), mock_message_detail, mock_message_detail, mock_message_detail
+        ]
+
+        gmail_service = GmailService(self.test_credentials, batch_size=2)
+        messages = gmail_service.get_messages()
+
+        self.assertEqual([len(batch.requests) for batch in self.batches], [2, 2, 1])
+        self.assertEqual([message.id for message in messages], ['0', '2', '3', '4'])
+
+
+    @patch('app.message_service.gmail_service.backoff_delay', return_value=0)
+    @patch('app.message_service.gmail_service.build')
+    def test_fetch_messages_retries_failed_items(self, mock_build, mock_backoff):
+        """
+        Test that batch items failing with a server error are retried, and
+        raise once every retry is used up rather than being dropped
+        """
+        server_error = HttpError(MagicMock(status=500), b'backendError')
+        mock_message_detail = {
+            'labelIds': ['INBOX', 'UNREAD'],
+            'payload': {'mimeType': 'text/plain', 'headers': [{'name': 'Subject', 'value': 'Test Subject'}]},
+            'snippet': 'Test message body'
+        }
+        mock_service = mock_build.return_value
+        mock_service.users().messages().get().execute.side_effect = [mock_message_detail, server_error, mock_message_detail]
+
+        gmail_service = GmailService(self.test_credentials)
+        self.assertEqual([message['id'] for message in gmail_service.fetch_messages(['0', '1'])], ['0', '1'])
+
+        mock_service.users().messages().get().execute.side_effect = server_error
+        with self.assertRaises(HttpError):
+            gmail_service.fetch_messages(['2'])
+
+class TestGmailClientCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.credentials = GmailCredentials(user_id=1, token="test_token", refresh_token="test_refresh_token")
+        return super().setUp()
+
+    @patch('app.message_service.client_cache.GmailService')
+    def test_lease_reuses_client(self, mock_gmail_service):
+        cache = GmailClientCache()
+        with cache.lease(self.credentials) as first:
+            pass
+        with cache.lease(self.credentials) as second:
+            pass
+
+        self.assertIs(first, second)
+        mock_gmail_service.assert_called_once()
+        # Built without the getProfile round-trip
+        self.assertFalse(mock_gmail_service.call_args.kwargs['verify'])
+
+    @patch('app.message_service.client_cache.GmailService')
+    def test_lease_rebuilds_on_credential_change(self, mock_gmail_service):
+        cache = GmailClientCache()
+        with cache.lease(self.credentials):
+            pass
+        self.credentials.token = "refreshed_token"
+        with cache.lease(self.credentials):
+            pass
+
+        self.assertEqual(mock_gmail_service.call_count, 2)
+
+    @patch('app.message_service.client_cache.GmailService')
+    def test_lease_evicts_idle_and_failed_clients(self, mock_gmail_service):
+        cache = GmailClientCache(idle_seconds=0)
+        with cache.lease(self.credentials):
+            pass
+        with cache.lease(self.credentials):
+            pass
+        self.assertEqual(mock_gmail_service.call_count, 2)
+
+        cache = GmailClientCache()
+        with self.assertRaises(Exception):
+            with cache.lease(self.credentials):
+                raise Exception('Unauthorized')
+        self.assertNotIn(1, cache._clients)
+
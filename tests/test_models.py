@@ -1,6 +1,6 @@
 import unittest
 import os
-from sqlalchemy import create_engine
+from app.database import create_db_engine
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime, timezone
 from app.models import Base, User, Task, GmailCredentials
@@ -9,14 +9,15 @@ from sqlalchemy.exc import IntegrityError
 
 class TestModels(unittest.TestCase):
     def setUp(self):
-        # Create in-memory SQLite database for testing
-        self.engine = create_engine('sqlite:///:memory:')
+        # Create in-memory SQLite database for testing, set TEST_DATABASE_URL to run against Postgres
+        self.engine = create_db_engine(os.getenv("TEST_DATABASE_URL", "sqlite:///:memory:"))
         # Enable foreign key support
-        @event.listens_for(self.engine, "connect")
-        def set_sqlite_pragma(dbapi_connection, connection_record):
-            cursor = dbapi_connection.cursor()
-            cursor.execute("PRAGMA foreign_keys=ON")
-            cursor.close()
+        if self.engine.dialect.name == "sqlite":
+            @event.listens_for(self.engine, "connect")
+            def set_sqlite_pragma(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                cursor.execute("PRAGMA foreign_keys=ON")
+                cursor.close()
             
         Base.metadata.create_all(self.engine)
         TestingSessionLocal = sessionmaker(bind=self.engine)
@@ -24,6 +25,7 @@ class TestModels(unittest.TestCase):
 
     def tearDown(self):
         self.db.close()
+        Base.metadata.drop_all(self.engine)
 
     def test_create_user(self):
         user = User(
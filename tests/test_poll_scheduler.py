@@ -0,0 +1,52 @@
+import unittest
+from app.services.poll_scheduler import PollScheduler
+
+
+class TestPollScheduler(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.scheduler = PollScheduler(min_interval=10, max_interval=80, backoff=2, max_concurrency=2)
+        self.scheduler.sync([1, 2, 3], now=self.now)
+
+    def test_sync_spreads_new_users_over_first_interval(self):
+        self.assertEqual(self.scheduler.due(self.now - 1), [])
+        self.assertEqual(sorted(self.scheduler.due(self.now + 10)), [1, 2, 3])
+
+    def test_due_respects_limit(self):
+        self.assertEqual(len(self.scheduler.due(self.now + 10, limit=2)), 2)
+        self.assertEqual(len(self.scheduler.due(self.now + 10, limit=2)), 1)
+
+    def test_idle_users_back_off_and_busy_users_speed_up(self):
+        self.scheduler.due(self.now + 10)
+        for _ in range(5):
+            self.scheduler.complete(1, created=0, now=self.now)
+        self.assertEqual(self.scheduler.interval(1), 80)
+
+        self.scheduler.complete(1, created=2, now=self.now)
+        self.assertEqual(self.scheduler.interval(1), 10)
+        self.assertEqual(self.scheduler.due(self.now + 10), [1])
+
+    def test_complete_honours_retry_after(self):
+        self.scheduler.due(self.now + 10)
+        self.scheduler.complete(1, created=0, retry_after=60, now=self.now)
+        self.assertEqual(self.scheduler.due(self.now + 59), [])
+        self.assertEqual(self.scheduler.due(self.now + 60), [1])
+
+    def test_poll_now_supersedes_schedule(self):
+        self.scheduler.due(self.now + 10)
+        self.scheduler.complete(1, created=0, now=self.now)
+        self.scheduler.poll_now(1, now=self.now + 1)
+        self.assertEqual(self.scheduler.due(self.now + 1), [1])
+        self.assertEqual(self.scheduler.next_due(), None)
+
+    def test_sync_drops_removed_users(self):
+        self.scheduler.sync([1], now=self.now)
+        self.assertEqual(self.scheduler.due(self.now + 10), [1])
+        self.scheduler.complete(2, created=1, now=self.now)
+        self.assertEqual(self.scheduler.due(self.now + 100), [])
+
+    def test_records_lag(self):
+        due = self.scheduler.due(self.now + 30)
+        self.assertEqual(set(self.scheduler.lag), set(due))
+        self.assertTrue(all(20 <= lag <= 30 for lag in self.scheduler.lag.values()))
+        self.assertEqual(self.scheduler.stats()["users"], 3)
@@ -0,0 +1,68 @@
+import unittest
+import os
+import tempfile
+from app.ai_agents.prefilter import PreFilter, header_rules
+from app.message_service.models import Message
+
+
+def make_message(subject, body, sender="colleague@company.com", headers=None):
+    return Message(id="123", subject=subject, sender=sender, body=body, attachments=[], headers=headers or {})
+
+
+class TestPreFilter(unittest.TestCase):
+
+    def test_header_rules(self):
+        self.assertEqual(header_rules(make_message("Sale", "50% off", headers={"List-Unsubscribe": "<mailto:x>"})), "list-unsubscribe")
+        self.assertEqual(header_rules(make_message("Digest", "News", headers={"Precedence": "bulk"})), "bulk-precedence")
+        self.assertEqual(header_rules(make_message("Receipt", "Thanks", sender="No Reply <noreply@shop.com>")), "noreply-sender")
+        self.assertIsNone(header_rules(make_message("Report", "Please review the report by Friday")))
+
+    def test_untrained_model_only_uses_header_rules(self):
+        prefilter = PreFilter(mode="enforce")
+        self.assertTrue(prefilter.should_skip(make_message("Receipt", "Thanks", sender="noreply@shop.com")))
+        self.assertFalse(prefilter.should_skip(make_message("Receipt", "Thanks")))
+
+    def test_shadow_mode_never_skips(self):
+        prefilter = PreFilter(mode="shadow")
+        message = make_message("Receipt", "Your order has shipped", sender="noreply@shop.com")
+
+        self.assertFalse(prefilter.should_skip(message))
+        prefilter.observe(message, has_task=True)
+
+        self.assertEqual(prefilter.stats["would_skip"], 1)
+        self.assertEqual(prefilter.stats["skipped"], 0)
+        self.assertEqual(prefilter.stats["missed_tasks"], 1)
+
+    def test_model_learns_from_llm_decisions(self):
+        prefilter = PreFilter(mode="enforce", min_samples=20, threshold=0.9)
+        for i in range(10):
+            prefilter.observe(make_message(f"Your order {i} has shipped", "Track your package delivery status online"), has_task=False)
+            prefilter.observe(make_message(f"Report review {i}", "Please review the quarterly report and send feedback by Friday"), has_task=True)
+
+        self.assertTrue(prefilter.should_skip(make_message("Your order 99 has shipped", "Track your package delivery status online")))
+        self.assertFalse(prefilter.should_skip(make_message("Report review 99", "Please review the quarterly report and send feedback by Friday")))
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "prefilter.json")
+            prefilter = PreFilter(model_path=path)
+            prefilter.observe(make_message("Report", "Please review"), has_task=True)
+            prefilter.save()
+
+            loaded = PreFilter(model_path=path)
+            self.assertEqual(loaded.class_counts, [0, 1])
+            self.assertEqual(loaded.feature_counts, prefilter.feature_counts)
+
+    def test_corrupt_model_loads_empty(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "prefilter.json")
+            with open(path, "w") as f:
+                f.write('{"class_counts": [3, ')
+
+            prefilter = PreFilter(model_path=path)
+            self.assertEqual(prefilter.class_counts, [0, 0])
+
+            prefilter.observe(make_message("Report", "Please review"), has_task=True)
+            prefilter.save()
+            self.assertEqual(os.listdir(directory), ["prefilter.json"])
+            self.assertEqual(PreFilter(model_path=path).class_counts, [0, 1])
@@ -0,0 +1,83 @@
+import unittest
+from unittest.mock import MagicMock, patch
+from googleapiclient.errors import HttpError
+from app.rate_limiter import TokenBucket, RateLimiter, RateLimitExceeded, call_with_backoff, is_rate_limited, is_transient, get_retry_after
+
+
+def rate_limit_error(retry_after=None):
+    resp = MagicMock(status=429)
+    resp.get.side_effect = lambda name: retry_after if name == 'retry-after' else None
+    return HttpError(resp, b'Too Many Requests')
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_reserve_within_capacity(self):
+        bucket = TokenBucket(rate=10)
+        for _ in range(10):
+            self.assertEqual(bucket.reserve(), 0)
+
+    def test_reserve_past_capacity_waits(self):
+        bucket = TokenBucket(rate=10)
+        bucket.reserve(10)
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+
+    def test_pause(self):
+        bucket = TokenBucket(rate=10)
+        bucket.pause(5)
+        self.assertGreater(bucket.reserve(), 4.9)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_per_key_buckets(self):
+        limiter = RateLimiter("test", rate=100, per_key_rate=1)
+        self.assertEqual(limiter.reserve("user1"), 0)
+        self.assertGreater(limiter.reserve("user1"), 0)
+        self.assertEqual(limiter.reserve("user2"), 0)
+
+    def test_is_rate_limited(self):
+        self.assertTrue(is_rate_limited(rate_limit_error()))
+        self.assertTrue(is_rate_limited(HttpError(MagicMock(status=403), b'{"reason": "userRateLimitExceeded"}')))
+        self.assertFalse(is_rate_limited(HttpError(MagicMock(status=404), b'Not Found')))
+        self.assertTrue(is_rate_limited(MagicMock(spec=['status_code'], status_code=429)))
+
+    def test_is_transient(self):
+        self.assertTrue(is_transient(rate_limit_error()))
+        self.assertTrue(is_transient(RateLimitExceeded("mistral", 1)))
+        self.assertTrue(is_transient(TimeoutError()))
+        self.assertTrue(is_transient(HttpError(MagicMock(status=503), b'Unavailable')))
+        self.assertTrue(is_transient(MagicMock(spec=['status_code'], status_code=500)))
+        self.assertFalse(is_transient(MagicMock(spec=['status_code'], status_code=400)))
+        self.assertFalse(is_transient(ValueError("bad response")))
+
+    def test_get_retry_after(self):
+        self.assertEqual(get_retry_after(rate_limit_error('7')), 7)
+        self.assertIsNone(get_retry_after(rate_limit_error()))
+
+    @patch('app.rate_limiter.time.sleep')
+    def test_call_with_backoff_retries(self, mock_sleep):
+        limiter = RateLimiter("test", rate=1000)
+        fn = MagicMock(side_effect=[rate_limit_error('2'), "ok"])
+
+        self.assertEqual(call_with_backoff(fn, limiter), "ok")
+        self.assertEqual(fn.call_count, 2)
+        # Retry-After holds the whole limiter before the retry
+        self.assertAlmostEqual(mock_sleep.call_args.args[0], 2, places=1)
+
+    @patch('app.rate_limiter.time.sleep')
+    @patch('app.rate_limiter.settings')
+    def test_call_with_backoff_gives_up(self, mock_settings, mock_sleep):
+        mock_settings.BACKOFF_RETRIES = 2
+        limiter = RateLimiter("test", rate=1000)
+        fn = MagicMock(side_effect=rate_limit_error('1'))
+
+        with self.assertRaises(RateLimitExceeded) as context:
+            call_with_backoff(fn, limiter)
+        self.assertEqual(fn.call_count, 3)
+        self.assertEqual(context.exception.retry_after, 1)
+
+    def test_call_with_backoff_raises_other_errors(self):
+        limiter = RateLimiter("test", rate=1000)
+        with self.assertRaises(ValueError):
+            call_with_backoff(MagicMock(side_effect=ValueError("boom")), limiter)
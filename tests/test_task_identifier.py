@@ -1,15 +1,26 @@
-from app.ai_agents.task_identifier import TaskIdentifier
-from app.message_service.models import Message
+from app.ai_agents.task_identifier import TaskIdentifier, llm_stats
+from app.message_service.models import Message, Attachment
 from app.ai_agents.models import Task
+from app.ai_agents.response_cache import ResponseCache
+from app.ai_agents.prompt import PromptBuilder, estimate_tokens
+from app.rate_limiter import RateLimiter
+from datetime import date
+import os
+import tempfile
 import unittest
 import json
+import asyncio
 from unittest.mock import patch
 
 class TestTaskIdentifier(unittest.TestCase):
     
     @patch('app.ai_agents.task_identifier.Mistral')
     def setUp(self, mock_mistral):
-        self.task_identifier = TaskIdentifier()
+        self.task_identifier = TaskIdentifier(output_mode="text")
+        # A limiter of its own, so the calls of other tests never throttle this one's
+        patcher = patch('app.ai_agents.task_identifier.mistral_limiter', RateLimiter("mistral", 1000))
+        patcher.start()
+        self.addCleanup(patcher.stop)
         # Create a mock instance that will be returned by Mistral()
         self.mock_mistral_instance = mock_mistral.return_value
         # Create a mock for the chat attribute
@@ -91,9 +102,377 @@ class TestTaskIdentifier(unittest.TestCase):
         self.assertIsInstance(result, Task)
         self.assertEqual(result.title, "Update Website Pricing Page")
         self.assertEqual(result.due_date, "2024-01-19")
-        self.assertEqual(result.description, "Update pricing page to include new enterprise tier pricing")  
+        self.assertEqual(result.description, "Update pricing page to include new enterprise tier pricing")
 
+    @patch('app.ai_agents.task_identifier.Mistral')
+    def test_identify_task_uses_cache(self, mock_mistral):
+        task_identifier = TaskIdentifier(cache=ResponseCache(), output_mode="text")
+        mock_completion = unittest.mock.MagicMock()
+        mock_completion.choices = [
+            unittest.mock.MagicMock(
+                message=unittest.mock.MagicMock(
+                    content="None"
+                )
+            )
+        ]
+        mock_mistral.return_value.chat.complete.return_value = mock_completion
+
+        message = Message(
+            id="456",
+            subject="Hello",
+            sender="colleague@company.com",
+            body="Just wanted to say hello!",
+            attachments=[]
+        )
+        # Same mail delivered to another user, with different whitespace
+        forwarded = Message(
+            id="789",
+            subject="Hello",
+            sender="colleague@company.com",
+            body="Just wanted to   say hello!",
+            attachments=[]
+        )
+        self.assertIsNone(task_identifier.get_task(message))
+        self.assertIsNone(task_identifier.get_task(forwarded))
+
+        mock_mistral.return_value.chat.complete.assert_called_once()
+        self.assertEqual(task_identifier.cache.hits, 1)
+        self.assertEqual(task_identifier.cache.misses, 1)
+
+
+    def _mock_completion(self, content):
+        mock_completion = unittest.mock.MagicMock()
+        mock_completion.choices = [
+            unittest.mock.MagicMock(
+                message=unittest.mock.MagicMock(
+                    content=content
+                )
+            )
+        ]
+        return mock_completion
+
+    def _messages(self, count):
+        return [
+            Message(
+                id=str(i),
+                subject=f"Subject {i}",
+                sender="manager@company.com",
+                body=f"Body {i}",
+                attachments=[]
+            )
+            for i in range(count)
+        ]
+
+    @patch('app.ai_agents.task_identifier.Mistral')
+    def test_get_tasks_batches_messages(self, mock_mistral):
+        task_identifier = TaskIdentifier(cache=ResponseCache(), batch_size=2, output_mode="text", cascade=False)
+        task = {"title": "Review Report", "due_date": None, "description": "Review the report"}
+        mock_mistral.return_value.chat.complete.side_effect = [
+            self._mock_completion(json.dumps({"0": task, "1": None})),
+            self._mock_completion(json.dumps(task)),
+        ]
+
+        tasks = task_identifier.get_tasks(self._messages(3))
+
+        self.assertEqual(mock_mistral.return_value.chat.complete.call_count, 2)
+        self.assertEqual([task.title for task in tasks[0]], ["Review Report"])
+        self.assertEqual(tasks[1], [])
+        self.assertEqual([task.title for task in tasks[2]], ["Review Report"])
+
+        # Results of the batch are cached per message
+        self.assertEqual(task_identifier.get_tasks(self._messages(2))[1], [])
+        self.assertEqual(mock_mistral.return_value.chat.complete.call_count, 2)
+
+    @patch('app.ai_agents.task_identifier.Mistral')
+    def test_get_tasks_falls_back_on_malformed_batch(self, mock_mistral):
+        task_identifier = TaskIdentifier(cache=ResponseCache(), batch_size=2, output_mode="text", cascade=False)
+        mock_mistral.return_value.chat.complete.side_effect = [
+            self._mock_completion(json.dumps({"0": None})),
+            self._mock_completion("None"),
+            self._mock_completion("None"),
+        ]
+
+        tasks = task_identifier.get_tasks(self._messages(2))
+
+        self.assertEqual(tasks, [[], []])
+        self.assertEqual(mock_mistral.return_value.chat.complete.call_count, 3)
+
+
+    @patch('app.ai_agents.task_identifier.Mistral')
+    def test_get_tasks_async_limits_concurrency(self, mock_mistral):
+        task_identifier = TaskIdentifier(cache=ResponseCache(), batch_size=1, concurrency=2, output_mode="text", cascade=False)
+        in_flight = 0
+        max_in_flight = 0
+
+        async def complete_async(**kwargs):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return self._mock_completion("None")
+        mock_mistral.return_value.chat.complete_async.side_effect = complete_async
+
+        tasks = asyncio.run(task_identifier.get_tasks_async(self._messages(5)))
+
+        self.assertEqual(tasks, [[]] * 5)
+        self.assertEqual(mock_mistral.return_value.chat.complete_async.call_count, 5)
+        self.assertEqual(max_in_flight, 2)
+
+    @patch('app.ai_agents.task_identifier.Mistral')
+    def test_get_tasks_async_timeout(self, mock_mistral):
+        task_identifier = TaskIdentifier(cache=ResponseCache(), batch_size=1, timeout=0.01, output_mode="text", cascade=False)
+
+        async def complete_async(**kwargs):
+            await asyncio.sleep(1)
+        mock_mistral.return_value.chat.complete_async.side_effect = complete_async
+
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(task_identifier.get_tasks_async(self._messages(2)))
+
+
+    @patch('app.ai_agents.task_identifier.Mistral')
+    def test_structured_get_task_validates_against_schema(self, mock_mistral):
+        task_identifier = TaskIdentifier(cache=ResponseCache(), output_mode="structured")
+        task = {"title": "Review Report", "due_date": "2024-01-25", "description": "Review the report"}
+        mock_mistral.return_value.chat.complete.return_value = self._mock_completion(json.dumps({"tasks": [task]}))
+
+        result = task_identifier.get_task(self._messages(1)[0])
+
+        self.assertEqual(result.title, "Review Report")
+        self.assertEqual(result.due_date, date(2024, 1, 25))
+        response_format = mock_mistral.return_value.chat.complete.call_args.kwargs["response_format"]
+        self.assertEqual(response_format["type"], "json_schema")
+        self.assertEqual(response_format["json_schema"]["name"], "TaskExtraction")
+
+    @patch('app.ai_agents.task_identifier.Mistral')
+    def test_structured_retries_only_on_schema_violation(self, mock_mistral):
+        task_identifier = TaskIdentifier(cache=ResponseCache(), output_mode="structured", schema_retries=1)
+        mock_mistral.return_value.chat.complete.side_effect = [
+            self._mock_completion('{"tasks": [{"title": "Missing description"}]}'),
+            self._mock_completion('{"tasks": []}'),
+        ]
+        wasted = llm_stats["wasted_calls"]
+
+        self.assertIsNone(task_identifier.get_task(self._messages(1)[0]))
+        self.assertEqual(mock_mistral.return_value.chat.complete.call_count, 2)
+        self.assertEqual(llm_stats["wasted_calls"] - wasted, 1)
+
+        # The valid response was cached, so the message is not classified again
+        self.assertIsNone(task_identifier.get_task(self._messages(1)[0]))
+        self.assertEqual(mock_mistral.return_value.chat.complete.call_count, 2)
+
+    @patch('app.ai_agents.task_identifier.Mistral')
+    def test_structured_retries_responses_in_the_wrong_shape(self, mock_mistral):
+        task_identifier = TaskIdentifier(cache=ResponseCache(), output_mode="structured", schema_retries=2)
+        task = {"title": "Review Report", "due_date": None, "description": "Review the report"}
+        mock_mistral.return_value.chat.complete.side_effect = [
+            self._mock_completion("{}"),
+            self._mock_completion(json.dumps(task)),
+            self._mock_completion(json.dumps({"tasks": [task]})),
+        ]
+        wasted = llm_stats["wasted_calls"]
+
+        self.assertEqual(task_identifier.get_task(self._messages(1)[0]).title, "Review Report")
+        self.assertEqual(mock_mistral.return_value.chat.complete.call_count, 3)
+        self.assertEqual(llm_stats["wasted_calls"] - wasted, 2)
+
+    @patch('app.ai_agents.task_identifier.Mistral')
+    def test_structured_batch_rejects_results_without_tasks(self, mock_mistral):
+        task_identifier = TaskIdentifier(cache=ResponseCache(), batch_size=2, output_mode="structured", cascade=False, schema_retries=0)
+        mock_mistral.return_value.chat.complete.return_value = self._mock_completion(json.dumps({"results": [{"id": "0"}, {"id": "1"}]}))
+        wasted = llm_stats["wasted_calls"]
+
+        self.assertEqual(task_identifier.get_tasks(self._messages(2)), [[], []])
+        # The batch and each message's own request all broke the schema, and none were cached as an answer
+        self.assertEqual(llm_stats["wasted_calls"] - wasted, 3)
+        self.assertEqual(len(task_identifier.cache._entries), 0)
+
+    @patch('app.ai_agents.task_identifier.Mistral')
+    def test_structured_gives_up_after_retry_budget(self, mock_mistral):
+        task_identifier = TaskIdentifier(cache=ResponseCache(), output_mode="structured", schema_retries=2)
+        mock_mistral.return_value.chat.complete.return_value = self._mock_completion("None")
+        wasted = llm_stats["wasted_calls"]
+
+        self.assertIsNone(task_identifier.get_task(self._messages(1)[0]))
+        self.assertEqual(mock_mistral.return_value.chat.complete.call_count, 3)
+        self.assertEqual(llm_stats["wasted_calls"] - wasted, 3)
+        self.assertEqual(len(task_identifier.cache._entries), 0)
+
+    @patch('app.ai_agents.task_identifier.Mistral')
+    def test_structured_batch(self, mock_mistral):
+        task_identifier = TaskIdentifier(cache=ResponseCache(), batch_size=2, output_mode="structured", cascade=False)
+        task = {"title": "Review Report", "due_date": None, "description": "Review the report"}
+        mock_mistral.return_value.chat.complete.side_effect = [
+            # Missing the second message, so the request is repeated
+            self._mock_completion(json.dumps({"results": [{"id": "0", "tasks": [task]}]})),
+            self._mock_completion(json.dumps({"results": [{"id": "1", "tasks": []}, {"id": "0", "tasks": [task]}]})),
+        ]
+
+        tasks = task_identifier.get_tasks(self._messages(2))
+
+        self.assertEqual([task.title for task in tasks[0]], ["Review Report"])
+        self.assertEqual(tasks[1], [])
+        self.assertEqual(mock_mistral.return_value.chat.complete.call_count, 2)
+        self.assertIsNone(task_identifier.get_task(self._messages(2)[1]))
+        self.assertEqual(mock_mistral.return_value.chat.complete.call_count, 2)
+
+
+    @patch('app.ai_agents.task_identifier.Mistral')
+    def test_cascade_escalates_only_doubtful_messages(self, mock_mistral):
+        task_identifier = TaskIdentifier(cache=ResponseCache(), batch_size=3, output_mode="structured", cascade=True)
+        task = {"title": "Review Report", "due_date": None, "description": "Review the report"}
+        triage = {"results": [
+            {"id": "0", "has_task": False, "confidence": 0.99},
+            {"id": "1", "has_task": True, "confidence": 0.8},
+            {"id": "2", "has_task": False, "confidence": 0.6},
+        ]}
+        mock_mistral.return_value.chat.complete.side_effect = [
+            self._mock_completion(json.dumps(triage)),
+            self._mock_completion(json.dumps({"results": [{"id": "0", "tasks": [task]}, {"id": "1", "tasks": []}]})),
+        ]
+        escalated = llm_stats["escalated"]
+
+        tasks = task_identifier.get_tasks(self._messages(3))
+
+        self.assertEqual(tasks[0], [])
+        self.assertEqual([task.title for task in tasks[1]], ["Review Report"])
+        self.assertEqual(tasks[2], [])
+        calls = mock_mistral.return_value.chat.complete.call_args_list
+        self.assertEqual([call.kwargs["model"] for call in calls], ["mistral-small-latest", "mistral-large-latest"])
+        self.assertNotIn("Subject 0", calls[1].kwargs["messages"][1]["content"])
+        self.assertEqual(llm_stats["escalated"] - escalated, 2)
+
+        # The triage decision is cached like any other result
+        self.assertEqual(task_identifier.get_tasks(self._messages(1)), [[]])
+        self.assertEqual(mock_mistral.return_value.chat.complete.call_count, 2)
+
+    @patch('app.ai_agents.task_identifier.Mistral')
+    def test_cascade_escalates_everything_on_bad_triage(self, mock_mistral):
+        task_identifier = TaskIdentifier(cache=ResponseCache(), batch_size=2, output_mode="structured", cascade=True)
+        mock_mistral.return_value.chat.complete.side_effect = [
+            self._mock_completion(json.dumps({"results": [{"id": "0", "has_task": False, "confidence": 0.99}]})),
+            self._mock_completion(json.dumps({"results": [{"id": "0", "tasks": []}, {"id": "1", "tasks": []}]})),
+        ]
+
+        self.assertEqual(task_identifier.get_tasks(self._messages(2)), [[], []])
+        self.assertEqual(mock_mistral.return_value.chat.complete.call_args_list[1].kwargs["model"], "mistral-large-latest")
+
+    @patch('app.ai_agents.task_identifier.Mistral')
+    def test_stats_per_tier(self, mock_mistral):
+        task_identifier = TaskIdentifier(cache=ResponseCache(), output_mode="structured", cascade=True)
+        completion = self._mock_completion(json.dumps({"results": [{"id": "0", "has_task": False, "confidence": 1}]}))
+        completion.usage.total_tokens = 1000
+        mock_mistral.return_value.chat.complete.return_value = completion
+        calls, cost = llm_stats["triage_calls"], llm_stats["triage_cost"]
+
+        task_identifier.get_tasks(self._messages(1))
+
+        stats = llm_stats.snapshot()
+        self.assertEqual(stats["triage_calls"] - calls, 1)
+        self.assertAlmostEqual(stats["triage_cost"] - cost, 1000 * 0.1 / 1e6)
+        self.assertIn("triage_p50_seconds", stats)
+
+
+    @patch('app.ai_agents.task_identifier.Mistral')
+    def test_get_tasks_returns_every_task_in_a_message(self, mock_mistral):
+        task_identifier = TaskIdentifier(cache=ResponseCache(), output_mode="structured", cascade=False)
+        action_items = [
+            {"title": "Send Minutes", "due_date": None, "description": "Send the meeting minutes"},
+            {"title": "Book Venue", "due_date": "2024-02-01", "description": "Book the offsite venue"},
+        ]
+        mock_mistral.return_value.chat.complete.return_value = self._mock_completion(json.dumps({"tasks": action_items}))
+
+        tasks = task_identifier.get_tasks(self._messages(1))
+
+        self.assertEqual([task.title for task in tasks[0]], ["Send Minutes", "Book Venue"])
+        mock_mistral.return_value.chat.complete.assert_called_once()
+
+    @patch('app.ai_agents.task_identifier.Mistral')
+    def test_get_tasks_chunks_long_messages_and_merges(self, mock_mistral):
+        task_identifier = TaskIdentifier(
+            cache=ResponseCache(), batch_size=4, output_mode="structured", cascade=False, prompts=PromptBuilder(body_token_budget=10)
+        )
+        message = Message(id="1", subject="Thread", sender="manager@company.com", body="word " * 20, attachments=[])
+        minutes = {"title": "Send  minutes", "due_date": None, "description": "Send the minutes"}
+        dated_minutes = {"title": "send minutes", "due_date": "2024-02-01", "description": "Send the minutes"}
+        venue = {"title": "Book Venue", "due_date": None, "description": "Book the venue"}
+        mock_mistral.return_value.chat.complete.return_value = self._mock_completion(json.dumps({"results": [
+            {"id": "0", "tasks": [minutes]}, {"id": "1", "tasks": [dated_minutes, venue]}, {"id": "2", "tasks": []}
+        ]}))
+
+        tasks = task_identifier.get_tasks([message])
+
+        request = mock_mistral.return_value.chat.complete.call_args.kwargs["messages"][1]["content"]
+        self.assertIn("Thread (part 3 of 3)", request)
+        self.assertEqual([(task.title, task.due_date) for task in tasks[0]], [("Send  minutes", date(2024, 2, 1)), ("Book Venue", None)])
+
+
+class TestPromptBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.prompts = PromptBuilder(body_token_budget=10)
+        self.message = Message(
+            id="1",
+            subject="Contract",
+            sender="legal@company.com",
+            body="Please sign the attached contract before the end of the week so we can countersign it",
+            attachments=[Attachment(filename="contract.pdf", mimeType="application/pdf", data="JVBERi0xLjQK" * 1000)]
+        )
+
+    def test_render_leaves_out_attachment_data(self):
+        prompt = self.prompts.render(self.message)
+
+        self.assertIn("contract.pdf (application/pdf)", prompt)
+        self.assertNotIn("JVBERi0", prompt)
+        self.assertNotIn("JVBERi0", str(self.message))
+
+    def test_render_truncates_body_to_budget(self):
+        body = self.prompts.render(self.message).split("Body: ")[1].split("\n")[0]
+
+        self.assertTrue(body.endswith("[truncated]"))
+        self.assertLessEqual(estimate_tokens(body), 10)
+        self.assertEqual(self.prompts.stats["truncated"], 1)
+
+    def test_system_prompt_has_todays_date(self):
+        prompt = self.prompts.system_prompt()
+
+        self.assertIn(f"Todays date is {date.today().isoformat()}", prompt)
+        self.assertIs(prompt, self.prompts.system_prompt())
+        self.assertFalse(prompt.startswith(" "))
+
+    def test_requests_report_estimated_tokens(self):
+        request = self.prompts.task_request(self.message)
+
+        self.assertEqual([part["role"] for part in request], ["system", "user"])
+        self.assertEqual(self.prompts.stats["requests"], 1)
+        self.assertEqual(self.prompts.stats["estimated_tokens"], sum(estimate_tokens(part["content"]) for part in request))
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(max_size=2)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        cache.get("a")
+        cache.set("c", "3")
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "1")
+        self.assertEqual(cache.get("c"), "3")
 
+    def test_ttl_expiry(self):
+        cache = ResponseCache(ttl_seconds=0)
+        cache.set("a", "1")
+        self.assertIsNone(cache.get("a"))
 
+    def test_disk_tier(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.db")
+            ResponseCache(path=path).set("a", "1")
 
+            cache = ResponseCache(path=path)
+            self.assertEqual(cache.get("a"), "1")
+            self.assertEqual(cache.stats()["disk_hits"], 1)
 
@@ -3,11 +3,13 @@ import os
 from unittest.mock import patch, MagicMock
 from fastapi import HTTPException
 from sqlalchemy.orm import Session
-from app.models import Task, User, get_db, Base
-from sqlalchemy import create_engine
+from app.models import Task, User, get_async_db, Base
+from sqlalchemy import create_engine, select
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import NullPool
 from app.message_service.gmail_service import GmailService
-from app.api.routes.tasks import router
+from app.api.routes.tasks import router, keyset_filter
 from fastapi.testclient import TestClient
 from fastapi import FastAPI
 import datetime
@@ -20,16 +22,19 @@ class TestTaskRoutes(unittest.TestCase):
         self.TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
         self.db = self.TestingSessionLocal()
         
-        # Override get_db dependency
-        def override_get_db():
-            try:
-                yield self.db
-            finally:
-                self.db.close()
+        # Routes use an async session on the same database. Each test client
+        # request runs on a new event loop, so connections are not pooled.
+        self.async_engine = create_async_engine("sqlite+aiosqlite:///test.db", poolclass=NullPool)
+        self.AsyncTestingSessionLocal = async_sessionmaker(self.async_engine, expire_on_commit=False)
+
+        # Override get_async_db dependency
+        async def override_get_async_db():
+            async with self.AsyncTestingSessionLocal() as db:
+                yield db
                 
         self.app = FastAPI()
         self.app.include_router(router)
-        self.app.dependency_overrides[get_db] = override_get_db
+        self.app.dependency_overrides[get_async_db] = override_get_async_db
         self.client = TestClient(self.app)
         
     def tearDown(self):
@@ -70,3 +75,97 @@ class TestTaskRoutes(unittest.TestCase):
         response = self.client.put("/tasks/2", json={"title": "Updated Task", "description": "Updated Description", "due_date": "2025-01-02"})
         self.assertEqual(response.status_code, 404)
 
+    def _add_tasks(self):
+        self.db.add(User(id=1, email="test@test.com", password="test_password"))
+        for i in range(5):
+            self.db.add(Task(
+                user_id=1,
+                title=f"Task {i}",
+                description="Test Description",
+                completed=i % 2 == 0,
+                created_at=datetime.datetime(2025, 1, 1 + i),
+                due_date=datetime.datetime(2025, 2, 1 + i) if i < 3 else None
+            ))
+        self.db.commit()
+
+    def test_get_tasks_pagination(self):
+        self._add_tasks()
+
+        titles = []
+        cursor = None
+        for _ in range(3):
+            params = {"limit": 2}
+            if cursor:
+                params["cursor"] = cursor
+            response = self.client.get("/tasks", headers={"user-id": "1"}, params=params)
+            self.assertEqual(response.status_code, 200)
+            titles += [task['title'] for task in response.json()]
+            cursor = response.headers.get("X-Next-Cursor")
+
+        self.assertEqual(titles, ["Task 4", "Task 3", "Task 2", "Task 1", "Task 0"])
+        self.assertIsNone(cursor)
+
+    def test_get_tasks_sorted_by_due_date(self):
+        self._add_tasks()
+
+        titles = []
+        cursor = None
+        while True:
+            params = {"limit": 2, "sort": "due_date"}
+            if cursor:
+                params["cursor"] = cursor
+            response = self.client.get("/tasks", headers={"user-id": "1"}, params=params)
+            titles += [task['title'] for task in response.json()]
+            cursor = response.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+
+        # Tasks without a due date come last
+        self.assertEqual(titles, ["Task 0", "Task 1", "Task 2", "Task 3", "Task 4"])
+
+    def test_get_tasks_sorted_by_due_date_descending(self):
+        self._add_tasks()
+
+        pages = []
+        cursor = None
+        while True:
+            params = {"limit": 2, "sort": "-due_date"}
+            if cursor:
+                params["cursor"] = cursor
+            response = self.client.get("/tasks", headers={"user-id": "1"}, params=params)
+            pages.append([task['title'] for task in response.json()])
+            cursor = response.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+
+        # The second page crosses from dated tasks into the tail without a due date
+        self.assertEqual(pages, [["Task 2", "Task 1"], ["Task 0", "Task 4"], ["Task 3"]])
+
+    def test_keyset_filter_is_an_index_range(self):
+        query = select(Task).filter(
+            Task.user_id == 1, keyset_filter(Task.created_at, True, datetime.datetime(2025, 1, 3), 3)
+        ).order_by(Task.created_at.desc(), Task.id.desc())
+        compiled = query.compile(self.engine)
+
+        with self.engine.connect() as connection:
+            plan = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", tuple(compiled.params.values())).fetchall()
+
+        self.assertIn("(user_id=? AND created_at<?)", " ".join(row[-1] for row in plan))
+
+    def test_get_tasks_filters(self):
+        self._add_tasks()
+
+        response = self.client.get("/tasks", headers={"user-id": "1"}, params={"completed": "true"})
+        self.assertEqual([task['title'] for task in response.json()], ["Task 4", "Task 2", "Task 0"])
+
+        response = self.client.get("/tasks", headers={"user-id": "1"}, params={"due_after": "2025-02-02", "due_before": "2025-02-03"})
+        self.assertEqual([task['title'] for task in response.json()], ["Task 2", "Task 1"])
+
+        response = self.client.get("/tasks", headers={"user-id": "1"}, params={"created_after": "2025-01-04T00:00:00"})
+        self.assertEqual([task['title'] for task in response.json()], ["Task 4"])
+
+    def test_get_tasks_invalid_cursor(self):
+        self._add_tasks()
+        response = self.client.get("/tasks", headers={"user-id": "1"}, params={"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
@@ -0,0 +1,113 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from google.auth.exceptions import RefreshError
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app.models import Base, User, GmailCredentials, decrypt_token
+from app.services.token_refresh import TokenRefreshScheduler
+
+
+class TestTokenRefreshScheduler(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite:///:memory:')
+        Base.metadata.create_all(self.engine)
+        self.db = sessionmaker(bind=self.engine)()
+        self.now = datetime(2025, 1, 1, 12, 0)
+        for i, minutes in enumerate([2, 60, 4], start=1):
+            self.db.add(User(id=i, email=f"test{i}@example.com", password="test_password", is_google_authenticated=True))
+            self.db.add(GmailCredentials(
+                id=i,
+                user_id=i,
+                token=f"token{i}",
+                refresh_token=f"refresh{i}",
+                token_expiry=self.now + timedelta(minutes=minutes)
+            ))
+        self.db.add(User(id=4, email="test4@example.com", password="test_password", is_google_authenticated=True))
+        self.db.add(GmailCredentials(id=4, user_id=4, token="token4", token_expiry=self.now))
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_due_in_expiry_order(self):
+        scheduler = TokenRefreshScheduler(lead_seconds=300)
+        scheduler.load(self.db)
+
+        # Credentials 4 has no refresh token so is never scheduled
+        self.assertEqual(scheduler.due(self.now), [1, 3])
+        self.assertEqual(scheduler.due(self.now), [])
+        self.assertEqual(scheduler.due(self.now + timedelta(minutes=60)), [2])
+
+    def test_due_respects_batch_size(self):
+        scheduler = TokenRefreshScheduler(lead_seconds=300, batch_size=1)
+        scheduler.load(self.db)
+        self.assertEqual(scheduler.due(self.now), [1])
+        self.assertEqual(scheduler.due(self.now), [3])
+
+    def test_reschedule_supersedes_previous_entry(self):
+        scheduler = TokenRefreshScheduler(lead_seconds=300)
+        scheduler.schedule(1, self.now)
+        scheduler.schedule(1, self.now + timedelta(hours=1))
+        self.assertEqual(scheduler.due(self.now), [])
+
+    def test_refresh_due(self):
+        scheduler = TokenRefreshScheduler(lead_seconds=300)
+        scheduler.load(self.db)
+
+        def update_token(credentials):
+            if credentials.id == 3:
+                raise Exception("Connection reset")
+            credentials.token = "new_token"
+            credentials.token_expiry = self.now + timedelta(hours=1)
+
+        with patch.object(GmailCredentials, 'update_token', update_token):
+            self.assertEqual(scheduler.refresh_due(self.db, self.now), 1)
+
+        self.assertEqual(self.db.get(GmailCredentials, 1).token, "new_token")
+        # Refreshed tokens are rescheduled for their new expiry, failures are retried later
+        self.assertEqual(scheduler.due(self.now + timedelta(minutes=10)), [3])
+        self.assertEqual(scheduler.due(self.now + timedelta(hours=1)), [1, 2])
+
+    def test_load_skips_superseded_and_disconnected_credentials(self):
+        self.db.add(User(id=5, email="inactive@example.com", password="test_password", is_active=False, is_google_authenticated=True))
+        self.db.add(GmailCredentials(id=5, user_id=5, token="token5", refresh_token="refresh5", token_expiry=self.now))
+        self.db.add(User(id=6, email="disconnected@example.com", password="test_password"))
+        self.db.add(GmailCredentials(id=6, user_id=6, token="token6", refresh_token="refresh6", token_expiry=self.now))
+        # User 2 re-authenticated, superseding credentials 2
+        self.db.add(GmailCredentials(id=7, user_id=2, token="token7", refresh_token="refresh7", token_expiry=self.now + timedelta(minutes=3)))
+        self.db.commit()
+
+        scheduler = TokenRefreshScheduler(lead_seconds=300)
+        scheduler.load(self.db)
+
+        self.assertEqual(scheduler.due(self.now + timedelta(hours=2)), [1, 7, 3])
+
+    def test_revoked_token_is_not_retried(self):
+        scheduler = TokenRefreshScheduler(lead_seconds=300)
+        scheduler.load(self.db)
+
+        def update_token(credentials):
+            if credentials.id == 3:
+                raise RefreshError("invalid_grant: Token has been expired or revoked.")
+            credentials.token_expiry = self.now + timedelta(hours=1)
+
+        with patch.object(GmailCredentials, 'update_token', update_token):
+            scheduler.refresh_due(self.db, self.now)
+
+        self.assertFalse(self.db.get(User, 3).is_google_authenticated)
+        self.assertEqual(scheduler.due(self.now + timedelta(hours=2)), [1, 2])
+        # Nor is it scheduled again on reload
+        scheduler.load(self.db)
+        self.assertNotIn(3, scheduler.due(self.now + timedelta(hours=2)))
+
+    def test_decrypted_tokens_are_cached(self):
+        credentials = self.db.get(GmailCredentials, 1)
+        decrypt_token.cache_clear()
+        credentials.token
+        credentials.token
+        self.assertEqual(decrypt_token.cache_info().hits, 1)
+
+        # A changed token is a new ciphertext, so it is never served stale
+        credentials.token = "changed_token"
+        self.assertEqual(credentials.token, "changed_token")